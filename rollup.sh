@@ -0,0 +1,3 @@
+#!/bin/bash
+
+python -m stardust.rollup "$@"
@@ -0,0 +1,234 @@
+# Columnar archive of the candles for backtests.
+#
+# Candles of every trade pair and resolution are kept in <path>/<trade pair>/<resolution>/ as one .npy file per column
+# (ts, open, high, low, close, volume, counter_volume), ordered by ts. Backtests memory map the files and slice the
+# period by binary search on ts, hence candles are not copied and backtest workers share them through the OS page cache.
+#
+# Archive is kept up to date by importer (or archive.sh) by appending the candles imported since last sync. Files are
+# appended in place: data is written first and the shape in the header afterwards, so readers loading the files
+# meanwhile see the earlier candles.
+
+import getopt
+import io
+import logging
+import os
+import shutil
+import sys
+
+import numpy as np
+import yaml
+
+from stardust.data import set_db, get_backtest_db
+from stardust.rollup import ROLLUP_RESOLUTIONS
+
+COLUMNS = ('ts', 'open', 'high', 'low', 'close', 'volume', 'counter_volume')
+RESOLUTIONS = ('min',) + tuple(resolution for resolution, seconds, smaller in ROLLUP_RESOLUTIONS)
+
+
+def _header(version, dtype, length):
+    header = io.BytesIO()
+    d = {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (length,)}
+    if version == (1, 0):
+        np.lib.format.write_array_header_1_0(header, d)
+    else:
+        np.lib.format.write_array_header_2_0(header, d)
+    return header.getvalue()
+
+
+def write_from(filename, row, values):
+    """
+    Writes values to 1-D .npy file starting at given row, file is extended if needed.
+    """
+    values = np.ascontiguousarray(values)
+    if not os.path.exists(filename):
+        np.save(filename, values)
+        return
+
+    with open(filename, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+        length = max(shape[0], row + len(values))
+        values = values.astype(dtype, copy=False)
+
+        header = _header(version, dtype, length)
+        if len(header) == offset:
+            # header has room for larger shape in most cases
+            f.seek(offset + row * dtype.itemsize)
+            f.write(values.tobytes())
+            f.flush()
+            f.seek(0)
+            f.write(header)
+            return
+
+    # header grew, whole file is written again
+    old = np.load(filename, mmap_mode='r')
+    new = np.empty(length, dtype=dtype)
+    new[:row] = old[:row]
+    new[row:row + len(values)] = values
+    del old
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.save(f, new)
+    os.rename(tmp, filename)
+
+
+class CandleArchive(object):
+    """
+    Memory mapped columnar copy of SDEX_OHLCV and its rollups.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _dir(self, trade_pair, resolution):
+        return os.path.join(self.path, trade_pair, resolution)
+
+    def _filename(self, trade_pair, resolution, column):
+        return os.path.join(self._dir(trade_pair, resolution), '%s.npy' % column)
+
+    def _load(self, trade_pair, resolution):
+        if not os.path.exists(self._filename(trade_pair, resolution, 'ts')):
+            return None
+
+        try:
+            columns = {}
+            for column in COLUMNS:
+                columns[column] = np.load(self._filename(trade_pair, resolution, column), mmap_mode='r')
+        except:
+            logging.exception('Error occurred while loading archive of %s %s' % (trade_pair, resolution))
+            return None
+
+        # columns are appended one after the other, candles missing in any column are not complete yet
+        n = min([len(values) for values in columns.values()])
+        if n == 0:
+            return None
+        return dict((column, values[:n]) for column, values in columns.items())
+
+    def last_ts(self, trade_pair, resolution):
+        """
+        :return: ts of the last archived candle, None if nothing is archived
+        """
+        columns = self._load(trade_pair, resolution)
+        if columns is None:
+            return None
+        return int(columns['ts'][-1])
+
+    def load(self, trade_pair, resolution, period_from=None, period_to=None):
+        """
+        :return: dict with read-only memory mapped arrays of the candles in the period (both inclusive), None if
+        nothing is archived
+        """
+        columns = self._load(trade_pair, resolution)
+        if columns is None:
+            return None
+
+        ts = columns['ts']
+        start = int(np.searchsorted(ts, period_from, 'left')) if period_from else 0
+        end = int(np.searchsorted(ts, period_to, 'right')) if period_to else len(ts)
+        return dict((column, values[start:end]) for column, values in columns.items())
+
+    def sync(self, history, trade_pair, resolution, rebuild=False):
+        """
+        Appends the candles imported after the last sync. Last archived candle is written again, as it may have been
+        updated since (e.g. rollup of the current period).
+        history: SdexHistory without archive, candles are read from its database
+        :return: number of candles written
+        """
+        last_ts = None
+        if rebuild:
+            shutil.rmtree(self._dir(trade_pair, resolution), ignore_errors=True)
+        else:
+            last_ts = self.last_ts(trade_pair, resolution)
+
+        if last_ts is None:
+            row = 0
+            if not os.path.exists(self._dir(trade_pair, resolution)):
+                os.makedirs(self._dir(trade_pair, resolution))
+            for column in COLUMNS:
+                # files of incomplete earlier sync
+                if os.path.exists(self._filename(trade_pair, resolution, column)):
+                    os.remove(self._filename(trade_pair, resolution, column))
+        else:
+            row = len(self._load(trade_pair, resolution)['ts']) - 1
+
+        count = 0
+        for chunk in history.iter_candle_chunks(trade_pair, last_ts, None, resolution, prefetch=False):
+            for column in COLUMNS:
+                write_from(self._filename(trade_pair, resolution, column), row, chunk[column])
+            row += len(chunk['ts'])
+            count += len(chunk['ts'])
+        return count
+
+    def sync_all(self, history, trade_pair, rebuild=False):
+        for resolution in RESOLUTIONS:
+            count = self.sync(history, trade_pair, resolution, rebuild)
+            logging.debug('Archived %s %s candles of %s' % (count, resolution, trade_pair))
+
+
+def usage():
+    print('archive -c/--config <config-file> [-p/--pair <trade-pair>] [-r/--rebuild]')
+
+
+if __name__ == '__main__':
+    # exports SDEX_OHLCV to the archive, importer keeps it up to date afterwards
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "c:p:r", ["config=", "pair=", "rebuild"])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    configfile = 'engine.yaml'
+    pairs = []
+    rebuild = False
+    for opt, val in opts:
+        if opt in ('-c', '--config'):
+            configfile = val
+        elif opt in ('-p', '--pair'):
+            pairs += [val]
+        elif opt in ('-r', '--rebuild'):
+            rebuild = True
+
+    if not os.path.isfile(configfile):
+        print('config file %s doesnt exist' % configfile)
+        usage()
+        sys.exit(2)
+
+    with open(configfile, 'r') as f:
+        configcontent = f.read()
+    try:
+        config = yaml.load(configcontent)
+    except yaml.YAMLError as e:
+        print('Incorrect config file content. ex = %s' % str(e))
+        sys.exit(2)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    if 'archive' not in config or 'path' not in config['archive']:
+        print('Archive path is missing in archive section of engine.yaml')
+        sys.exit(2)
+
+    main_db = 'engine.db'
+    backtest_db = 'backtest.db'
+    if 'db' in config:
+        dbconfig = config['db']
+        if 'connection_main' in dbconfig:
+            main_db = dbconfig['connection_main']
+        if 'connection_backtest' in dbconfig:
+            backtest_db = dbconfig['connection_backtest']
+    set_db(main_db, backtest_db)
+
+    # backtester imports this module
+    from stardust.backtester import SdexHistory
+
+    archive = CandleArchive(config['archive']['path'])
+    history = SdexHistory(sdex_db=get_backtest_db()).init()
+    if not pairs:
+        pairs = [pair.code for pair in history.get_trading_pairs()]
+    for pair in pairs:
+        archive.sync_all(history, pair, rebuild)
+        logging.info('Archived %s' % pair)
+    history.close()
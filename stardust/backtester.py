@@ -1,17 +1,38 @@
 import datetime
 import getopt
+import hashlib
+import itertools
 import json
 import logging
+import math
+import multiprocessing
 import os
+import pickle
+import queue
+import signal
+import socket
 import sqlite3
 import sys
+import threading
 import time
+import uuid
 
 import numpy as np
 import yaml
 
-from stardust.data import get_backtest_db, EPOCH, TradeAdvice, Candle, set_db, Backtest
-from stardust.strategy import STRATEGY_FACTORY as strategy_factory
+from stardust.archive import CandleArchive
+from stardust.cache import IndicatorCache
+from stardust.data import get_backtest_db, get_main_db, EPOCH, TradeAdvice, Candle, set_db, Backtest, \
+    aggregate_candle, expand_grid, encode_equity_curve, estimate_cost, SECONDS_PER_YEAR, \
+    EQUITY_CURVE_POINTS
+from stardust.notify import set_notify_sockets, notify_webapp, bind, wait
+from stardust.rollup import RESOLUTION_SECONDS, create_rollup_table
+from stardust.strategy import STRATEGY_FACTORY as strategy_factory, STRATEGY_CLASSES as strategy_classes, \
+    BaseTradingStrategy
+
+
+# number of candles read from the database at once by columnar loader
+CHUNK_SIZE = 50000
 
 
 def get_asset(code, issuer):
@@ -31,6 +52,17 @@ def format_asset(asset):
 class SdexHistory(object):
     NATIVE_ASSET = ('XLM', 'native')
 
+    # resolutions of the history corresponding to the candle sizes used by strategies
+    CANDLESIZE_RESOLUTIONS = {
+        Candle.CANDLESIZE_1MIN: 'min',
+        Candle.CANDLESIZE_5MIN: '5min',
+        Candle.CANDLESIZE_15MIN: '15min',
+        Candle.CANDLESIZE_1HR: '1hr',
+        Candle.CANDLESIZE_4HR: '4hr',
+        Candle.CANDLESIZE_1DAY: '1d',
+        Candle.CANDLESIZE_1WK: '1w',
+    }
+
     class TradingPair(object):
         def __init__(self, code, first, second):
             self.code = code
@@ -51,9 +83,16 @@ class SdexHistory(object):
             self.volume = []
             self.counter_volume = []
 
-    def __init__(self, sdex_db):
+    def __init__(self, sdex_db, indicator_cache=None, archive=None, shards=1):
         self.sdex_db = sdex_db
         self.conn = None
+        self.indicator_cache = indicator_cache
+        # CandleArchive, candles in it are memory mapped instead of being read from the database
+        self.archive = archive
+        # number of processes running parts of the period of long backtest of strategy which is not vectorized
+        self.shards = shards
+        # lease of the backtest being run, trades are saved only while it is held
+        self.lease = None
 
     def init(self):
         try:
@@ -105,45 +144,53 @@ class SdexHistory(object):
         return pairs
 
     @staticmethod
-    def resolution_based_projection(resolution, where_clause):
-        selections = {
-            'min': 'year, month, day, hour, minute',
-            '5min': 'year, month, day, hour, minute5',
-            '15min': 'year, month, day, hour, minute15',
-            '1hr': 'year, month, day, hour',
-            '4hr': 'year, month, day, hour4',
-            '1d': 'year, month, day',
-            '1w': 'year, week',
-        }
-
-        if resolution not in selections.keys():
+    def _candles_select(resolution, where_stmt, where_params, page_token=None):
+        """
+        :return: (select statement, params) of candles of given resolution ordered by ts, page token of next rows is
+        (first column, last column) of the last row (see _page_token)
+        """
+        if not resolution or resolution == 'min':
+            # keyset pagination over the index on (trade_pair, ts, id) which covers the selected columns, hence pages
+            # deep in the period are read as fast as the first one
+            if page_token:
+                where_stmt += ' and (ts, id) > (?, ?) '
+                where_params = where_params + list(page_token)
+            return 'SELECT ts, high, low, open, close, base_volume, counter_volume, id FROM sdex_ohlcv ' \
+                   'WHERE %s ORDER BY ts, id' % (where_stmt,), where_params
+
+        if resolution not in RESOLUTION_SECONDS:
             raise Exception('Invalid resolution. Supported = [min, 5min, 15min, 1hr, 4hr, 1d, 1w]')
 
-        return """
-            SELECT mints,
-                maxhigh,
-                minlow,
-                (SELECT open
-                    FROM sdex_ohlcv
-                    WHERE rowid = minrow) AS firstopen,
-                (SELECT close
-                    FROM sdex_ohlcv
-                    WHERE rowid = maxrow) AS lastclose,
-                sum_base_volume,
-                sum_counter_volume,
-                maxid
-            FROM
-                (SELECT min(ts) AS mints,
-                    min(rowid) AS minrow,
-                    max(rowid) AS maxrow,
-                    max(high) AS maxhigh,
-                    min(low) AS minlow,
-                    sum(base_volume) AS sum_base_volume,
-                    sum(counter_volume) AS sum_counter_volume,
-                    max(id) AS maxid
-                FROM sdex_ohlcv
-                WHERE %s GROUP BY %s 
-                ORDER BY ts) """ % (where_clause, selections[resolution])
+        # larger candles are maintained by importer in the rollup table
+        if page_token:
+            where_stmt += ' and ts > ? '
+            where_params = where_params + [page_token[0]]
+        where_stmt += ' and resolution = ? '
+        where_params = where_params + [resolution]
+        return 'SELECT ts, high, low, open, close, base_volume, counter_volume, ts FROM sdex_ohlcv_rollup ' \
+               'WHERE %s ORDER BY ts' % (where_stmt,), where_params
+
+    @staticmethod
+    def _page_token(row):
+        """
+        :return: page token of the rows after given row of _candles_select, (ts, id) of minute candles
+        """
+        return int(row[0]), int(row[7])
+
+    @staticmethod
+    def _candles_where(trade_pair_code, period_from=None, period_to=None):
+        where_stmt = ' trade_pair = ? and '
+        where_params = [trade_pair_code]
+
+        if period_from:
+            where_stmt += ' ts >= ? and '
+            where_params += [period_from]
+
+        if period_to:
+            where_stmt += ' ts <= ? and '
+            where_params += [period_to]
+
+        return where_stmt[:-5], where_params
 
     def get_candles(self, trade_pair_code, period_from=None, period_to=None, resolution=None, page_size=100,
                     page_token=None):
@@ -153,7 +200,7 @@ class SdexHistory(object):
         period_to: seconds since epoch indicating end from where SDEX is needed (optional)
         resolution: [min, 5min, 15min, 1hr, 4hr, 1d, 1w]
         page_size: size of the result set (optional, default:100)
-        page_token: page_token to fetch next page (optional)
+        page_token: page_token of the previous page to fetch next page (optional)
 
         returns: Ohlcv containing numpy arrays for open, high, low, close, volume
         """
@@ -164,29 +211,9 @@ class SdexHistory(object):
         if not self.conn:
             raise Exception('No DB connection: call init first')
 
-        where_stmt = ' trade_pair = ? and '
-        where_params = [trade_pair_code]
-
-        if period_from:
-            where_stmt += ' ts >= ? and '
-            where_params += [period_from]
-
-        if period_to:
-            where_stmt += ' ts <= ? and '
-            where_params += [period_to]
-
-        where_stmt = where_stmt[:-5]
-
-        if page_token:
-            where_stmt = where_stmt + ' and id > ? '
-            where_params += [page_token]
-
-        if not resolution or resolution == 'min':
-            ohlcv_select_stmt = 'SELECT ts, high, low, open, close, base_volume, counter_volume, id FROM '
-            ohlcv_select_stmt += ' ( SELECT * FROM sdex_ohlcv WHERE %s ORDER BY ts)' % (where_stmt,)
-        else:
-            ohlcv_select_stmt = SdexHistory.resolution_based_projection(resolution, where_stmt)
-
+        resolution = SdexHistory.CANDLESIZE_RESOLUTIONS.get(resolution, resolution)
+        where_stmt, where_params = SdexHistory._candles_where(trade_pair_code, period_from, period_to)
+        ohlcv_select_stmt, where_params = SdexHistory._candles_select(resolution, where_stmt, where_params, page_token)
         ohlcv_select_stmt += ' LIMIT %s' % (page_size,)
 
         cur = self.conn.execute(ohlcv_select_stmt, where_params)
@@ -202,11 +229,582 @@ class SdexHistory(object):
             result.volume += [row[5]]
             result.counter_volume += [row[6]]
 
-            result.page_token = row[7]
+            result.page_token = SdexHistory._page_token(row)
             i += 1
 
         return i, result
 
+    @staticmethod
+    def _rows_to_chunk(rows):
+        """
+        :return: dict with numpy arrays of the candles in rows (ts, high, low, open, close, base_volume,
+        counter_volume, id)
+        """
+        # rows are converted in C straight into one block, columns of the chunk are views of it
+        n, num_columns = len(rows), len(rows[0])
+        try:
+            values = np.fromiter(itertools.chain.from_iterable(rows), dtype=float, count=n * num_columns)
+        except TypeError:
+            # missing values are nan
+            values = np.array(rows, dtype=float)
+        values = values.reshape(n, num_columns).T.copy()
+
+        return {
+            'ts': values[0].astype(np.int64),
+            'high': values[1],
+            'low': values[2],
+            'open': values[3],
+            'close': values[4],
+            'volume': values[5],
+            'counter_volume': values[6],
+        }
+
+    def _read_chunks(self, conn, trade_pair_code, period_from, period_to, resolution, chunk_size):
+        resolution = SdexHistory.CANDLESIZE_RESOLUTIONS.get(resolution, resolution)
+
+        page_token = None
+        while True:
+            where_stmt, where_params = SdexHistory._candles_where(trade_pair_code, period_from, period_to)
+            select_stmt, where_params = SdexHistory._candles_select(resolution, where_stmt, where_params, page_token)
+            select_stmt += ' LIMIT %s' % (chunk_size,)
+
+            # every chunk is read by its own query, read lock is not held between the chunks so that trades can be
+            # written to the same database meanwhile
+            rows = conn.execute(select_stmt, where_params).fetchall()
+            if not rows:
+                break
+
+            page_token = SdexHistory._page_token(rows[-1])
+            yield SdexHistory._rows_to_chunk(rows)
+            if len(rows) < chunk_size:
+                break
+
+    def _archived_candles(self, trade_pair_code, period_from, period_to, resolution):
+        """
+        :return: (candles of the period in the archive or None, ts from which candles should be read from the database
+        or None if archive has all of them)
+        """
+        if not self.archive:
+            return None, period_from
+
+        resolution = SdexHistory.CANDLESIZE_RESOLUTIONS.get(resolution, resolution) or 'min'
+        last_ts = self.archive.last_ts(trade_pair_code, resolution)
+        if last_ts is None:
+            return None, period_from
+
+        if period_to and period_to < last_ts:
+            return self.archive.load(trade_pair_code, resolution, period_from, period_to), None
+
+        # last archived candle may be updated after it was archived (e.g. rollup of the current period), hence it is
+        # read from the database along with the candles imported after it
+        return self.archive.load(trade_pair_code, resolution, period_from, last_ts - 1), max(period_from or 0, last_ts)
+
+    def iter_candle_chunks(self, trade_pair_code, period_from=None, period_to=None, resolution=None,
+                           chunk_size=CHUNK_SIZE, prefetch=True):
+        """
+        trade_pair: trading pair for which data is needed (mandatory)
+        period_from: seconds since epoch indicating start from where SDEX data is needed (optional)
+        period_to: seconds since epoch indicating end from where SDEX is needed (optional)
+        resolution: [min, 5min, 15min, 1hr, 4hr, 1d, 1w]
+        chunk_size: number of candles in a chunk
+        prefetch: if True, next chunk is read in background thread while the current one is processed
+
+        returns: generator of dicts with numpy arrays of ts (seconds since epoch), open, high, low, close, volume and
+        counter_volume. At most two chunks are in memory at any time. Candles in the archive are read-only memory
+        mapped arrays.
+        """
+        if not trade_pair_code:
+            raise Exception('Trading pair is mandatory')
+
+        if not self.conn:
+            raise Exception('No DB connection: call init first')
+
+        archived, period_from = self._archived_candles(trade_pair_code, period_from, period_to, resolution)
+        if archived is not None:
+            for i in range(0, len(archived['ts']), chunk_size):
+                yield dict((column, values[i:i + chunk_size]) for column, values in archived.items())
+            if period_from is None:
+                return
+
+        if not prefetch:
+            yield from self._read_chunks(self.conn, trade_pair_code, period_from, period_to, resolution, chunk_size)
+            return
+
+        chunks = queue.Queue(maxsize=1)
+        stopped = threading.Event()
+
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    chunks.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def read():
+            # sqlite connection can not be shared between threads
+            conn = None
+            try:
+                conn = sqlite3.connect(self.sdex_db)
+                for chunk in self._read_chunks(conn, trade_pair_code, period_from, period_to, resolution, chunk_size):
+                    if not put(chunk):
+                        return
+                put(None)
+            except Exception as e:
+                put(e)
+            finally:
+                if conn:
+                    conn.close()
+
+        reader = threading.Thread(target=read, name='candle-prefetch', daemon=True)
+        reader.start()
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is None:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            stopped.set()
+            reader.join()
+
+    def get_all_candles(self, trade_pair_code, period_from=None, period_to=None, resolution=None,
+                        chunk_size=CHUNK_SIZE):
+        """
+        trade_pair: trading pair for which data is needed (mandatory)
+        period_from: seconds since epoch indicating start from where SDEX data is needed (optional)
+        period_to: seconds since epoch indicating end from where SDEX is needed (optional)
+        resolution: [min, 5min, 15min, 1hr, 4hr, 1d, 1w]
+
+        returns: dict with numpy arrays of ts (seconds since epoch), open, high, low, close, volume and counter_volume
+        of all the candles in the period, arrays are memory mapped without copying if all of them are in the archive
+        """
+        archived, db_from = self._archived_candles(trade_pair_code, period_from, period_to, resolution)
+        if archived is not None and db_from is None:
+            return archived
+
+        chunks = list(self.iter_candle_chunks(trade_pair_code, period_from, period_to, resolution, chunk_size))
+        return SdexHistory._concatenate_chunks(chunks)
+
+    def get_pairs_candles(self, trade_pair_codes, period_from=None, period_to=None, resolution=None,
+                          chunk_size=CHUNK_SIZE):
+        """
+        Loads the candles of several trade pairs, candles which are not in the archive are read by one query for all
+        the pairs.
+        :return: dict of trade pair -> candles of the pair in the format of get_all_candles
+        """
+        candles = {}
+        chunks = {}
+        db_from = {}
+        for pair in trade_pair_codes:
+            archived, pair_from = self._archived_candles(pair, period_from, period_to, resolution)
+            if archived is not None and pair_from is None:
+                candles[pair] = archived
+                continue
+            chunks[pair] = [archived] if archived is not None else []
+            db_from[pair] = pair_from or 0
+        if not db_from:
+            return candles
+
+        # one scan of the index on (trade_pair, ts, id) from the earliest candle which is not archived, candles of
+        # the pairs archived after it are skipped
+        resolution = SdexHistory.CANDLESIZE_RESOLUTIONS.get(resolution, resolution)
+        select_stmt, params = SdexHistory._pairs_candles_select(list(db_from), resolution,
+                                                                min(db_from.values()) or None, period_to)
+        cur = self.conn.execute(select_stmt, params)
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            for pair, pair_rows in itertools.groupby(rows, key=lambda row: row[0]):
+                pair_rows = [row[1:] for row in pair_rows if row[1] >= db_from[pair]]
+                if pair_rows:
+                    chunks[pair] += [SdexHistory._rows_to_chunk(pair_rows)]
+
+        for pair, pair_chunks in chunks.items():
+            candles[pair] = SdexHistory._concatenate_chunks(pair_chunks)
+        return candles
+
+    @staticmethod
+    def _pairs_candles_select(trade_pair_codes, resolution, period_from=None, period_to=None):
+        """
+        :return: (select statement, params) of candles of given resolution of all the trade pairs ordered by
+        (trade_pair, ts), rows are (trade_pair,) followed by the columns of _candles_select
+        """
+        where_stmt = ' trade_pair in (%s) ' % ', '.join(['?'] * len(trade_pair_codes))
+        where_params = list(trade_pair_codes)
+        if period_from:
+            where_stmt += ' and ts >= ? '
+            where_params += [period_from]
+        if period_to:
+            where_stmt += ' and ts <= ? '
+            where_params += [period_to]
+
+        if not resolution or resolution == 'min':
+            return 'SELECT trade_pair, ts, high, low, open, close, base_volume, counter_volume, id FROM sdex_ohlcv ' \
+                   'WHERE %s ORDER BY trade_pair, ts, id' % (where_stmt,), where_params
+
+        if resolution not in RESOLUTION_SECONDS:
+            raise Exception('Invalid resolution. Supported = [min, 5min, 15min, 1hr, 4hr, 1d, 1w]')
+
+        where_stmt += ' and resolution = ? '
+        where_params += [resolution]
+        return 'SELECT trade_pair, ts, high, low, open, close, base_volume, counter_volume, ts ' \
+               'FROM sdex_ohlcv_rollup WHERE %s ORDER BY trade_pair, ts' % (where_stmt,), where_params
+
+    @staticmethod
+    def _concatenate_chunks(chunks):
+        """
+        :return: dict with numpy arrays of all the candles in the chunks
+        """
+        columns = ('ts', 'open', 'high', 'low', 'close', 'volume', 'counter_volume')
+        if not chunks:
+            ohlcv = {column: np.empty(0) for column in columns}
+            ohlcv['ts'] = np.empty(0, dtype=np.int64)
+            return ohlcv
+        if len(chunks) == 1:
+            return dict((column, np.ascontiguousarray(chunks[0][column])) for column in columns)
+        return dict((column, np.concatenate([chunk[column] for chunk in chunks])) for column in columns)
+
+    def count_candles(self, trade_pair_code, period_from=None, period_to=None, resolution=None):
+        """
+        :return: number of candles in the period
+        """
+        archived, period_from = self._archived_candles(trade_pair_code, period_from, period_to, resolution)
+        count = len(archived['ts']) if archived is not None else 0
+        if archived is not None and period_from is None:
+            return count
+
+        resolution = SdexHistory.CANDLESIZE_RESOLUTIONS.get(resolution, resolution)
+        where_stmt, where_params = SdexHistory._candles_where(trade_pair_code, period_from, period_to)
+        select_stmt, where_params = SdexHistory._candles_select(resolution, where_stmt, where_params)
+        return count + self.conn.execute('SELECT count(*) FROM (%s)' % select_stmt, where_params).fetchone()[0]
+
+    @staticmethod
+    def load_checkpoint(bid):
+        """
+        :return: (ts of the last processed candle, number of processed candles, pickled state) of the last checkpoint
+        of the backtest, None if there is no checkpoint
+        """
+        num_tries = 0
+        while num_tries < 3:
+            try:
+                with sqlite3.connect(get_backtest_db()) as db:
+                    return db.execute("select ts, candles, state from backtest_checkpoint where backtest_id = ?",
+                                      [bid]).fetchone()
+            except:
+                logging.exception('Error occurred while loading checkpoint of backtest %s' % bid)
+                num_tries += 1
+        return None
+
+    @staticmethod
+    def _write_checkpoint(conn, bid, checkpoint, lease_owner):
+        ts, candles, state = checkpoint
+        if state is None:
+            conn.execute("delete from backtest_checkpoint where backtest_id = ?", [bid])
+            return True
+
+        if lease_owner:
+            cursor = conn.execute("insert or replace into backtest_checkpoint(backtest_id, ts, candles, state) "
+                                  "select ?, ?, ?, ? where exists "
+                                  "(select 1 from backtest_request where id = ? and lease_owner = ?)",
+                                  [bid, ts, candles, state, bid, lease_owner])
+        else:
+            cursor = conn.execute("insert or replace into backtest_checkpoint(backtest_id, ts, candles, state) "
+                                  "values (?, ?, ?, ?)", [bid, ts, candles, state])
+        return cursor.rowcount == 1
+
+    @staticmethod
+    def save_trades(bid, trades, lease_owner=None, db=None, checkpoint=None):
+        """
+        trades: list of (advice, sold_asset, sold_amount, bought_asset, bought_amount)
+        lease_owner: if given, trades are saved only if backtest is still leased by this owner
+        db: connection to backtest db to use, new connection is opened if not given
+        checkpoint: (ts of the last processed candle, number of processed candles, pickled state) of the backtest
+        after the trades, saved in the same transaction so that resumed backtest does not repeat the trades. Checkpoint
+        is deleted if state is None.
+        returns: True if trades are saved, False otherwise
+        """
+        ts = (datetime.datetime.utcnow() - EPOCH).total_seconds()
+        rows = [[ts, bid, advice, format_asset(sell_asset), float(total_sold), format_asset(buy_asset),
+                 float(total_bought)] for advice, sell_asset, total_sold, buy_asset, total_bought in trades]
+
+        if lease_owner:
+            # lease check and insert are done in the same statement, so the worker which lost the lease
+            # can not add trades to backtest that is already taken over by another worker
+            stmt = "insert into backtest_trades" \
+                   "(ts, backtest_id, advice, sold_asset, sold_amount, bought_asset, bought_amount)" \
+                   " select ?, ?, ?, ?, ?, ?, ? where exists " \
+                   "(select 1 from backtest_request where id = ? and lease_owner = ?)"
+            rows = [row + [bid, lease_owner] for row in rows]
+        else:
+            stmt = "insert into backtest_trades" \
+                   "(ts, backtest_id, advice, sold_asset, sold_amount, bought_asset, bought_amount)" \
+                   " values (?, ?, ?, ?, ?, ?, ?)"
+
+        def insert(conn):
+            # all the trades are inserted in one transaction
+            cursor = conn.executemany(stmt, rows)
+            if cursor.rowcount < len(rows) or \
+                    (checkpoint and not SdexHistory._write_checkpoint(conn, bid, checkpoint, lease_owner)):
+                conn.rollback()
+                logging.error('Backtest %s is not leased by %s anymore, trades are not saved' % (bid, lease_owner))
+                return False
+            conn.commit()
+            return True
+
+        num_tries = 0
+        while num_tries < 3:
+            try:
+                if db:
+                    return insert(db)
+                with sqlite3.connect(get_backtest_db()) as conn:
+                    return insert(conn)
+            except:
+                if db:
+                    db.rollback()
+                num_tries += 1
+
+        return False
+
+    def _save_trades(self, bid, trades, db=None, checkpoint=None):
+        if self.lease:
+            return SdexHistory.save_trades(bid, trades, self.lease.owner, db, checkpoint)
+        return SdexHistory.save_trades(bid, trades, None, db, checkpoint)
+
+    def result_keys(self, backtest_req: Backtest):
+        """
+        :return: (fingerprint of the request along with the code of its strategy, key of the minute candles in its
+        period which changes when candles are added to the period). Backtests with the same keys have the same results.
+        """
+        key = json.dumps([backtest_req.strategyname, strategy_version(backtest_req.strategyname),
+                          backtest_req.parameters, backtest_req.grid, backtest_req.tradepair, backtest_req.candlesize,
+                          backtest_req.start_ts, backtest_req.end_ts, backtest_req.pairs, backtest_req.capital],
+                         sort_keys=True)
+        data_keys = []
+        for pair in backtest_req.pairs or [backtest_req.tradepair]:
+            # larger candles are rolled up from the minute candles, updated candles are replaced by rows with new id
+            where_stmt, where_params = SdexHistory._candles_where(pair, backtest_req.start_ts, backtest_req.end_ts)
+            count, last_id = self.conn.execute('SELECT count(*), max(id) FROM sdex_ohlcv WHERE %s' % where_stmt,
+                                               where_params).fetchone()
+            data_keys += ['%s:%s' % (count, last_id)]
+        return hashlib.sha1(key.encode()).hexdigest(), ','.join(data_keys)
+
+    @staticmethod
+    def find_result(bid, result_key, data_key):
+        """
+        :return: id of the latest finished backtest with the same keys as given backtest, None if there is none
+        """
+        num_tries = 0
+        while num_tries < 3:
+            try:
+                with sqlite3.connect(get_backtest_db()) as db:
+                    row = db.execute("select id from backtest_request where result_key = ? and data_key = ? and "
+                                     "status = ? and results_id is null and id != ? order by id desc limit 1",
+                                     [result_key, data_key, Backtest.STATUS_FINISHED, bid]).fetchone()
+                return row[0] if row else None
+            except:
+                logging.exception('Error occurred while looking up results of backtest %s' % bid)
+                num_tries += 1
+        return None
+
+    @staticmethod
+    def save_result_keys(bid, result_key, data_key, results_id=None, lease_owner=None):
+        """
+        results_id: id of the backtest whose results are the results of given backtest, None if it is run
+        returns: True if keys are saved, False otherwise
+        """
+        stmt = "update backtest_request set result_key = ?, data_key = ?, results_id = ? where id = ?"
+        params = [result_key, data_key, results_id, bid]
+        if lease_owner:
+            stmt += " and lease_owner = ?"
+            params += [lease_owner]
+
+        num_tries = 0
+        while num_tries < 3:
+            try:
+                with sqlite3.connect(get_backtest_db()) as db:
+                    cursor = db.execute(stmt, params)
+                    db.commit()
+                return cursor.rowcount == 1
+            except:
+                num_tries += 1
+        return False
+
+    def use_cached_result(self, backtest_req: Backtest):
+        """
+        Finds finished backtest with the same request over the same candles, whose results are then reported as the
+        results of given backtest.
+        :return: True if backtest uses results of another backtest, False if it has to be run
+        """
+        bid = backtest_req.bid
+        try:
+            result_key, data_key = self.result_keys(backtest_req)
+        except:
+            logging.exception('Cannot compute result keys of backtest %s' % bid)
+            return False
+
+        results_id = SdexHistory.find_result(bid, result_key, data_key)
+        lease_owner = self.lease.owner if self.lease else None
+        if not SdexHistory.save_result_keys(bid, result_key, data_key, results_id, lease_owner):
+            return False
+        if results_id:
+            logging.info('Backtest %s has the same results as backtest %s' % (bid, results_id))
+            return True
+        return False
+
+    @staticmethod
+    def state_fingerprint(backtest_req: Backtest):
+        """
+        :return: fingerprint of the backtests that run the same algo over the same candles from the same start with
+        the same code of the strategy. Start is a part of the fingerprint, as state of the strategy and its trades
+        depend on all the candles since the start: only backtests with later end are extended, backtest of a moved
+        period (e.g. last 30 days re-run daily) is always run from its start. State is only saved by backtests run
+        candle by candle in one process, vectorized and sharded backtests are never extended from.
+        """
+        key = json.dumps([backtest_req.strategyname, strategy_version(backtest_req.strategyname),
+                          backtest_req.parameters, backtest_req.tradepair, backtest_req.candlesize,
+                          backtest_req.start_ts], sort_keys=True)
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    @staticmethod
+    def save_state(bid, strategyname, fingerprint, checkpoint, lease_owner=None, db=None):
+        """
+        Saves state of the finished backtest, so that later backtest with the same fingerprint is extended from it.
+        State of the earlier backtests with the same fingerprint is deleted, as later backtests are extended from
+        the latest one. States saved by another version of the strategy are deleted as well, they can not be loaded
+        by the current code.
+        checkpoint: (ts of the last processed candle, number of processed candles, pickled state)
+        returns: True if state is saved, False otherwise
+        """
+        ts, candles, state = checkpoint
+        version = strategy_version(strategyname)
+
+        def insert(conn):
+            if lease_owner:
+                cursor = conn.execute("insert or replace into backtest_state(backtest_id, strategy, version, "
+                                      "fingerprint, ts, candles, state) select ?, ?, ?, ?, ?, ?, ? where exists "
+                                      "(select 1 from backtest_request where id = ? and lease_owner = ?)",
+                                      [bid, strategyname, version, fingerprint, ts, candles, state, bid, lease_owner])
+            else:
+                cursor = conn.execute("insert or replace into backtest_state(backtest_id, strategy, version, "
+                                      "fingerprint, ts, candles, state) values (?, ?, ?, ?, ?, ?, ?)",
+                                      [bid, strategyname, version, fingerprint, ts, candles, state])
+            if cursor.rowcount != 1:
+                conn.rollback()
+                return False
+            conn.execute("delete from backtest_state where fingerprint = ? and ts <= ? and backtest_id != ?",
+                         [fingerprint, ts, bid])
+            conn.execute("delete from backtest_state where strategy = ? and version != ?", [strategyname, version])
+            conn.commit()
+            return True
+
+        num_tries = 0
+        while num_tries < 3:
+            try:
+                if db:
+                    return insert(db)
+                with sqlite3.connect(get_backtest_db()) as conn:
+                    return insert(conn)
+            except:
+                logging.exception('Error occurred while saving state of backtest %s' % bid)
+                if db:
+                    db.rollback()
+                num_tries += 1
+        return False
+
+    def _save_state(self, backtest_req: Backtest, checkpoint, db=None):
+        lease_owner = self.lease.owner if self.lease else None
+        if not SdexHistory.save_state(backtest_req.bid, backtest_req.strategyname,
+                                      SdexHistory.state_fingerprint(backtest_req), checkpoint, lease_owner, db):
+            # backtest is finished anyway, later backtests are only run from the start
+            logging.warning('State of backtest %s is not saved' % backtest_req.bid)
+
+    @staticmethod
+    def extend_backtest(bid, fingerprint, end_ts=None, lease_owner=None):
+        """
+        Copies trades and state of the latest finished backtest with the same fingerprint, whose last candle is not
+        after end_ts, to the backtest as its checkpoint. Backtest is then resumed from it, i.e. only the candles after
+        the earlier backtest are processed. State which can not be loaded is deleted and backtest is run from the
+        start.
+        :return: (ts of the last processed candle, number of processed candles, pickled state) of the checkpoint, None
+        if there is no backtest to extend
+        """
+        stmt = "select s.backtest_id, s.ts, s.candles, s.state from backtest_state s " \
+               "join backtest_request r on r.id = s.backtest_id " \
+               "where s.fingerprint = ? and s.backtest_id != ? and r.status = ?"
+        params = [fingerprint, bid, Backtest.STATUS_FINISHED]
+        if end_ts:
+            stmt += " and s.ts <= ?"
+            params += [end_ts]
+        stmt += " order by s.ts desc limit 1"
+
+        num_tries = 0
+        while num_tries < 3:
+            try:
+                with sqlite3.connect(get_backtest_db()) as db:
+                    row = db.execute(stmt, params).fetchone()
+                    if not row:
+                        return None
+
+                    extended, ts, candles, state = row
+                    try:
+                        pickle.loads(state)
+                    except:
+                        logging.exception('Cannot load state of backtest %s, deleting it' % extended)
+                        db.execute("delete from backtest_state where backtest_id = ?", [extended])
+                        db.commit()
+                        return None
+
+                    # trades and checkpoint are saved in one transaction, as for the checkpoints of the backtest
+                    db.execute("insert into backtest_trades"
+                               "(ts, backtest_id, advice, sold_asset, sold_amount, bought_asset, bought_amount) "
+                               "select ts, ?, advice, sold_asset, sold_amount, bought_asset, bought_amount "
+                               "from backtest_trades where backtest_id = ? order by id", [bid, extended])
+                    if not SdexHistory._write_checkpoint(db, bid, (ts, candles, state), lease_owner):
+                        db.rollback()
+                        logging.error('Backtest %s is not leased by %s anymore' % (bid, lease_owner))
+                        return None
+                    db.commit()
+                logging.info('Extending backtest %s from %s candles of backtest %s' % (bid, candles, extended))
+                return ts, candles, state
+            except:
+                logging.exception('Error occurred while extending backtest %s' % bid)
+                num_tries += 1
+        return None
+
+    def _extend_backtest(self, backtest_req: Backtest):
+        lease_owner = self.lease.owner if self.lease else None
+        return SdexHistory.extend_backtest(backtest_req.bid, SdexHistory.state_fingerprint(backtest_req),
+                                           backtest_req.end_ts, lease_owner)
+
+    def _fork_pool(self, processes):
+        """
+        :return: pool of forked processes, which see the state of the worker (e.g. candles) without copying it.
+        Heartbeat of the lease is paused while the processes are forked, so that they do not inherit locks (e.g. of
+        logging or sqlite) held by the heartbeat thread, which would deadlock them.
+        """
+        if self.lease:
+            self.lease.pause()
+        try:
+            return multiprocessing.get_context('fork').Pool(processes)
+        finally:
+            if self.lease:
+                self.lease.resume()
+
+    def _report_progress(self, candles, total, ts):
+        if self.lease:
+            self.lease.progress = (candles, total, int(ts) if ts is not None else None)
+
+    def _save_error(self):
+        if self.lease and self.lease.lost:
+            return 'Lease of backtest is lost'
+        logging.fatal('Cannot update db after retries')
+        return 'Cannot update db after retries'
+
     def run(self, backtest_req: Backtest):
         bid, algoname, tradepair, start_ts, end_ts, candlesize, strategyname, parameters = \
             backtest_req.bid, backtest_req.algoname, backtest_req.tradepair, backtest_req.start_ts, \
@@ -214,134 +812,1414 @@ class SdexHistory(object):
 
         logging.debug('Starting backtest for bid = %s' % bid)
 
+        strategy_candlesize = candlesize
+        for size, resolution in SdexHistory.CANDLESIZE_RESOLUTIONS.items():
+            if candlesize == resolution:
+                strategy_candlesize = size
+
         try:
-            strategy = strategy_factory[strategyname](bid, parameters)
+            strategy = strategy_factory[strategyname](bid, parameters, None, strategy_candlesize)
         except Exception as e:
             logging.exception('Error occurred while instantiating strategy')
             return False, str(e)
 
-        page_size = 100
+        # candles of the additional candle sizes of strategy are combined from the candles of the backtest,
+        # hence only larger candle sizes can be used
+        timeframes = []
+        for size in strategy.get_candlesizes()[1:]:
+            sizes = Candle.VALID_CANDLE_SIZES
+            if strategy_candlesize in sizes and sizes.index(size) > sizes.index(strategy_candlesize):
+                timeframes += [size]
+            else:
+                logging.warning('Candle size %s is not larger than %s, bid = %s will not get its candles' %
+                                (size, candlesize, bid))
+
+        checkpoint = SdexHistory.load_checkpoint(bid)
+        if strategy.VECTORIZED and not timeframes:
+            if checkpoint and not delete_backtest_results(bid):
+                # trades saved before the checkpoint would be saved again
+                return False, 'Cannot delete results of earlier attempt'
+            return self.run_vectorized(backtest_req, strategy)
+
+        if not checkpoint:
+            # backtest of the same algo from the same start finished earlier is extended by the candles after it
+            checkpoint = self._extend_backtest(backtest_req)
+
+        resumed = None
+        if checkpoint:
+            try:
+                resumed = pickle.loads(checkpoint[2])
+                strategy_state, candle_per_size_per_key, last_advice, last_bought, equity = resumed
+                # state of the extended backtest belongs to another backtest
+                strategy_state.deployment_id = bid
+            except:
+                logging.exception('Cannot load checkpoint of backtest %s, starting over' % bid)
+                if not delete_backtest_results(bid):
+                    return False, 'Cannot delete results of earlier attempt'
+                checkpoint = resumed = None
+
+        if self.shards > 1 and not checkpoint:
+            result = self.run_sharded(backtest_req, strategy, strategy_candlesize, timeframes)
+            if result:
+                return result
+
+        asset_pairs = tradepair.split('_')
+        base_asset = get_asset(asset_pairs[0], asset_pairs[1])
+        counter_asset = get_asset(asset_pairs[2], asset_pairs[3])
+
+        if not checkpoint:
+            last_advice = None
+            last_bought = 0
+            candle_per_size_per_key = {}
+            # metrics of the candles processed so far, candles are not kept for them
+            equity = EquityMetrics()
+        # trades are saved in one transaction along with the checkpoint over the connection held for the backtest
+        trades = []
+        total = self.count_candles(tradepair, start_ts, end_ts, candlesize)
+        period_from, last_ts = start_ts, None
+        if checkpoint:
+            checkpoint_ts, candles, state = checkpoint
+            strategy = strategy_state
+            loaded = self.count_candles(tradepair, start_ts, checkpoint_ts, candlesize)
+            if loaded != candles:
+                logging.warning('Backtest %s processed %s candles before checkpoint, %s are in history now' %
+                                (bid, candles, loaded))
+            period_from, last_ts = checkpoint_ts + 1, checkpoint_ts
+            logging.info('Resuming backtest %s from candle %s of %s' % (bid, equity.num_candles, total))
+
+        # checkpoints are disabled if state of the strategy can not be saved
+        checkpoints = True
+        checkpoint_at = time.time() + CHECKPOINT_INTERVAL
+        db = sqlite3.connect(get_backtest_db())
+        try:
+            for chunk in self.iter_candle_chunks(tradepair, period_from, end_ts, candlesize):
+                if self.lease and self.lease.lost:
+                    return False, 'Lease of backtest is lost'
+
+                offset = equity.num_candles
+
+                logging.debug('Got %s candles to process' % len(chunk['ts']))
+                ts, c_open, c_high, c_low, c_close, c_base_volume, c_counter_volume = \
+                    [chunk[column].tolist() for column in
+                     ('ts', 'open', 'high', 'low', 'close', 'volume', 'counter_volume')]
+                for i in range(len(ts)):
+                    if i % PROGRESS_CANDLES == 0:
+                        if i:
+                            last_ts = ts[i - 1]
+                        self._report_progress(offset + i, total, last_ts)
+
+                        if last_ts is not None and time.time() >= checkpoint_at:
+                            measured = equity.num_candles - offset
+                            equity.update(chunk['ts'][measured:i], chunk['close'][measured:i])
+                            state = None
+                            if checkpoints:
+                                state = SdexHistory._pickle_state(bid, (strategy, candle_per_size_per_key,
+                                                                        last_advice, last_bought, equity))
+                                checkpoints = state is not None
+                            if not self._save_trades(bid, trades, db, (last_ts, offset + i, state)):
+                                return False, self._save_error()
+                            trades = []
+                            checkpoint_at = time.time() + CHECKPOINT_INTERVAL
+
+                    current_candle = Candle(tradepair)
+                    current_candle.c_open = c_open[i]
+                    current_candle.c_high = c_high[i]
+                    current_candle.c_low = c_low[i]
+                    current_candle.c_close = c_close[i]
+                    current_candle.c_base_volume = c_base_volume[i]
+                    current_candle.c_counter_volume = c_counter_volume[i]
+                    current_candle.c_date = datetime.datetime.utcfromtimestamp(ts[i])
+
+                    strategy._update_indicators(current_candle)
+
+                    try:
+                        for size in timeframes:
+                            released = aggregate_candle(candle_per_size_per_key, size, current_candle)
+                            if released:
+                                strategy._on_candle(released, None, size)
+
+                        logging.debug('Starting strategy execution for bid = %s' % bid)
+                        strategy.process_candle(current_candle)
+                        strategy.current_candle = current_candle
+                        advice = strategy._execute()
+                    except Exception as e:
+                        logging.exception('Strategy generated error')
+                        return False, e
+
+                    logging.debug('Done executing. generated advice = %s' % advice)
+                    if advice:
+                        if last_advice and last_advice == advice:
+                            logging.info(
+                                'Got sequential %s order from bid=%s. Ignoring recent advice.' % (last_advice, bid))
+                            continue
+                        if not last_advice and advice == TradeAdvice.SELL:
+                            logging.info('Sell order without first buy order from bid=%s. Ignoring advice' % bid)
+                            continue
+
+                        logging.debug('Collecting %s from strategy %s of backtest_request %s' %
+                                      (advice, strategyname, bid))
+
+                        if advice == TradeAdvice.BUY:
+                            sell_asset, buy_asset = base_asset, counter_asset
+                            total_sold = 1
+                            last_bought = total_bought = current_candle.c_close * total_sold
+                        elif advice == TradeAdvice.SELL:
+                            sell_asset, buy_asset = counter_asset, base_asset
+                            total_sold = last_bought
+                            total_bought = total_sold / current_candle.c_close
+                        else:
+                            logging.error('Algo generated incorrect advice %s' % advice)
+                            continue
+
+                        trades += [(advice, sell_asset, total_sold, buy_asset, total_bought)]
+                        equity.trade(offset + i, strategy.SIGNAL_BUY if advice == TradeAdvice.BUY
+                                     else strategy.SIGNAL_SELL)
+                        logging.debug('Trade executed for did=%s, sold_asset=%s, sold_amount=%s, '
+                                      'bought_asset=%s, bought_amount=%s'
+                                      % (bid, sell_asset, total_sold, buy_asset, total_bought))
+
+                        last_advice = advice
+
+                if ts:
+                    last_ts = ts[-1]
+                measured = equity.num_candles - offset
+                equity.update(chunk['ts'][measured:], chunk['close'][measured:])
+
+            # checkpoint is deleted along with the last trades, backtest restarted after it is started over
+            if not self._save_trades(bid, trades, db, (None, None, None)):
+                return False, self._save_error()
+            self._report_progress(equity.num_candles, total, last_ts)
+
+            if not self._save_metrics(backtest_req, equity, db):
+                return False, self._save_error()
+
+            if checkpoints and last_ts is not None:
+                state = SdexHistory._pickle_state(bid, (strategy, candle_per_size_per_key, last_advice, last_bought,
+                                                        equity))
+                if state is not None:
+                    self._save_state(backtest_req, (last_ts, equity.num_candles, state), db)
+        finally:
+            db.close()
+        return True, None
+
+    @staticmethod
+    def _pickle_state(bid, state):
+        """
+        :return: pickled state of the backtest for its checkpoint, None if it can not be pickled
+        """
+        try:
+            return pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+        except:
+            logging.exception('Cannot checkpoint backtest %s, it is started over if restarted' % bid)
+            return None
 
-        last_advice = None
-        last_bought = 0
-        count, candle = self.get_candles(tradepair, start_ts, end_ts, candlesize, page_size)
-        logging.debug('Got %s candles to process' % count)
-        while True:
-            i = 0
-            while i < count:
-                current_candle = Candle(tradepair)
-                current_candle.c_open = candle.open[i]
-                current_candle.c_high = candle.high[i]
-                current_candle.c_low = candle.low[i]
-                current_candle.c_close = candle.close[i]
-                current_candle.c_base_volume = candle.volume[i]
-                current_candle.c_counter_volume = candle.counter_volume[i]
-                current_candle.c_date = candle.time[i]
-
-                strategy.ohlcv['open'] += [candle.open[i]]
-                strategy.ohlcv['high'] += [candle.high[i]]
-                strategy.ohlcv['low'] += [candle.low[i]]
-                strategy.ohlcv['close'] += [candle.close[i]]
-                strategy.ohlcv['volume'] += [candle.volume[i]]
-
-                result = {}
-                for k, v in strategy.indicator_values.items():
-                    # compute indicator
-                    ohlcv = {}
-                    ohlcv['open'] = np.array(strategy.ohlcv['open'])
-                    ohlcv['high'] = np.array(strategy.ohlcv['high'])
-                    ohlcv['low'] = np.array(strategy.ohlcv['low'])
-                    ohlcv['close'] = np.array(strategy.ohlcv['close'])
-                    ohlcv['volume'] = np.array(strategy.ohlcv['volume'])
-
-                    indicator = strategy.indicators[strategy.indicator_type[k]]
-                    result[k] = indicator(ohlcv, strategy.indicator_params[k])
-
-                for k, vals in result.items():
-                    for param_name, param_val in vals.items():
-                        # get the last value of the indicator
-                        lastval = param_val[len(param_val) - 1]
-                        strategy.indicator_values[k][param_name] = None if lastval == np.nan else lastval
+    @staticmethod
+    def check_signal(signal, ohlcv):
+        """
+        :return: error if signal of execute_vectorized is not valid, None otherwise
+        """
+        if signal.shape != ohlcv['close'].shape:
+            return 'Algo generated %s advices for %s candles' % (len(signal), len(ohlcv['close']))
+        if not np.isin(signal, (BaseTradingStrategy.SIGNAL_NONE, BaseTradingStrategy.SIGNAL_BUY,
+                                BaseTradingStrategy.SIGNAL_SELL)).all():
+            return 'Algo generated incorrect advice'
+        return None
 
-                try:
-                    logging.debug('Starting strategy execution for bid = %s' % bid)
-                    strategy.process_candle(current_candle)
-                    strategy.current_candle = candle
-                    strategy.execute(strategy.indicator_values)
-                except Exception as e:
-                    logging.exception('Strategy generated error')
-                    return False, e
-
-                advice = strategy.current_advice
-                logging.debug('Done executing. generated advice = %s' % advice)
-                if advice:
-                    if last_advice and last_advice == advice:
-                        logging.info(
-                            'Got sequential %s order from bid=%s. Ignoring recent advice.' % (last_advice, bid))
-                        continue
-                    if not last_advice and advice == TradeAdvice.SELL:
-                        logging.info('Sell order without first buy order from bid=%s. Ignoring advice' % bid)
-                        continue;
-
-                    logging.debug('Saving %s from strategy %s of backtest_request %s' %
-                                  (strategy.current_advice, strategyname, bid))
-
-                    asset_pairs = tradepair.split('_')
-                    base_asset = get_asset(asset_pairs[0], asset_pairs[1])
-                    counter_asset = get_asset(asset_pairs[2], asset_pairs[3])
-
-                    if advice == TradeAdvice.BUY:
-                        sell_asset, buy_asset = base_asset, counter_asset
-                        total_sold = 1
-                        last_bought = total_bought = current_candle.c_close * total_sold
-                    elif advice == TradeAdvice.SELL:
-                        sell_asset, buy_asset = counter_asset, base_asset
-                        total_sold = last_bought
-                        total_bought = total_sold / current_candle.c_close
-                    else:
-                        logging.error('Algo generated incorrect advice %s' % advice)
-                        continue
-
-                    ts = (datetime.datetime.utcnow() - EPOCH).total_seconds()
-                    num_tries = 0
-                    while num_tries < 3:
-                        try:
-                            with sqlite3.connect(get_backtest_db()) as db:
-                                db.execute("insert into backtest_trades"
-                                           "(ts, backtest_id, advice, sold_asset, sold_amount, bought_asset, bought_amount)"
-                                           " values (?, ?, ?, ?, ?, ?, ?)",
-                                           [ts, bid, strategy.current_advice,
-                                            format_asset(sell_asset), float(total_sold),
-                                            format_asset(buy_asset), float(total_bought)])
-                                db.commit()
-                            break
-                        except:
-                            num_tries += 1
-                    else:
-                        logging.fatal('Cannot update db after retries')
-                        return False, 'Cannot update db after retries'
+    @staticmethod
+    def signal_to_advices(signal):
+        """
+        :return: (index of the candles where trades are made, advices), advices alternate starting with buy
+        """
+        trade_index = np.flatnonzero(signal)
+        advices = signal[trade_index]
 
-                    logging.debug('Trade executed for did=%s, sold_asset=%s, sold_amount=%s, '
-                                  'bought_asset=%s, bought_amount=%s'
-                                  % (bid, sell_asset, total_sold, buy_asset, total_bought))
+        # ignore sequential advices of same type and sell advice without first buy
+        changed = np.ones(len(advices), dtype=bool)
+        changed[1:] = advices[1:] != advices[:-1]
+        trade_index, advices = trade_index[changed], advices[changed]
+        if len(advices) and advices[0] == BaseTradingStrategy.SIGNAL_SELL:
+            trade_index, advices = trade_index[1:], advices[1:]
+        return trade_index, advices
 
-                    last_advice = advice
+    @staticmethod
+    def trade_amounts(close, trade_index, advices):
+        """
+        :return: (sold amounts, bought amounts) of the trades, every buy sells 1 unit of base asset
+        """
+        # advices alternate starting with buy, hence every sell sells what is bought by the previous advice
+        price = close[trade_index]
+        sells = np.flatnonzero(advices == BaseTradingStrategy.SIGNAL_SELL)
+        total_sold = np.ones(len(advices))
+        total_bought = price.copy()
+        total_sold[sells] = price[sells - 1]
+        total_bought[sells] = total_sold[sells] / price[sells]
+        return total_sold, total_bought
+
+    def run_vectorized(self, backtest_req: Backtest, strategy):
+        """
+        Runs backtest of the strategy which implements execute_vectorized over all the candles at once.
+        """
+        bid, tradepair, start_ts, end_ts, candlesize = \
+            backtest_req.bid, backtest_req.tradepair, backtest_req.start_ts, backtest_req.end_ts, \
+            backtest_req.candlesize
 
-                i += 1
+        ohlcv = self.get_all_candles(tradepair, start_ts, end_ts, candlesize)
+        logging.debug('Got %s candles to process' % len(ohlcv['ts']))
+        self._report_progress(0, len(ohlcv['ts']), None)
 
-            if count < page_size:
-                break
+        try:
+            scope = None
+            if self.indicator_cache is not None:
+                scope = (tradepair, candlesize, start_ts, end_ts, IndicatorCache.digest_candles(ohlcv))
+            indicators = strategy._compute_indicators(ohlcv, self.indicator_cache, scope)
+            if self.indicator_cache is not None:
+                logging.info('Indicator cache for bid = %s: %s' % (bid, self.indicator_cache.stats()))
+
+            logging.debug('Starting vectorized strategy execution for bid = %s' % bid)
+            signal = strategy.execute_vectorized(ohlcv, indicators)
+        except Exception as e:
+            logging.exception('Strategy generated error')
+            return False, e
+
+        signal = np.asarray(signal)
+        err = SdexHistory.check_signal(signal, ohlcv)
+        if err:
+            return False, err
+
+        return self._save_signal(backtest_req, ohlcv, signal)
+
+    def _save_signal(self, backtest_req: Backtest, ohlcv, signal):
+        """
+        Saves trades and metrics of the backtest generating given signal over the candles.
+        """
+        bid, tradepair, strategyname = backtest_req.bid, backtest_req.tradepair, backtest_req.strategyname
+
+        trade_index, advices = SdexHistory.signal_to_advices(signal)
+        total_sold, total_bought = SdexHistory.trade_amounts(ohlcv['close'], trade_index, advices)
+
+        asset_pairs = tradepair.split('_')
+        base_asset = get_asset(asset_pairs[0], asset_pairs[1])
+        counter_asset = get_asset(asset_pairs[2], asset_pairs[3])
+
+        trades = []
+        for advice, sold, bought in zip(advices, total_sold, total_bought):
+            if advice == BaseTradingStrategy.SIGNAL_BUY:
+                trades += [(TradeAdvice.BUY, base_asset, sold, counter_asset, bought)]
+            else:
+                trades += [(TradeAdvice.SELL, counter_asset, sold, base_asset, bought)]
+
+        logging.debug('Saving %s trades from strategy %s of backtest_request %s' % (len(trades), strategyname, bid))
+        if trades and not self._save_trades(bid, trades):
+            return False, self._save_error()
+        equity = EquityMetrics()
+        equity.update(ohlcv['ts'], ohlcv['close'], trade_index, advices)
+        if not self._save_metrics(backtest_req, equity):
+            return False, self._save_error()
+        if len(ohlcv['ts']):
+            self._report_progress(len(ohlcv['ts']), len(ohlcv['ts']), ohlcv['ts'][-1])
+
+        return True, None
+
+    def simulate_signal(self, strategy, ohlcv, tradepair, timeframes):
+        """
+        Runs strategy candle by candle over the candles in memory.
+        :return: signal of the strategy (see BaseTradingStrategy.execute_vectorized)
+        """
+        signal = np.zeros(len(ohlcv['close']), dtype=int)
+        candle_per_size_per_key = {}
+        ts, c_open, c_high, c_low, c_close, c_base_volume, c_counter_volume = \
+            [ohlcv[column].tolist() for column in ('ts', 'open', 'high', 'low', 'close', 'volume', 'counter_volume')]
+        for i in range(len(signal)):
+            current_candle = Candle(tradepair)
+            current_candle.c_open = c_open[i]
+            current_candle.c_high = c_high[i]
+            current_candle.c_low = c_low[i]
+            current_candle.c_close = c_close[i]
+            current_candle.c_base_volume = c_base_volume[i]
+            current_candle.c_counter_volume = c_counter_volume[i]
+            current_candle.c_date = datetime.datetime.utcfromtimestamp(ts[i])
+
+            strategy._update_indicators(current_candle)
+            for size in timeframes:
+                released = aggregate_candle(candle_per_size_per_key, size, current_candle)
+                if released:
+                    strategy._on_candle(released, None, size)
+
+            strategy.process_candle(current_candle)
+            strategy.current_candle = current_candle
+            advice = strategy._execute()
+            if advice == TradeAdvice.BUY:
+                signal[i] = strategy.SIGNAL_BUY
+            elif advice == TradeAdvice.SELL:
+                signal[i] = strategy.SIGNAL_SELL
+        return signal
+
+    def run_sharded(self, backtest_req: Backtest, strategy, strategy_candlesize, timeframes):
+        """
+        Runs the strategy over consecutive parts (shards) of the period in parallel processes and saves trades and
+        metrics of the merged signal. Each shard starts early enough to warm up the indicators and continues over the
+        warmup of the next shard after its end, shards are merged only if the continuation of the previous shard
+        generates the same advices as the next shard there. This is a heuristic, not a comparison with the sequential
+        run: the next shard may still diverge after the continuation, e.g. if advices depend on state older than the
+        warmup. Position is tracked over the merged signal, hence it is carried across the shards. State of the
+        strategy is not saved at the end of sharded backtest (see save_state), hence later backtests are never
+        extended from it.
+        strategy: strategy of the backtest, used for the warmup size of its indicators
+        :return: (result, error) like run, None if backtest is too short to split or shards do not agree, in which
+        case it should be run sequentially
+        """
+        bid, tradepair, start_ts, end_ts, candlesize = \
+            backtest_req.bid, backtest_req.tradepair, backtest_req.start_ts, backtest_req.end_ts, \
+            backtest_req.candlesize
+
+        ohlcv = self.get_all_candles(tradepair, start_ts, end_ts, candlesize)
+        n = len(ohlcv['close'])
+        shards = min(self.shards, n // MIN_SHARD_CANDLES)
+        if shards < 2:
+            return None
+        for values in ohlcv.values():
+            values.flags.writeable = False
+        self._report_progress(0, n, None)
+
+        # candles of larger sizes are combined from the candles of the backtest, hence their warmup takes longer
+        seconds = dict((size, RESOLUTION_SECONDS.get(resolution, 60))
+                       for size, resolution in SdexHistory.CANDLESIZE_RESOLUTIONS.items())
+        warmup = strategy.get_warmup_size(strategy_candlesize)
+        for size in timeframes:
+            ratio = seconds[size] // seconds.get(strategy_candlesize, 60)
+            warmup = max(warmup, (strategy.get_warmup_size(size) + 1) * ratio)
+        warmup = max(warmup * SHARD_WARMUP_FACTOR, MIN_SHARD_WARMUP)
+
+        bounds = [n * k // shards for k in range(shards + 1)]
+        ranges = [(max(bounds[k] - warmup, 0), min(bounds[k + 1] + warmup, n)) for k in range(shards)]
+        logging.info('Running bid = %s in %s shards of %s candles with warmup of %s candles' %
+                     (bid, shards, n // shards, warmup))
+
+        global _shards
+        _shards = {
+            'history': self,
+            'backtest': backtest_req,
+            'ohlcv': ohlcv,
+            'candlesize': strategy_candlesize,
+            'timeframes': timeframes,
+        }
+        try:
+            # forked processes see the candles of the parent without copying them
+            with self._fork_pool(shards) as pool:
+                signals = pool.map(_run_shard, ranges)
+        except Exception as e:
+            logging.exception('Strategy generated error')
+            return False, e
+        finally:
+            _shards = None
+
+        if self.lease and self.lease.lost:
+            return False, 'Lease of backtest is lost'
+
+        signal = np.zeros(n, dtype=int)
+        for k, ((start, end), shard_signal) in enumerate(zip(ranges, signals)):
+            signal[bounds[k]:bounds[k + 1]] = shard_signal[bounds[k] - start:bounds[k + 1] - start]
+            if k + 1 < shards:
+                # advices of the continuation of this shard and of the next shard over the same candles
+                next_start = ranges[k + 1][0]
+                overlap = shard_signal[bounds[k + 1] - start:end - start]
+                next_overlap = signals[k + 1][bounds[k + 1] - next_start:end - next_start]
+                if not np.array_equal(overlap, next_overlap):
+                    logging.warning('Shards %s and %s of bid = %s generate different advices after %s candles of '
+                                    'warmup, running it sequentially' % (k, k + 1, bid, warmup))
+                    return None
+
+        return self._save_signal(backtest_req, ohlcv, signal)
+
+    def run_sweep(self, backtest_req: Backtest, processes=None):
+        """
+        Runs backtest of every parameters of the sweep over the same candles and saves the results ranked by pnl.
+        Candles are loaded once and shared read-only with the processes running the parameters.
+        """
+        bid, tradepair, start_ts, end_ts, candlesize, strategyname = \
+            backtest_req.bid, backtest_req.tradepair, backtest_req.start_ts, backtest_req.end_ts, \
+            backtest_req.candlesize, backtest_req.strategyname
+
+        try:
+            combinations = expand_grid(backtest_req.parameters, backtest_req.grid)
+        except Exception as e:
+            return False, 'Incorrect sweep grid: %s' % e
+        if strategyname not in strategy_factory:
+            return False, 'Unknown strategy %s' % strategyname
+
+        ohlcv = self.get_all_candles(tradepair, start_ts, end_ts, candlesize)
+        for values in ohlcv.values():
+            values.flags.writeable = False
+        logging.info('Running sweep of %s parameters over %s candles for bid = %s' %
+                     (len(combinations), len(ohlcv['close']), bid))
+
+        global _sweep
+        _sweep = {
+            'history': self,
+            'backtest': backtest_req,
+            'ohlcv': ohlcv,
+            # indicators are cached per process, key is computed for these candles only once
+            'scope': (tradepair, candlesize, start_ts, end_ts, IndicatorCache.digest_candles(ohlcv)),
+        }
+
+        # parameters sharing indicators are next to each other, hence computed by the same process
+        order = sorted(range(len(combinations)), key=lambda k: json.dumps(combinations[k], sort_keys=True))
+        processes = min(processes or multiprocessing.cpu_count(), len(combinations))
+        chunksize = max(1, -(-len(combinations) // max(processes, 1)))
+        chunks = [[(k, combinations[k]) for k in order[j:j + chunksize]]
+                  for j in range(0, len(combinations), chunksize)]
+
+        try:
+            if processes > 1:
+                # forked processes see the candles of the parent without copying them
+                with self._fork_pool(processes) as pool:
+                    results = pool.map(_run_sweep_chunk, chunks)
+            else:
+                results = [_run_sweep_chunk(chunk) for chunk in chunks]
+        finally:
+            _sweep = None
+
+        results = [result for chunk in results for result in chunk]
+        if not results:
+            return False, 'No parameters of the sweep could be backtested'
+
+        # best pnl first, smaller drawdown breaks the ties
+        results.sort(key=lambda result: (-result[1], result[3], result[0]))
+        rows = [(rank + 1, json.dumps(combinations[k]), pnl, num_trades, max_drawdown)
+                for rank, (k, pnl, num_trades, max_drawdown) in enumerate(results)]
+
+        lease_owner = self.lease.owner if self.lease else None
+        if not SdexHistory.save_sweep_results(bid, rows, lease_owner):
+            return False, self._save_error()
+
+        logging.info('Sweep of bid = %s is done, %s of %s parameters backtested' %
+                     (bid, len(results), len(combinations)))
+        return True, None
+
+    def _run_sweep_parameters(self, backtest_req: Backtest, parameters, ohlcv, indicator_cache, scope):
+        """
+        :return: (pnl, number of trades, max drawdown) of the backtest of given parameters
+        """
+        signal = self._signal(backtest_req, parameters, ohlcv, backtest_req.tradepair, indicator_cache, scope)
+        trade_index, advices = SdexHistory.signal_to_advices(signal)
+        return sweep_metrics(ohlcv['close'], trade_index, advices)
+
+    def _signal(self, backtest_req: Backtest, parameters, ohlcv, tradepair, indicator_cache, scope):
+        """
+        :return: signal of the strategy of the backtest with given parameters over the candles of the trade pair
+        """
+        strategy_candlesize = backtest_req.candlesize
+        for size, resolution in SdexHistory.CANDLESIZE_RESOLUTIONS.items():
+            if backtest_req.candlesize == resolution:
+                strategy_candlesize = size
+
+        strategy = strategy_factory[backtest_req.strategyname](backtest_req.bid, parameters, None, strategy_candlesize)
+
+        timeframes = []
+        for size in strategy.get_candlesizes()[1:]:
+            sizes = Candle.VALID_CANDLE_SIZES
+            if strategy_candlesize in sizes and sizes.index(size) > sizes.index(strategy_candlesize):
+                timeframes += [size]
+
+        if strategy.VECTORIZED and not timeframes:
+            indicators = strategy._compute_indicators(ohlcv, indicator_cache, scope)
+            signal = np.asarray(strategy.execute_vectorized(ohlcv, indicators))
+            err = SdexHistory.check_signal(signal, ohlcv)
+            if err:
+                raise Exception(err)
+        else:
+            signal = self.simulate_signal(strategy, ohlcv, tradepair, timeframes)
+        return signal
+
+    @staticmethod
+    def save_sweep_results(bid, rows, lease_owner=None):
+        """
+        rows: list of (rank, parameters, pnl, num_trades, max_drawdown)
+        lease_owner: if given, results are saved only if backtest is still leased by this owner
+        returns: True if results are saved, False otherwise
+        """
+        stmt = "insert into backtest_sweep_results" \
+               "(backtest_id, rank, parameters, pnl, num_trades, max_drawdown)"
+        if lease_owner:
+            stmt += " select ?, ?, ?, ?, ?, ? where exists " \
+                    "(select 1 from backtest_request where id = ? and lease_owner = ?)"
+            rows = [[bid] + list(row) + [bid, lease_owner] for row in rows]
+        else:
+            stmt += " values (?, ?, ?, ?, ?, ?)"
+            rows = [[bid] + list(row) for row in rows]
+
+        num_tries = 0
+        while num_tries < 3:
+            try:
+                with sqlite3.connect(get_backtest_db()) as db:
+                    cursor = db.executemany(stmt, rows)
+                    if cursor.rowcount < len(rows):
+                        db.rollback()
+                        logging.error('Backtest %s is not leased by %s anymore, sweep results are not saved' %
+                                      (bid, lease_owner))
+                        return False
+                    db.commit()
+                return True
+            except:
+                num_tries += 1
+
+        return False
+
+    def run_portfolio(self, backtest_req: Backtest, processes=None):
+        """
+        Runs the strategy over every trade pair of the portfolio and trades the pairs from the shared capital. Candles
+        of all the pairs are loaded at once and shared read-only with the processes running the pairs. Strategies of the
+        pairs are independent of each other, hence their signals are computed in parallel and advices of all the pairs
+        are then executed in the order of ts (see execute_portfolio).
+        """
+        bid, pairs, start_ts, end_ts, candlesize, strategyname = \
+            backtest_req.bid, backtest_req.pairs, backtest_req.start_ts, backtest_req.end_ts, \
+            backtest_req.candlesize, backtest_req.strategyname
+
+        if strategyname not in strategy_factory:
+            return False, 'Unknown strategy %s' % strategyname
+        if not pairs:
+            return False, 'Portfolio has no trade pairs'
+
+        candles = self.get_pairs_candles(pairs, start_ts, end_ts, candlesize)
+        for ohlcv in candles.values():
+            for values in ohlcv.values():
+                values.flags.writeable = False
+        total = sum([len(ohlcv['close']) for ohlcv in candles.values()])
+        logging.info('Running portfolio of %s pairs over %s candles for bid = %s' % (len(pairs), total, bid))
+        self._report_progress(0, total, None)
+
+        global _portfolio
+        _portfolio = {
+            'history': self,
+            'backtest': backtest_req,
+            'candles': candles,
+        }
+
+        signals = {}
+        processes = min(processes or multiprocessing.cpu_count(), len(pairs))
+        try:
+            if processes > 1:
+                # forked processes see the candles of the parent without copying them
+                with self._fork_pool(processes) as pool:
+                    for pair, signal in pool.imap_unordered(_run_portfolio_pair, pairs):
+                        signals[pair] = signal
+                        self._report_progress(sum([len(candles[p]['close']) for p in signals]), total, None)
             else:
-                count, candle = self.get_candles(tradepair, start_ts, end_ts, candlesize, page_size, candle.page_token)
+                for pair in pairs:
+                    signals[pair] = _run_portfolio_pair(pair)[1]
+                    self._report_progress(sum([len(candles[p]['close']) for p in signals]), total, None)
+        except Exception as e:
+            logging.exception('Strategy generated error')
+            return False, e
+        finally:
+            _portfolio = None
+
+        if self.lease and self.lease.lost:
+            return False, 'Lease of backtest is lost'
+
+        capital = backtest_req.capital or len(pairs)
+        trades, trade_index, advices, sold, skipped = \
+            SdexHistory.execute_portfolio([candles[pair] for pair in pairs], [signals[pair] for pair in pairs], capital)
+        if skipped:
+            logging.info('%s buy advices of bid = %s are skipped, all capital is invested' % (skipped, bid))
+
+        assets = []
+        for pair in pairs:
+            asset_pairs = pair.split('_')
+            assets += [(get_asset(asset_pairs[0], asset_pairs[1]), get_asset(asset_pairs[2], asset_pairs[3]))]
+        rows = []
+        for k, advice, total_sold, total_bought in trades:
+            base_asset, counter_asset = assets[k]
+            if advice == BaseTradingStrategy.SIGNAL_BUY:
+                rows += [(TradeAdvice.BUY, base_asset, total_sold, counter_asset, total_bought)]
+            else:
+                rows += [(TradeAdvice.SELL, counter_asset, total_sold, base_asset, total_bought)]
+        if rows and not self._save_trades(bid, rows):
+            return False, self._save_error()
+
+        resolution = SdexHistory.CANDLESIZE_RESOLUTIONS.get(candlesize, candlesize)
+        metrics, pair_metrics = portfolio_metrics([candles[pair] for pair in pairs], trade_index, advices, sold,
+                                                  capital, resolution)
+        logging.info('Metrics of bid = %s: return = %s, max drawdown = %s, sharpe = %s, trades = %s' %
+                     (bid, metrics['total_return'], metrics['max_drawdown'], metrics['sharpe'], metrics['num_trades']))
+        lease_owner = self.lease.owner if self.lease else None
+        if not SdexHistory.save_pair_metrics(bid, list(zip(pairs, pair_metrics)), lease_owner) or \
+                not SdexHistory.save_metrics(bid, metrics, lease_owner):
+            return False, self._save_error()
+
+        last_ts = max([int(ohlcv['ts'][-1]) for ohlcv in candles.values() if len(ohlcv['ts'])] or [None])
+        self._report_progress(total, total, last_ts)
         return True, None
 
+    @staticmethod
+    def execute_portfolio(candles, signals, capital):
+        """
+        Executes advices of all the pairs in the order of ts (pairs in the given order at the same ts). Buy of the pair
+        without open trade sells 1 unit of base asset from the capital, or the rest of the capital if there is less of
+        it, and is skipped if all the capital is invested. Sell buys base asset back to the capital with what the
+        previous buy of the pair bought.
+        candles: list of dicts with ts and close of the candles of every pair
+        signals: list of signals of every pair
+        :return: (list of (index of the pair, advice, sold amount, bought amount) of the trades in the order of
+        execution, list of index of the candles of the trades of every pair, list of advices of every pair, list of
+        amounts sold by the trades of every pair, number of buy advices skipped as capital is invested)
+        """
+        ts, pair_index, candle_index = [], [], []
+        for k, (ohlcv, signal) in enumerate(zip(candles, signals)):
+            index = np.flatnonzero(signal)
+            ts += [ohlcv['ts'][index]]
+            pair_index += [np.full(len(index), k)]
+            candle_index += [index]
+        ts = np.concatenate(ts) if ts else np.zeros(0, dtype=np.int64)
+        pair_index = np.concatenate(pair_index) if pair_index else np.zeros(0, dtype=int)
+        candle_index = np.concatenate(candle_index) if candle_index else np.zeros(0, dtype=int)
+
+        balance = float(capital)
+        # amount of counter asset bought by the open trade of every pair
+        bought = [None] * len(candles)
+        trades, skipped = [], 0
+        trade_index = [[] for i in range(len(candles))]
+        advices = [[] for i in range(len(candles))]
+        sold = [[] for i in range(len(candles))]
+        for e in np.lexsort((pair_index, ts)).tolist():
+            k, i = int(pair_index[e]), int(candle_index[e])
+            advice = int(signals[k][i])
+            price = float(candles[k]['close'][i])
+            if advice == BaseTradingStrategy.SIGNAL_BUY:
+                if bought[k] is not None:
+                    continue
+                if balance <= 0:
+                    skipped += 1
+                    continue
+                stake = min(1.0, balance)
+                balance -= stake
+                bought[k] = stake * price
+                trades += [(k, advice, stake, bought[k])]
+                sold[k] += [stake]
+            elif advice == BaseTradingStrategy.SIGNAL_SELL:
+                if bought[k] is None:
+                    continue
+                balance += bought[k] / price
+                trades += [(k, advice, bought[k], bought[k] / price)]
+                sold[k] += [bought[k]]
+                bought[k] = None
+            else:
+                continue
+            trade_index[k] += [i]
+            advices[k] += [advice]
+
+        trade_index = [np.array(index, dtype=int) for index in trade_index]
+        advices = [np.array(pair_advices, dtype=int) for pair_advices in advices]
+        return trades, trade_index, advices, sold, skipped
+
+    @staticmethod
+    def save_pair_metrics(bid, rows, lease_owner=None):
+        """
+        rows: list of (trade pair, dict returned by backtest_metrics) of the pairs of portfolio backtest
+        lease_owner: if given, metrics are saved only if backtest is still leased by this owner
+        returns: True if metrics are saved, False otherwise
+        """
+        stmt = "insert or replace into backtest_pair_metrics(backtest_id, trade_pair, %s)" % ', '.join(METRICS_COLUMNS)
+        params = ', '.join(['?'] * (len(METRICS_COLUMNS) + 2))
+        if lease_owner:
+            stmt += " select %s where exists (select 1 from backtest_request where id = ? and lease_owner = ?)" % params
+            rows = [[bid, pair] + [metrics[column] for column in METRICS_COLUMNS] + [bid, lease_owner]
+                    for pair, metrics in rows]
+        else:
+            stmt += " values (%s)" % params
+            rows = [[bid, pair] + [metrics[column] for column in METRICS_COLUMNS] for pair, metrics in rows]
+
+        num_tries = 0
+        while num_tries < 3:
+            try:
+                with sqlite3.connect(get_backtest_db()) as db:
+                    cursor = db.executemany(stmt, rows)
+                    if cursor.rowcount < len(rows):
+                        db.rollback()
+                        logging.error('Backtest %s is not leased by %s anymore, metrics are not saved' %
+                                      (bid, lease_owner))
+                        return False
+                    db.commit()
+                return True
+            except:
+                num_tries += 1
+
+        return False
+
+    @staticmethod
+    def save_metrics(bid, metrics, lease_owner=None, db=None):
+        """
+        metrics: dict returned by backtest_metrics
+        lease_owner: if given, metrics are saved only if backtest is still leased by this owner
+        db: connection to backtest db to use, new connection is opened if not given
+        returns: True if metrics are saved, False otherwise
+        """
+        row = [bid] + [metrics[column] for column in METRICS_COLUMNS]
+        stmt = "insert or replace into backtest_metrics(backtest_id, %s)" % ', '.join(METRICS_COLUMNS)
+        if lease_owner:
+            stmt += " select %s where exists (select 1 from backtest_request where id = ? and lease_owner = ?)" % \
+                    ', '.join(['?'] * len(row))
+            row += [bid, lease_owner]
+        else:
+            stmt += " values (%s)" % ', '.join(['?'] * len(row))
+
+        def insert(conn):
+            cursor = conn.execute(stmt, row)
+            if cursor.rowcount < 1:
+                conn.rollback()
+                logging.error('Backtest %s is not leased by %s anymore, metrics are not saved' % (bid, lease_owner))
+                return False
+            conn.commit()
+            return True
+
+        num_tries = 0
+        while num_tries < 3:
+            try:
+                if db:
+                    return insert(db)
+                with sqlite3.connect(get_backtest_db()) as conn:
+                    return insert(conn)
+            except:
+                if db:
+                    db.rollback()
+                num_tries += 1
+
+        return False
+
+    def _save_metrics(self, backtest_req: Backtest, equity, db=None):
+        resolution = SdexHistory.CANDLESIZE_RESOLUTIONS.get(backtest_req.candlesize, backtest_req.candlesize)
+        metrics = equity.metrics(resolution)
+        logging.info('Metrics of bid = %s: return = %s, max drawdown = %s, sharpe = %s, trades = %s' %
+                     (backtest_req.bid, metrics['total_return'], metrics['max_drawdown'], metrics['sharpe'],
+                      metrics['num_trades']))
+        lease_owner = self.lease.owner if self.lease else None
+        return SdexHistory.save_metrics(backtest_req.bid, metrics, lease_owner, db)
+
+
+# columns of backtest_metrics besides backtest_id, in the order of the values saved
+METRICS_COLUMNS = ('num_candles', 'num_trades', 'total_return', 'max_drawdown', 'sharpe', 'sortino', 'win_rate',
+                   'exposure', 'equity_curve')
+
+# state of the sweep being run, set before forking the processes of the sweep so that they share it
+_sweep = None
+
+# state of the sharded backtest being run, set before forking the processes running the shards
+_shards = None
+
+# state of the portfolio backtest being run, set before forking the processes running the pairs
+_portfolio = None
+
+# set once the worker is stopped, SystemExit raised by the signal handler may be caught by retries of db operations
+_stop_requested = False
+
+# backtest is split into shards of at least MIN_SHARD_CANDLES candles, each shard runs the strategy over at least
+# MIN_SHARD_WARMUP candles (SHARD_WARMUP_FACTOR times the warmup size of its indicators) before the shard, so that
+# indicators and state of the strategy converge to the ones of the sequential run
+MIN_SHARD_CANDLES = 10000
+MIN_SHARD_WARMUP = 1000
+SHARD_WARMUP_FACTOR = 10
+
+# modules besides the module of the strategy whose code determines results of backtests (see strategy_version)
+RESULT_MODULES = ('stardust.backtester', 'stardust.strategy', 'stardust.indicators', 'stardust.batched',
+                  'stardust.streaming', 'stardust.ohlcv', 'stardust.data', 'stardust.cache')
+_strategy_versions = {}
+
+# tables with results of backtests by backtest_id
+RESULT_TABLES = ('backtest_trades', 'backtest_sweep_results', 'backtest_metrics', 'backtest_pair_metrics',
+                 'backtest_checkpoint', 'backtest_state')
+# results of the deleted backtests are evicted by idle workers every EVICT_INTERVAL seconds
+EVICT_INTERVAL = 60 * 60
+# saved states and checkpoints which are not results of any backtest are kept for RESULTS_MAX_AGE seconds by default
+RESULTS_MAX_AGE = 30 * 24 * 60 * 60
+
+
+def equity_curve(close, trade_index, advices):
+    """
+    Every buy sells 1 unit of base asset and the following sell buys it back, equity is in units of the base asset
+    starting with 1.
+    :return: (equity at every candle including the open trade, realized return of every sell, whether position is
+    open at every candle)
+    """
+    n = len(close)
+    is_buy = np.zeros(n, dtype=bool)
+    is_buy[trade_index[advices == BaseTradingStrategy.SIGNAL_BUY]] = True
+    sells = trade_index[advices == BaseTradingStrategy.SIGNAL_SELL]
+
+    # price of the last buy and whether it is open at every candle
+    last_buy = np.maximum.accumulate(np.where(is_buy, np.arange(n), 0))
+    position = np.zeros(n, dtype=int)
+    position[is_buy] = 1
+    position[sells] = -1
+    holding = np.cumsum(position) > 0
+
+    realized = np.zeros(n)
+    realized[sells] = close[last_buy[sells]] / close[sells] - 1
+    unrealized = np.where(holding, close[last_buy] / close - 1, 0.0)
+    equity = 1 + np.cumsum(realized) + unrealized
+    return equity, realized[sells], holding
+
+
+def max_drawdown(equity):
+    """
+    :return: max drawdown as fraction of peak equity
+    """
+    peak = np.maximum.accumulate(equity)
+    return float(np.max((peak - equity) / peak))
+
+
+def sweep_metrics(close, trade_index, advices):
+    """
+    :return: (pnl including the open trade at last close, number of trades, max drawdown as fraction of peak equity)
+    """
+    if len(close) == 0:
+        return 0.0, 0, 0.0
+
+    equity, realized, holding = equity_curve(close, trade_index, advices)
+    return float(equity[-1] - 1), int(len(advices)), max_drawdown(equity)
+
+
+def backtest_metrics(ts, close, trade_index, advices, resolution):
+    """
+    :return: dict of the metrics stored in backtest_metrics (see equity_metrics)
+    """
+    equity = EquityMetrics()
+    equity.update(ts, close, trade_index, advices)
+    return equity.metrics(resolution)
+
+
+def portfolio_metrics(candles, trade_index, advices, stakes, capital, resolution):
+    """
+    Equity of the portfolio is the capital which is not invested plus value of the open trades in units of base asset
+    at the latest candle of every pair, relative to the capital. Metrics of every pair are of its trades as if each buy
+    sold 1 unit of base asset (see backtest_metrics).
+    candles: list of dicts with ts and close of the candles of every pair
+    trade_index, advices: lists of the trades of every pair
+    stakes: list of amounts of base asset sold by the buys of every pair, aligned with its trades
+    :return: (dict of the metrics of the portfolio, list of dicts of the metrics of every pair)
+    """
+    pair_metrics = [backtest_metrics(ohlcv['ts'], ohlcv['close'], index, pair_advices, resolution)
+                    for ohlcv, index, pair_advices in zip(candles, trade_index, advices)]
+
+    ts = np.unique(np.concatenate([ohlcv['ts'] for ohlcv in candles]))
+    value = np.zeros(len(ts))
+    invested = np.zeros(len(ts))
+    realized, change_ts, change = [], [], []
+    for ohlcv, index, pair_advices, pair_stakes in zip(candles, trade_index, advices, stakes):
+        close = ohlcv['close']
+        n = len(close)
+        if n == 0:
+            continue
+        equity, pair_realized, holding = equity_curve(close, index, pair_advices)
+        realized += [pair_realized]
+
+        # stake and price of the last buy at every candle
+        buys = pair_advices == BaseTradingStrategy.SIGNAL_BUY
+        stake = np.zeros(n)
+        stake[index[buys]] = np.asarray(pair_stakes, dtype=float)[buys]
+        last_buy = np.maximum.accumulate(np.where(stake > 0, np.arange(n), 0))
+        stake = stake[last_buy]
+        pair_value = np.where(holding, stake * close[last_buy] / close, 0)
+
+        # latest candle of the pair at every ts of the portfolio, none before its first candle
+        latest = np.searchsorted(ohlcv['ts'], ts, 'right') - 1
+        started = latest >= 0
+        value += np.where(started, pair_value[latest], 0)
+        invested += np.where(started & holding[latest], stake[latest], 0)
+
+        # buys take their stake from the capital, sells return what the previous buy bought at the price of the sell
+        change_ts += [ohlcv['ts'][index]]
+        change += [np.where(buys, -stake[index], stake[index] * close[last_buy[index]] / close[index])]
+
+    change_ts = np.concatenate(change_ts) if change_ts else np.zeros(0, dtype=np.int64)
+    change = np.concatenate(change) if change else np.zeros(0)
+    order = np.argsort(change_ts, kind='stable')
+    changed = np.concatenate([[0], np.cumsum(change[order])])
+    balance = capital + changed[np.searchsorted(change_ts[order], ts, 'right')]
+
+    realized = np.concatenate(realized) if realized else np.zeros(0)
+    num_trades = sum([len(pair_advices) for pair_advices in advices])
+    metrics = equity_metrics(ts, (balance + value) / capital, realized, invested / capital, num_trades, resolution)
+    return metrics, pair_metrics
+
+
+def equity_metrics(ts, equity, realized, invested, num_trades, resolution):
+    """
+    Sharpe and sortino ratios are annualized from the returns of the equity per candle, None if returns do not vary
+    (or never go down for sortino).
+    equity: equity at every candle relative to the capital
+    realized: realized return of every sell
+    invested: fraction of the capital invested at every candle
+    :return: dict of the metrics stored in backtest_metrics, equity curve is encoded with encode_equity_curve
+    """
+    metrics = EquityMetrics()
+    metrics.add(ts, equity, realized, invested)
+    metrics.num_trades = int(num_trades)
+    return metrics.metrics(resolution)
+
+
+class EquityMetrics(object):
+    """
+    Metrics of the equity curve (see equity_metrics) computed over the candles chunk by chunk. Only running sums and
+    the equity curve sampled every stride candles are kept, hence memory does not depend on the number of candles and
+    the metrics are checkpointed along with the state of the strategy.
+    """
+
+    def __init__(self):
+        self.num_candles = 0
+        self.num_trades = 0
+        # trades not yet added to the equity, (index of the candle, signal)
+        self.pending = []
+        # sum of realized returns and close of the open buy, None if position is not open
+        self.realized = 0.0
+        self.buy_close = None
+        self.num_sells = 0
+        self.num_wins = 0
+        self.invested = 0.0
+        self.peak = None
+        self.max_drawdown = 0.0
+        self.last_ts = None
+        self.last_equity = None
+        # count, mean and sum of squared deviations of the returns per candle, sum of squared negative returns
+        self.num_returns = 0
+        self.mean_return = 0.0
+        self.returns_m2 = 0.0
+        self.downside_sq = 0.0
+        # equity at every stride-th candle, stride doubles once there are EQUITY_CURVE_POINTS points
+        self.stride = 1
+        self.curve_ts = []
+        self.curve_equity = []
+
+    def trade(self, index, signal):
+        """
+        Adds trade made at the candle with given index since the start of the backtest, before the candle is added.
+        """
+        self.pending += [(index, signal)]
+
+    def update(self, ts, close, trade_index=None, advices=None):
+        """
+        Adds the next candles, every buy sells 1 unit of base asset and the following sell buys it back (see
+        equity_curve).
+        trade_index, advices: trades made at these candles besides the ones added by trade, index is of these candles
+        """
+        n = len(close)
+        end = self.num_candles + n
+        index = np.array([i for i, signal in self.pending if i < end], dtype=int) - self.num_candles
+        signals = np.array([signal for i, signal in self.pending if i < end], dtype=int)
+        self.pending = [(i, signal) for i, signal in self.pending if i >= end]
+        if trade_index is not None:
+            index = np.concatenate([index, trade_index]).astype(int)
+            signals = np.concatenate([signals, advices]).astype(int)
+        self.num_trades += len(signals)
+        if n == 0:
+            return
+
+        is_buy = np.zeros(n, dtype=bool)
+        is_buy[index[signals == BaseTradingStrategy.SIGNAL_BUY]] = True
+        sells = index[signals == BaseTradingStrategy.SIGNAL_SELL]
+
+        # close of the last buy and whether it is open at every candle, including the buy open before these candles
+        last_buy = np.maximum.accumulate(np.where(is_buy, np.arange(n), -1))
+        buy_close = np.where(last_buy >= 0, close[np.maximum(last_buy, 0)],
+                             np.nan if self.buy_close is None else self.buy_close)
+        position = np.zeros(n, dtype=int)
+        position[is_buy] = 1
+        position[sells] = -1
+        holding = (self.buy_close is not None) + np.cumsum(position) > 0
+
+        realized = np.zeros(n)
+        realized[sells] = buy_close[sells] / close[sells] - 1
+        unrealized = np.where(holding, buy_close / close - 1, 0.0)
+        realized_sum = np.cumsum(np.concatenate([[self.realized], realized]))[1:]
+        equity = 1 + realized_sum + unrealized
+        self.realized = float(realized_sum[-1])
+        self.buy_close = float(buy_close[-1]) if holding[-1] else None
+        self.add(ts, equity, realized[sells], holding)
+
+    def add(self, ts, equity, realized, invested):
+        """
+        Adds the next candles.
+        equity: equity at every candle relative to the capital
+        realized: realized return of every sell
+        invested: fraction of the capital invested at every candle
+        """
+        n = len(equity)
+        if n == 0:
+            return
+
+        peak = np.maximum.accumulate(np.concatenate([[equity[0] if self.peak is None else self.peak], equity]))[1:]
+        self.peak = float(peak[-1])
+        self.max_drawdown = max(self.max_drawdown, float(np.max((peak - equity) / peak)))
+        self.num_sells += len(realized)
+        self.num_wins += int(np.count_nonzero(np.asarray(realized) > 0))
+        self.invested += float(np.sum(invested))
+
+        # returns are merged with the ones of the earlier candles by the parallel variance algorithm
+        returns = np.diff(equity if self.last_equity is None else np.concatenate([[self.last_equity], equity]))
+        if len(returns):
+            count = self.num_returns + len(returns)
+            mean = float(np.mean(returns))
+            delta = mean - self.mean_return
+            self.returns_m2 += float(np.sum((returns - mean) ** 2)) + \
+                delta ** 2 * self.num_returns * (len(returns) / count)
+            self.mean_return += delta * (len(returns) / count)
+            self.num_returns = count
+            self.downside_sq += float(np.sum(np.minimum(returns, 0) ** 2))
+
+        start = self.num_candles
+        self.num_candles += n
+        while -(-self.num_candles // self.stride) > EQUITY_CURVE_POINTS - 1:
+            self.stride *= 2
+            self.curve_ts, self.curve_equity = self.curve_ts[::2], self.curve_equity[::2]
+        sampled = slice(-start % self.stride, n, self.stride)
+        self.curve_ts += np.asarray(ts)[sampled].tolist()
+        self.curve_equity += np.asarray(equity)[sampled].tolist()
+        self.last_ts, self.last_equity = int(ts[-1]), float(equity[-1])
+
+    def metrics(self, resolution):
+        """
+        :return: dict of the metrics stored in backtest_metrics (see equity_metrics)
+        """
+        metrics = {
+            'num_candles': self.num_candles,
+            'num_trades': self.num_trades,
+            'total_return': 0.0,
+            'max_drawdown': 0.0,
+            'sharpe': None,
+            'sortino': None,
+            'win_rate': None,
+            'exposure': 0.0,
+            'equity_curve': encode_equity_curve(np.zeros(0, dtype=np.int64), np.ones(0)),
+        }
+        if self.num_candles == 0:
+            return metrics
+
+        metrics['total_return'] = self.last_equity - 1
+        metrics['max_drawdown'] = self.max_drawdown
+        metrics['exposure'] = self.invested / self.num_candles
+        if self.num_sells:
+            metrics['win_rate'] = self.num_wins / self.num_sells
+        # last candle is always in the curve
+        last = (self.num_candles - 1) % self.stride == 0
+        points = len(self.curve_ts) - last
+        metrics['equity_curve'] = encode_equity_curve(self.curve_ts[:points] + [self.last_ts],
+                                                      self.curve_equity[:points] + [self.last_equity])
+
+        periods = np.sqrt(SECONDS_PER_YEAR / RESOLUTION_SECONDS.get(resolution, 60))
+        std = np.sqrt(self.returns_m2 / self.num_returns) if self.num_returns else 0
+        if self.num_returns > 1 and std > 0:
+            metrics['sharpe'] = float(self.mean_return / std * periods)
+        downside = np.sqrt(self.downside_sq / self.num_returns) if self.num_returns else 0
+        if downside > 0:
+            metrics['sortino'] = float(self.mean_return / downside * periods)
+        return metrics
+
+
+def strategy_version(strategyname):
+    """
+    :return: hash of the code of the strategy and of the modules computing its backtest
+    """
+    if strategyname not in _strategy_versions:
+        sha = hashlib.sha1()
+        for module in (strategy_classes[strategyname].__module__,) + RESULT_MODULES:
+            with open(sys.modules[module].__file__, 'rb') as f:
+                sha.update(f.read())
+        _strategy_versions[strategyname] = sha.hexdigest()
+    return _strategy_versions[strategyname]
+
+
+def evict_results(max_age=None, max_states=None, now=None):
+    """
+    Deletes results of the backtests which are deleted and are not used as results of other backtests. Saved states
+    of finished backtests (see SdexHistory.save_state) and checkpoints of failed backtests are not referenced by any
+    results, they are deleted once their backtest was started more than max_age seconds ago, and only max_states
+    latest states are kept.
+    :return: number of deleted rows
+    """
+    if now is None:
+        now = int(time.time())
+    used = "select id from backtest_request union select results_id from backtest_request where results_id is not null"
+    num_tries = 0
+    while num_tries < 3:
+        try:
+            count = 0
+            with sqlite3.connect(get_backtest_db()) as db:
+                for table in RESULT_TABLES:
+                    count += db.execute("delete from %s where backtest_id not in (%s)" % (table, used)).rowcount
+                if max_age is not None:
+                    count += db.execute("delete from backtest_state where backtest_id in "
+                                        "(select id from backtest_request where coalesce(started_at, 0) < ?)",
+                                        [now - max_age]).rowcount
+                    count += db.execute("delete from backtest_checkpoint where backtest_id in "
+                                        "(select id from backtest_request where status = ? and "
+                                        "coalesce(started_at, 0) < ?)",
+                                        [Backtest.STATUS_ERROR, now - max_age]).rowcount
+                if max_states is not None:
+                    count += db.execute("delete from backtest_state where backtest_id not in "
+                                        "(select s.backtest_id from backtest_state s "
+                                        "join backtest_request r on r.id = s.backtest_id "
+                                        "order by r.started_at desc, s.backtest_id desc limit ?)",
+                                        [max_states]).rowcount
+                db.commit()
+            return count
+        except:
+            logging.exception('Error occurred while evicting results of deleted backtests')
+            num_tries += 1
+    return 0
+
+
+def _run_sweep_chunk(chunk):
+    """
+    Runs parameters of the sweep in the process, candles are taken from _sweep.
+    :return: list of (index of parameters, pnl, num_trades, max_drawdown)
+    """
+    history, backtest, ohlcv, scope = _sweep['history'], _sweep['backtest'], _sweep['ohlcv'], _sweep['scope']
+    indicator_cache = history.indicator_cache
+    if indicator_cache is None:
+        # indicators are still shared between parameters of the chunk
+        indicator_cache = IndicatorCache()
+
+    results = []
+    for k, parameters in chunk:
+        try:
+            results += [(k,) + history._run_sweep_parameters(backtest, parameters, ohlcv, indicator_cache, scope)]
+        except:
+            logging.exception('Error occurred while backtesting parameters %s of bid = %s' % (parameters, backtest.bid))
+    return results
+
+
+def _run_portfolio_pair(pair):
+    """
+    Runs the strategy of the portfolio backtest over the candles of the pair, candles are taken from _portfolio.
+    :return: (pair, signal of the candles)
+    """
+    history, backtest, ohlcv = _portfolio['history'], _portfolio['backtest'], _portfolio['candles'][pair]
+    scope = None
+    if history.indicator_cache is not None:
+        scope = (pair, backtest.candlesize, backtest.start_ts, backtest.end_ts, IndicatorCache.digest_candles(ohlcv))
+    signal = history._signal(backtest, backtest.parameters, ohlcv, pair, history.indicator_cache, scope)
+    return pair, signal.astype(np.int8)
+
+
+def _run_shard(shard):
+    """
+    Runs the strategy of the sharded backtest candle by candle over candles [start, end), candles are taken from
+    _shards.
+    :return: signal of the candles
+    """
+    start, end = shard
+    history, backtest, ohlcv = _shards['history'], _shards['backtest'], _shards['ohlcv']
+    strategy = strategy_factory[backtest.strategyname](backtest.bid, backtest.parameters, None, _shards['candlesize'])
+    candles = dict((column, values[start:end]) for column, values in ohlcv.items())
+    return history.simulate_signal(strategy, candles, backtest.tradepair, _shards['timeframes'])
+
+
+# seconds after which backtest leased by a worker which stopped sending heartbeats is given to another worker
+LEASE_TTL = 60
+
+# progress of backtest is written along with the lease at most every PROGRESS_INTERVAL seconds and checked every
+# PROGRESS_CANDLES candles
+PROGRESS_INTERVAL = 5
+PROGRESS_CANDLES = 1000
+
+# seconds between checkpoints of running backtest, restarted backtest is resumed from the last one
+CHECKPOINT_INTERVAL = 60
+
+# seconds between polls of idle worker for new backtest requests, webapp notifies the workers when the socket for it
+# is configured, hence they poll only in case notification is lost
+POLL_INTERVAL = 1
+NOTIFIED_POLL_INTERVAL = 10
+# number of times backtest is leased before it is considered failed, e.g. if it keeps crashing workers
+MAX_ATTEMPTS = 3
+
+# see schedule_backtest
+FAIR_SHARE_WINDOW = 60 * 60
+SHORTEST_FIRST_QUEUE = 10
+AGING_INTERVAL = 10 * 60
+
+
+class BacktestLease(object):
+    """
+    Lease of backtest request held by a worker while running it. Lease is extended by a heartbeat thread,
+    if worker dies or hangs, lease expires and backtest is leased to another worker. Progress of the backtest is
+    written along with the lease.
+    """
+
+    def __init__(self, bid, owner, ttl=LEASE_TTL):
+        self.bid = bid
+        self.owner = owner
+        self.ttl = ttl
+        self.lost = False
+        self.stopped = threading.Event()
+        self.thread = None
+        self.paused = False
+        # (candles processed, total candles, ts of the last processed candle), set by the worker
+        self.progress = None
+
+    def renew(self):
+        num_tries = 0
+        while num_tries < 3:
+            try:
+                with sqlite3.connect(get_backtest_db()) as db:
+                    if self.progress:
+                        cursor = db.execute("update backtest_request set lease_expires = ?, progress_candles = ?, "
+                                            "total_candles = ?, progress_ts = ? where id = ? and lease_owner = ?",
+                                            [int(time.time()) + self.ttl] + list(self.progress) +
+                                            [self.bid, self.owner])
+                    else:
+                        cursor = db.execute("update backtest_request set lease_expires = ? "
+                                            "where id = ? and lease_owner = ?",
+                                            [int(time.time()) + self.ttl, self.bid, self.owner])
+                    db.commit()
+                if cursor.rowcount == 0:
+                    logging.error('Lease of backtest %s is taken over from %s' % (self.bid, self.owner))
+                    self.lost = True
+                return not self.lost
+            except:
+                num_tries += 1
+        logging.error('Cannot renew lease of backtest %s' % self.bid)
+        return False
+
+    def _heartbeat(self):
+        while not self.stopped.wait(min(self.ttl / 3.0, PROGRESS_INTERVAL)):
+            if not self.renew():
+                break
+
+    def start(self):
+        self.thread = threading.Thread(target=self._heartbeat, name='lease-%s' % self.bid, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        if self.progress and not self.lost:
+            # final progress
+            self.renew()
+
+    def pause(self):
+        """
+        Stops the heartbeat till resume is called, lease is not renewed meanwhile.
+        """
+        if self.thread:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+            self.paused = True
+
+    def resume(self):
+        if self.paused:
+            self.paused = False
+            self.stopped = threading.Event()
+            self.start()
+
+
+def schedule_backtest(db, now):
+    """
+    Picks the backtest to run next among the new backtests and the running ones with expired lease. Users get fair
+    share of the workers: backtests of the user with the fewest running backtests go first, then of the user whose
+    backtests started in last FAIR_SHARE_WINDOW seconds have the lowest cost. Backtests of the user are ordered by
+    priority, then, if the queue is longer than SHORTEST_FIRST_QUEUE, by estimated cost in powers of two (halved
+    every AGING_INTERVAL seconds the backtest waits, so that long backtests are not starved), then by id.
+    :return: id of the backtest, None if there is nothing to run
+    """
+    candidates = db.execute("select id, userid, priority, cost, queued_at, start_ts, end_ts, candlesize "
+                            "from backtest_request where status = ? or (status = ? and "
+                            "(lease_expires is null or lease_expires < ?))",
+                            [Backtest.STATUS_NEW, Backtest.STATUS_RUNNING, now]).fetchall()
+    if not candidates:
+        return None
+
+    running = dict(db.execute("select userid, count(*) from backtest_request where status = ? and "
+                              "lease_expires >= ? group by userid", [Backtest.STATUS_RUNNING, now]).fetchall())
+    usage = dict(db.execute("select userid, sum(cost) from backtest_request where started_at >= ? group by userid",
+                            [now - FAIR_SHARE_WINDOW]).fetchall())
+    shortest_first = len(candidates) > SHORTEST_FIRST_QUEUE
+
+    def key(row):
+        bid, userid, priority, cost, queued_at, start_ts, end_ts, candlesize = row
+        size = 0
+        if shortest_first:
+            if cost is None:
+                cost = estimate_cost(start_ts, end_ts, candlesize, now=now)
+            waited = now - queued_at if queued_at else 0
+            size = max(0, int(math.log2(max(cost, 1))) - waited // AGING_INTERVAL)
+        return running.get(userid, 0), usage.get(userid) or 0, -(priority or 0), size, bid
+
+    return min(candidates, key=key)[0]
+
+
+def claim_backtest(worker, ttl=LEASE_TTL):
+    """
+    Atomically picks the backtest to run next (see schedule_backtest), moves it to running and leases it to the
+    worker.
+    :return: (Backtest, BacktestLease, number of times it is leased, whether it was started before and may have
+    partial results) or None if there is nothing to run
+    """
+    owner = '%s:%s' % (worker, uuid.uuid4().hex)
+    now = int(time.time())
 
-def update_backtest_status(bid, status):
+    num_tries = 0
+    while num_tries < 3:
+        try:
+            db = sqlite3.connect(get_backtest_db(), isolation_level=None)
+            try:
+                # claims of the workers are serialized, backtest is picked and leased in one transaction
+                db.execute('BEGIN IMMEDIATE')
+                bid = schedule_backtest(db, now)
+                if bid is None:
+                    db.execute('COMMIT')
+                    return None
+                status = db.execute("select status from backtest_request where id = ?", [bid]).fetchone()[0]
+
+                db.execute("update backtest_request set status = ?, lease_owner = ?, lease_expires = ?, "
+                           "attempts = attempts + 1, started_at = ? where id = ?",
+                           [Backtest.STATUS_RUNNING, owner, now + ttl, now, bid])
+                cursor = db.execute("select id, algoname, start_ts, end_ts, tradepair, candlesize, strategyname, "
+                                    "parameters, attempts, grid, pairs, capital from backtest_request where id = ?",
+                                    [bid])
+                row = cursor.fetchone()
+                db.execute('COMMIT')
+            except:
+                if db.in_transaction:
+                    db.execute('ROLLBACK')
+                raise
+            finally:
+                db.close()
+            break
+        except:
+            logging.exception('Error occurred while claiming backtest')
+            num_tries += 1
+    else:
+        return None
+
+    if not row:
+        return None
+
+    try:
+        parameters = json.loads(row[7])
+        grid = json.loads(row[9]) if row[9] is not None else None
+        pairs = json.loads(row[10]) if row[10] is not None else None
+    except:
+        parameters, grid, pairs = None, None, None
+
+    backtest = Backtest(row[0], row[1], row[2], row[3], row[4], row[5], row[6], parameters, grid, pairs, row[11])
+    return backtest, BacktestLease(row[0], owner, ttl), row[8], status == Backtest.STATUS_RUNNING
+
+
+def update_backtest_status(bid, status, lease_owner=None):
+    """
+    lease_owner: if given, status is updated only if backtest is still leased by this owner
+    """
     num_tries = 0
     while num_tries < 3:
         try:
             with sqlite3.connect(get_backtest_db()) as db:
-                db.execute("update backtest_request set status = ? where id = ?", [status, bid])
+                if lease_owner:
+                    db.execute("update backtest_request set status = ?, lease_owner = null, lease_expires = null "
+                               "where id = ? and lease_owner = ?", [status, bid, lease_owner])
+                else:
+                    db.execute("update backtest_request set status = ? where id = ?", [status, bid])
                 db.commit()
             break
         except:
@@ -352,51 +2230,281 @@ def update_backtest_status(bid, status):
     return True
 
 
-def run_backtester():
-    while True:
-        backtests = []
+def release_backtest(bid, lease_owner):
+    """
+    Gives up the lease of the backtest which is still running, e.g. when the worker is stopped. Backtest is claimed
+    again right away and resumed from its checkpoint, the attempt is not counted.
+    :return: True if lease is released, False otherwise
+    """
+    num_tries = 0
+    while num_tries < 3:
+        try:
+            with sqlite3.connect(get_backtest_db()) as db:
+                cursor = db.execute("update backtest_request set lease_owner = null, lease_expires = null, "
+                                    "attempts = max(attempts - 1, 0) where id = ? and lease_owner = ? and status = ?",
+                                    [bid, lease_owner, Backtest.STATUS_RUNNING])
+                db.commit()
+            return cursor.rowcount == 1
+        except:
+            logging.exception('Error occurred while releasing backtest %s' % bid)
+            num_tries += 1
+    return False
 
-        num_tries = 0
-        while num_tries < 3:
-            try:
-                logging.debug("Querying backtest_request for new requests")
-                with sqlite3.connect(get_backtest_db()) as db:
-                    cursor = db.execute("select id, algoname, start_ts, end_ts, "
-                                        "tradepair, candlesize, strategyname, parameters "
-                                        "from backtest_request where status = ?", [Backtest.STATUS_NEW])
 
-                    for row in cursor:
-                        backtests += [
-                            Backtest(row[0], row[1], row[2], row[3], row[4], row[5], row[6], json.loads(row[7]))]
-                break
+def delete_backtest_results(bid, resume=False):
+    """
+    resume: if backtest has a checkpoint, trades saved along with it are kept, so that backtest is resumed from it
+    """
+    num_tries = 0
+    while num_tries < 3:
+        try:
+            with sqlite3.connect(get_backtest_db()) as db:
+                if resume and db.execute("select 1 from backtest_checkpoint where backtest_id = ?", [bid]).fetchone():
+                    logging.info('Keeping trades of backtest %s saved before its checkpoint' % bid)
+                else:
+                    db.execute("delete from backtest_trades where backtest_id = ?", [bid])
+                    db.execute("delete from backtest_sweep_results where backtest_id = ?", [bid])
+                    db.execute("delete from backtest_checkpoint where backtest_id = ?", [bid])
+                db.execute("delete from backtest_metrics where backtest_id = ?", [bid])
+                db.execute("delete from backtest_pair_metrics where backtest_id = ?", [bid])
+                db.execute("delete from backtest_state where backtest_id = ?", [bid])
+                db.commit()
+            return True
+        except:
+            num_tries += 1
+    return False
+
+
+def upgrade_backtest_db():
+    """
+    Adds columns and tables of backtest_request added after the database was created.
+    """
+    columns = [
+        ('LEASE_OWNER', 'TEXT'),
+        ('LEASE_EXPIRES', 'INT'),
+        ('ATTEMPTS', 'INT NOT NULL DEFAULT 0'),
+        ('GRID', 'TEXT'),
+        ('PROGRESS_CANDLES', 'INT'),
+        ('TOTAL_CANDLES', 'INT'),
+        ('PROGRESS_TS', 'INT'),
+        ('RESULT_KEY', 'TEXT'),
+        ('DATA_KEY', 'TEXT'),
+        ('RESULTS_ID', 'INT'),
+        ('PRIORITY', 'INT NOT NULL DEFAULT 0'),
+        ('COST', 'INT'),
+        ('QUEUED_AT', 'INT'),
+        ('STARTED_AT', 'INT'),
+        ('PAIRS', 'TEXT'),
+        ('CAPITAL', 'REAL'),
+    ]
+    with sqlite3.connect(get_backtest_db()) as db:
+        existing = [row[1].upper() for row in db.execute('pragma table_info(backtest_request)')]
+        for name, definition in columns:
+            if name not in existing:
+                logging.info('Adding column %s to backtest_request' % name)
+                try:
+                    db.execute('alter table backtest_request add column %s %s' % (name, definition))
+                except sqlite3.OperationalError:
+                    # added by another backtester at the same time
+                    logging.exception('Cannot add column %s' % name)
+        db.execute('create index if not exists backtest_request_status on backtest_request(status, id)')
+        db.execute('create index if not exists backtest_request_result on backtest_request(result_key, id)')
+        db.execute('create index if not exists backtest_request_started on backtest_request(started_at)')
+        create_candles_index(db)
+        create_rollup_table(db)
+        db.execute('create table if not exists backtest_sweep_results ('
+                   'id integer primary key autoincrement, backtest_id int not null, rank int not null, '
+                   'parameters text not null, pnl real, num_trades int, max_drawdown real)')
+        db.execute('create index if not exists backtest_sweep_results_rank '
+                   'on backtest_sweep_results(backtest_id, rank)')
+        db.execute('create table if not exists backtest_metrics ('
+                   'backtest_id int primary key, num_candles int, num_trades int, total_return real, '
+                   'max_drawdown real, sharpe real, sortino real, win_rate real, exposure real, equity_curve blob)')
+        db.execute('create table if not exists backtest_pair_metrics ('
+                   'backtest_id int not null, trade_pair text not null, num_candles int, num_trades int, '
+                   'total_return real, max_drawdown real, sharpe real, sortino real, win_rate real, exposure real, '
+                   'equity_curve blob, primary key (backtest_id, trade_pair))')
+        db.execute('create table if not exists backtest_checkpoint ('
+                   'backtest_id int primary key, ts int not null, candles int not null, state blob not null)')
+        if db.execute("select 1 from sqlite_master where type = 'table' and name = 'backtest_state'").fetchone() and \
+                'VERSION' not in [row[1].upper() for row in db.execute('pragma table_info(backtest_state)')]:
+            # states saved without the version of the strategy can not be told from the stale ones
+            logging.info('Dropping states of backtests saved without version of strategy')
+            db.execute('drop table backtest_state')
+        db.execute('create table if not exists backtest_state ('
+                   'backtest_id int primary key, strategy text not null, version text not null, '
+                   'fingerprint text not null, ts int not null, candles int not null, state blob not null)')
+        db.execute('create index if not exists backtest_state_fingerprint on backtest_state(fingerprint, ts)')
+        db.commit()
+
+
+def create_candles_index(conn):
+    """
+    Creates index of SDEX_OHLCV ordered by (trade_pair, ts, id) covering the columns read by backtests. Candles are
+    read from the index only, hence candles of a trade pair are read sequentially in the order of ts.
+    """
+    if conn.execute("select 1 from sqlite_master where type = 'index' and name = 'sdex_ohlcv_pair_ts'").fetchone():
+        return
+    logging.info('Creating index sdex_ohlcv_pair_ts, it takes a while for large history')
+    conn.execute('create index if not exists sdex_ohlcv_pair_ts on sdex_ohlcv'
+                 '(trade_pair, ts, id, high, low, open, close, base_volume, counter_volume)')
+
+
+def _stop_worker(signum, frame):
+    global _stop_requested
+    _stop_requested = True
+    sys.exit(0)
+
+
+def run_worker(worker, main_db, backtest_db, cache_config=None, lease_ttl=LEASE_TTL, sweep_processes=None,
+               archive_path=None, notify_sockets=(None, None), listener=None, shards=1, evict_config=None):
+    """
+    notify_sockets: (backtester socket, webapp socket) paths, webapp is notified when status of backtest changes
+    listener: socket bound to backtester socket, shared by the workers, each notification wakes up one idle worker
+    shards: number of processes running parts of long backtest (see SdexHistory.run_sharded)
+    evict_config: (max_age, max_states) of the results no backtest refers to (see evict_results)
+    """
+    set_db(main_db, backtest_db)
+    set_notify_sockets(*notify_sockets)
+    # terminate raises SystemExit, so that running backtest is released and resumed from its checkpoint
+    signal.signal(signal.SIGTERM, _stop_worker)
+
+    indicator_cache = None
+    if cache_config:
+        indicator_cache = IndicatorCache(*cache_config)
+
+    logging.info('Starting backtest worker %s' % worker)
+    archive = None
+    if archive_path:
+        archive = CandleArchive(archive_path)
+
+    sdex_history = SdexHistory(sdex_db=get_backtest_db(), indicator_cache=indicator_cache, archive=archive,
+                               shards=shards)
+    sdex_history.init()
+    evict_at = time.time()
+    try:
+        while True:
+            if _stop_requested:
+                raise SystemExit(0)
+            claimed = claim_backtest(worker, lease_ttl)
+            if claimed and _stop_requested:
+                # worker was stopped while claiming the backtest
+                backtest, lease, attempts, resumed = claimed
+                release_backtest(backtest.bid, lease.owner)
+                raise SystemExit(0)
+            if not claimed:
+                if time.time() >= evict_at:
+                    evict_at = time.time() + EVICT_INTERVAL
+                    logging.info('Evicted %s results of deleted backtests' % evict_results(*(evict_config or ())))
+                if listener:
+                    wait(listener, NOTIFIED_POLL_INTERVAL)
+                else:
+                    time.sleep(POLL_INTERVAL)
+                continue
+
+            backtest, lease, attempts, resumed = claimed
+            logging.info('Worker %s leased backtest %s (attempt %s)' % (worker, backtest.bid, attempts))
+            notify_webapp(backtest.bid)
+
+            if resumed and not delete_backtest_results(backtest.bid, resume=not backtest.is_sweep()):
+                # results of the earlier attempt would be duplicated, let another attempt try it
+                logging.error('Cannot delete results of earlier attempt of backtest %s' % backtest.bid)
+                continue
+
+            if attempts > MAX_ATTEMPTS or backtest.parameters is None:
+                logging.error('Giving up backtest %s after %s attempts' % (backtest.bid, attempts - 1))
+                update_backtest_status(backtest.bid, Backtest.STATUS_ERROR, lease.owner)
+                notify_webapp(backtest.bid)
+                continue
+
+            lease.start()
+            sdex_history.lease = lease
+            stopping = None
+            try:
+                if sdex_history.use_cached_result(backtest):
+                    r, err = True, None
+                elif backtest.is_sweep():
+                    r, err = sdex_history.run_sweep(backtest, sweep_processes)
+                elif backtest.is_portfolio():
+                    r, err = sdex_history.run_portfolio(backtest, sweep_processes)
+                else:
+                    r, err = sdex_history.run(backtest)
+            except (KeyboardInterrupt, SystemExit) as e:
+                # worker is stopped in the middle of the backtest, it is resumed from its checkpoint by next worker
+                logging.error('Backtest worker %s stopped while running backtest %s' % (worker, backtest.bid))
+                r, err, stopping = False, None, e
             except:
-                num_tries += 1
-        else:
-            time.sleep(1)
-            continue
-
-        logging.info("Found %s new backtest_request" % len(backtests))
-
-        sdex_history = SdexHistory(sdex_db=get_backtest_db())
-        sdex_history.init()
+                logging.exception('Error occurred while running backtest %s' % backtest.bid)
+                r, err = False, None
+            finally:
+                lease.stop()
+                sdex_history.lease = None
+
+            if not r and _stop_requested and not stopping:
+                # backtest failed as the worker was stopped
+                stopping = SystemExit(0)
+            if stopping:
+                if not release_backtest(backtest.bid, lease.owner):
+                    logging.error('Cannot release backtest %s, it is resumed once its lease expires' % backtest.bid)
+                notify_webapp(backtest.bid)
+                raise stopping
+
+            status = Backtest.STATUS_FINISHED if r else Backtest.STATUS_ERROR
+            if not r:
+                logging.error('Backtest %s failed: %s' % (backtest.bid, err))
+            if not update_backtest_status(backtest.bid, status, lease.owner):
+                logging.error('Cannot updated db for bid = %s with status = %s', backtest.bid, status)
+            notify_webapp(backtest.bid)
+    finally:
+        sdex_history.close()
+
+
+def run_backtester(workers=1, cache_config=None, lease_ttl=LEASE_TTL, sweep_processes=None, archive_path=None,
+                   notify_sockets=(None, None), shards=1, evict_config=(RESULTS_MAX_AGE, None)):
+    """
+    Runs backtests using given number of worker processes. Workers lease backtest requests from the database,
+    hence any number of backtesters can run on the same database.
+    sweep_processes: number of processes used by a worker to run a sweep or pairs of a portfolio, number of cpus by
+    default
+    archive_path: path of CandleArchive, candles are read from the database if not given
+    notify_sockets: (backtester socket, webapp socket) paths, workers poll the database more often if not given
+    shards: number of processes running parts of long backtest, 1 to run backtests sequentially
+    evict_config: (max_age, max_states) of the saved states and checkpoints no backtest refers to, None to keep them
+    """
+    upgrade_backtest_db()
+
+    listener = None
+    if notify_sockets[0]:
         try:
-            for backtest in backtests:
-                if not update_backtest_status(backtest.bid, Backtest.STATUS_RUNNING):
-                    continue
+            listener = bind(notify_sockets[0])
+        except:
+            logging.exception('Cannot listen on %s, polling for backtest requests' % notify_sockets[0])
 
-                r, err = sdex_history.run(backtest)
-                if r:
-                    if not update_backtest_status(backtest.bid, Backtest.STATUS_FINISHED):
-                        logging.error('Cannot updated db for bid = %s with status = %s',
-                                      backtest.bid, Backtest.STATUS_FINISHED)
-                elif not update_backtest_status(backtest.bid, Backtest.STATUS_ERROR):
-                    logging.error('Cannot updated db for bid = %s with status = %s',
-                                  backtest.bid, Backtest.STATUS_ERROR)
-        finally:
-            sdex_history.close()
+    name = '%s:%s' % (socket.gethostname(), os.getpid())
+    if workers <= 1:
+        run_worker(name, get_main_db(), get_backtest_db(), cache_config, lease_ttl, sweep_processes, archive_path,
+                   notify_sockets, listener, shards, evict_config)
+        return
 
-        if len(backtests) == 0:
+    # workers are not daemons as they start processes to run sweeps, hence they are stopped explicitly
+    processes = {}
+    try:
+        while True:
+            for i in range(workers):
+                if i in processes and processes[i].is_alive():
+                    continue
+                if i in processes:
+                    logging.error('Backtest worker %s exited with code %s, restarting' % (i, processes[i].exitcode))
+
+                processes[i] = multiprocessing.Process(target=run_worker, name='backtester-%s' % i,
+                                                       args=('%s:%s' % (name, i), get_main_db(), get_backtest_db(),
+                                                             cache_config, lease_ttl, sweep_processes, archive_path,
+                                                             notify_sockets, listener, shards, evict_config))
+                processes[i].start()
             time.sleep(1)
+    finally:
+        for process in processes.values():
+            process.terminate()
 
 
 def usage():
@@ -470,4 +2578,47 @@ if __name__ == '__main__':
             backtest_db = dbconfig['connection_backtest']
     set_db(main_db, backtest_db)
 
-    run_backtester()
+    workers = 1
+    lease_ttl = LEASE_TTL
+    sweep_processes = None
+    shards = 1
+    cache_config = None
+    results_max_age = RESULTS_MAX_AGE
+    results_max_states = None
+    if 'backtester' in config:
+        backtesterconfig = config['backtester']
+        if 'workers' in backtesterconfig:
+            workers = int(backtesterconfig['workers'])
+        if 'lease_ttl' in backtesterconfig:
+            lease_ttl = int(backtesterconfig['lease_ttl'])
+        if 'sweep_processes' in backtesterconfig:
+            sweep_processes = int(backtesterconfig['sweep_processes'])
+        if 'shards' in backtesterconfig:
+            shards = int(backtesterconfig['shards'])
+        if 'results_max_age_days' in backtesterconfig:
+            results_max_age = int(backtesterconfig['results_max_age_days']) * 24 * 60 * 60
+        if 'results_max_states' in backtesterconfig:
+            results_max_states = int(backtesterconfig['results_max_states'])
+        if 'indicator_cache' in backtesterconfig:
+            cacheconfig = backtesterconfig['indicator_cache']
+            cache_size = cacheconfig.get('size_mb', 256)
+            disk_path = cacheconfig.get('disk_path', None)
+            disk_size = cacheconfig.get('disk_size_mb', 1024)
+            logging.info('Using indicator cache size = %sMB, disk_path = %s, disk_size = %sMB' %
+                         (cache_size, disk_path, disk_size))
+            cache_config = (cache_size * 1024 * 1024, disk_path, disk_size * 1024 * 1024)
+
+    archive_path = None
+    if 'archive' in config and 'path' in config['archive']:
+        archive_path = config['archive']['path']
+        logging.info('Using candle archive %s' % archive_path)
+
+    notify_sockets = (None, None)
+    if 'notify' in config:
+        notifyconfig = config['notify']
+        notify_sockets = (notifyconfig.get('backtester_socket', None), notifyconfig.get('webapp_socket', None))
+        logging.info('Notifying through backtester socket = %s, webapp socket = %s' % notify_sockets)
+
+    logging.info('Starting backtester with %s workers' % workers)
+    run_backtester(workers, cache_config, lease_ttl, sweep_processes, archive_path, notify_sockets, shards,
+                   (results_max_age, results_max_states))
@@ -0,0 +1,118 @@
+# Indicators of stardust.indicators over a grid of parameters.
+#
+# Computes an indicator for a whole grid of parameters over one candle history and returns, for every output of the
+# indicator, 2-D numpy array of shape (number of parameters, number of candles), row i corresponds to i-th parameters
+# of the grid. Output names and values are same as of the wrappers in stardust.indicators.
+#
+# Grid is not evaluated in one vectorized pass. TA-Lib computes a single series in C faster than numpy computes the
+# grid: over 200k candles and 50 periods a cumsum based SMA is ~4x and a 2-D EMA recurrence (one python loop over the
+# candles) ~25x slower than one TA-Lib call per period, and the cumsum also loses precision on long histories.
+# Instead every distinct computation is done only once: rows with same indicator parameters (e.g. strategy parameter
+# sweeps where only thresholds change) share one TA-Lib call. Only BBANDS has a kernel below, rows which differ only
+# in the deviation multipliers share the middle band and standard deviation.
+
+import json
+
+import numpy as np
+from talib import abstract as talib
+
+import stardust.indicators as ind
+
+
+def _unique(itype, grid):
+    """
+    :return: (list of distinct parameters in positional order, index of the distinct parameters for every row)
+    """
+    unique = []
+    keys = {}
+    index = np.empty(len(grid), dtype=int)
+    for i, kw in enumerate(grid):
+        params = ind.get_params(itype, kw)
+        try:
+            key = json.dumps(params)
+        except TypeError:
+            # array parameters are not compared
+            key = i
+        if key not in keys:
+            keys[key] = len(unique)
+            unique += [params]
+        index[i] = keys[key]
+    return unique, index
+
+
+def _expand(values, index):
+    """
+    :return: 2-D array with row index[i] of values as row i, values itself if every row is used once in order and
+    read-only view if all the rows are same
+    """
+    if len(index) == len(values) and (index == np.arange(len(index))).all():
+        return values
+    if len(values) == 1:
+        return np.broadcast_to(values, (len(index), values.shape[1]))
+    return values[index]
+
+
+def BBANDS(ohlcv, grid):
+    """ :return Bollinger Bands (upperband, middleband, lowerband) """
+    # rows with same period and moving average type share the middle band and standard deviation,
+    # only the deviation multipliers are applied per row
+    unique, index = _unique('BBANDS', grid)
+    bands = {}
+    band_index = np.empty(len(unique), dtype=int)
+    for i, (timeperiod, nbdevup, nbdevdn, matype) in enumerate(unique):
+        if (timeperiod, matype) not in bands:
+            bands[(timeperiod, matype)] = len(bands)
+        band_index[i] = bands[(timeperiod, matype)]
+
+    n = len(ohlcv['close'])
+    middle = np.empty((len(bands), n))
+    stddev = np.empty((len(bands), n))
+    for (timeperiod, matype), i in bands.items():
+        # band with deviation 1 is middle + stddev
+        upper, middle[i], lower = talib.BBANDS(ohlcv, timeperiod, 1.0, 1.0, matype)
+        np.subtract(upper, middle[i], out=stddev[i])
+
+    rows = band_index[index]
+    nbdevup = np.array([float(p[1]) for p in unique])[index][:, np.newaxis]
+    nbdevdn = np.array([float(p[2]) for p in unique])[index][:, np.newaxis]
+    middle = _expand(middle, rows)
+    stddev = _expand(stddev, rows)
+    return {
+        'upperband': middle + nbdevup * stddev,
+        'middleband': middle,
+        'lowerband': middle - nbdevdn * stddev,
+    }
+
+
+def get_all_batched_indicators():
+    """ :return indicators whose kernel shares computation between rows with different parameters """
+    return {
+        'BBANDS': BBANDS,
+    }
+
+
+def compute_grid(itype, ohlcv, grid):
+    """
+    Computes the indicator for all the parameters in the grid.
+    :param grid: list of parameters of the indicator in dict format
+    :return: dict of output name -> 2-D numpy array (parameters x candles), arrays should not be modified as rows of
+    same parameters can share memory
+    """
+    kernels = get_all_batched_indicators()
+    if itype in kernels:
+        return kernels[itype](ohlcv, grid)
+
+    # indicator is computed once per distinct parameters
+    unique, index = _unique(itype, grid)
+    order = ind.PARAMETERS[itype][1]
+    indicator = ind.get_all_indicators()[itype]
+    result = {}
+    for i, params in enumerate(unique):
+        for output, values in indicator(ohlcv, dict(zip(order, params))).items():
+            if output not in result:
+                result[output] = np.empty((len(unique), len(values)))
+            result[output][i] = values
+
+    for output, values in result.items():
+        result[output] = _expand(values, index)
+    return result
@@ -0,0 +1,110 @@
+# Benchmark of reading candles page by page with SdexHistory.get_candles.
+#
+# Reads all the pages of the period and prints latency of the pages at every tenth of the period, which should stay
+# the same deep into the period as pages are read by keyset from the index on (trade_pair, ts, id).
+
+import getopt
+import os
+import sys
+import time
+
+import yaml
+
+from stardust.backtester import SdexHistory
+from stardust.data import set_db, get_backtest_db
+
+# number of deciles of the period the latency is reported for
+BUCKETS = 10
+
+
+def benchmark_pages(history, trade_pair, period_from=None, period_to=None, resolution=None, page_size=1000):
+    """
+    :return: list of (number of pages, number of candles, average and max latency in ms) for every tenth of the pages
+    """
+    latencies = []
+    counts = []
+    page_token = None
+    while True:
+        start = time.perf_counter()
+        count, ohlcv = history.get_candles(trade_pair, period_from, period_to, resolution, page_size, page_token)
+        latencies += [(time.perf_counter() - start) * 1000]
+        counts += [count]
+        if count < page_size:
+            break
+        page_token = ohlcv.page_token
+
+    results = []
+    size = max(1, -(-len(latencies) // BUCKETS))
+    for i in range(0, len(latencies), size):
+        bucket = latencies[i:i + size]
+        results += [(len(bucket), sum(counts[i:i + size]), sum(bucket) / len(bucket), max(bucket))]
+    return results
+
+
+def usage():
+    print('benchmark -c/--config <config-file> -p/--pair <trade-pair> [-r/--resolution <resolution>] '
+          '[-s/--page-size <page-size>] [-f/--from <ts>] [-t/--to <ts>]')
+
+
+if __name__ == '__main__':
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "c:p:r:s:f:t:",
+                                   ["config=", "pair=", "resolution=", "page-size=", "from=", "to="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    configfile = 'engine.yaml'
+    pair = None
+    resolution = 'min'
+    page_size = 1000
+    period_from = None
+    period_to = None
+    for opt, val in opts:
+        if opt in ('-c', '--config'):
+            configfile = val
+        elif opt in ('-p', '--pair'):
+            pair = val
+        elif opt in ('-r', '--resolution'):
+            resolution = val
+        elif opt in ('-s', '--page-size'):
+            page_size = int(val)
+        elif opt in ('-f', '--from'):
+            period_from = int(val)
+        elif opt in ('-t', '--to'):
+            period_to = int(val)
+
+    if not pair:
+        usage()
+        sys.exit(2)
+
+    if not os.path.isfile(configfile):
+        print('config file %s doesnt exist' % configfile)
+        usage()
+        sys.exit(2)
+
+    with open(configfile, 'r') as f:
+        configcontent = f.read()
+    try:
+        config = yaml.load(configcontent)
+    except yaml.YAMLError as e:
+        print('Incorrect config file content. ex = %s' % str(e))
+        sys.exit(2)
+
+    main_db = 'engine.db'
+    backtest_db = 'backtest.db'
+    if 'db' in config:
+        dbconfig = config['db']
+        if 'connection_main' in dbconfig:
+            main_db = dbconfig['connection_main']
+        if 'connection_backtest' in dbconfig:
+            backtest_db = dbconfig['connection_backtest']
+    set_db(main_db, backtest_db)
+
+    history = SdexHistory(sdex_db=get_backtest_db()).init()
+    print('%8s %8s %10s %10s %10s' % ('depth', 'pages', 'candles', 'avg ms', 'max ms'))
+    depth = 0
+    for pages, candles, avg, worst in benchmark_pages(history, pair, period_from, period_to, resolution, page_size):
+        print('%8s %8s %10s %10.2f %10.2f' % (depth, pages, candles, avg, worst))
+        depth += pages
+    history.close()
@@ -0,0 +1,159 @@
+import collections
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+
+class IndicatorCache(object):
+    """
+    Cache of indicator values computed over whole candle history in backtests. Entries are addressed by the digest of
+    everything the values depend on (trade pair, candle size, time range, candles, indicator type and parameters), so
+    backtests of the same period with different strategy parameters reuse the indicators instead of recomputing them.
+
+    Entries are kept in memory upto max_size bytes, least recently used ones are evicted first. If disk_path is
+    given, evicted entries are written there and are loaded back on next use, disk usage is limited by max_disk_size.
+    """
+
+    def __init__(self, max_size=256 * 1024 * 1024, disk_path=None, max_disk_size=1024 * 1024 * 1024):
+        self.max_size = max_size
+        self.disk_path = disk_path
+        self.max_disk_size = max_disk_size
+
+        self.entries = collections.OrderedDict()
+        self.size = 0
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if self.disk_path and not os.path.exists(self.disk_path):
+            os.makedirs(self.disk_path)
+
+    @staticmethod
+    def digest_candles(ohlcv):
+        """
+        :return: digest of the candle arrays, used as part of the key so that changes in candle data are detected
+        """
+        h = hashlib.sha1()
+        for column in ('open', 'high', 'low', 'close', 'volume'):
+            h.update(np.ascontiguousarray(ohlcv[column], dtype=float).tobytes())
+        return h.hexdigest()
+
+    @staticmethod
+    def key(tradepair, candlesize, start_ts, end_ts, candles_digest, itype, parameters):
+        """
+        :return: key of the indicator values or None if parameters can not be serialized (e.g. array parameters)
+        """
+        try:
+            content = json.dumps([tradepair, candlesize, start_ts, end_ts, candles_digest, itype, parameters],
+                                 sort_keys=True)
+        except TypeError:
+            return None
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        :return: dict of output name -> read-only numpy array or None if values are not in the cache
+        """
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+
+        values = self._load(key)
+        if values is not None:
+            self.disk_hits += 1
+            self._put_memory(key, values)
+            return values
+
+        self.misses += 1
+        return None
+
+    def put(self, key, values):
+        values = dict(values)
+        for output in values.values():
+            # values are shared between backtests, hence should not be modified
+            output.flags.writeable = False
+        self._put_memory(key, values)
+
+    def stats(self):
+        return 'hits=%s disk_hits=%s misses=%s evictions=%s entries=%s size=%s' % \
+               (self.hits, self.disk_hits, self.misses, self.evictions, len(self.entries), self.size)
+
+    @staticmethod
+    def _sizeof(values):
+        return sum([output.nbytes for output in values.values()])
+
+    def _put_memory(self, key, values):
+        if key in self.entries:
+            self.size -= IndicatorCache._sizeof(self.entries.pop(key))
+
+        self.entries[key] = values
+        self.size += IndicatorCache._sizeof(values)
+
+        while self.size > self.max_size and self.entries:
+            old_key, old_values = self.entries.popitem(last=False)
+            self.size -= IndicatorCache._sizeof(old_values)
+            self.evictions += 1
+            self._store(old_key, old_values)
+
+    def _filename(self, key):
+        return os.path.join(self.disk_path, '%s.npz' % key)
+
+    def _load(self, key):
+        if not self.disk_path:
+            return None
+
+        filename = self._filename(key)
+        if not os.path.exists(filename):
+            return None
+
+        try:
+            with np.load(filename) as f:
+                values = {}
+                for output in f.files:
+                    values[output] = f[output]
+                    values[output].flags.writeable = False
+            # mark as recently used for disk eviction
+            os.utime(filename, None)
+            return values
+        except:
+            logging.exception('Error occurred while reading indicator cache file %s' % filename)
+            return None
+
+    def _store(self, key, values):
+        if not self.disk_path:
+            return
+
+        filename = self._filename(key)
+        try:
+            if not os.path.exists(filename):
+                tmp = filename + '.tmp'
+                with open(tmp, 'wb') as f:
+                    np.savez(f, **values)
+                os.rename(tmp, filename)
+            self._evict_disk()
+        except:
+            logging.exception('Error occurred while writing indicator cache file %s' % filename)
+
+    def _evict_disk(self):
+        files = []
+        total = 0
+        for name in os.listdir(self.disk_path):
+            if not name.endswith('.npz'):
+                continue
+            filename = os.path.join(self.disk_path, name)
+            st = os.stat(filename)
+            files += [(st.st_mtime, st.st_size, filename)]
+            total += st.st_size
+
+        files.sort()
+        for mtime, size, filename in files:
+            if total <= self.max_disk_size:
+                break
+            os.remove(filename)
+            total -= size
@@ -1,5 +1,9 @@
 import datetime
+import itertools
 import logging
+import time
+
+import numpy as np
 
 EPOCH = datetime.datetime.utcfromtimestamp(0)
 
@@ -61,13 +65,13 @@ class Candle(object):
                 return True
             if size == Candle.CANDLESIZE_1DAY and self.c_date.day == other_date.day:
                 return True
-            if size == Candle.CANDLESIZE_4HR and (self.c_date.hour / 4) == (other_date.hour / 4):
+            if size == Candle.CANDLESIZE_4HR and (self.c_date.hour // 4) == (other_date.hour // 4):
                 return True
             if size == Candle.CANDLESIZE_1HR and self.c_date.hour == other_date.hour:
                 return True
-            if size == Candle.CANDLESIZE_15MIN and (self.c_date.minute / 15) == (other_date.minute / 15):
+            if size == Candle.CANDLESIZE_15MIN and (self.c_date.minute // 15) == (other_date.minute // 15):
                 return True
-            if size == Candle.CANDLESIZE_5MIN and (self.c_date.minute / 5) == (other_date.minute / 5):
+            if size == Candle.CANDLESIZE_5MIN and (self.c_date.minute // 5) == (other_date.minute // 5):
                 return True
             if size == Candle.CANDLESIZE_1MIN and self.c_date.minute == other_date.minute:
                 return True
@@ -119,6 +123,18 @@ class Candle(object):
         self.c_counter_volume = values['counter_volume']
         self.is_first = False
 
+    def copy(self):
+        candle = Candle(self.key)
+        candle.is_first = self.is_first
+        candle.c_open = self.c_open
+        candle.c_high = self.c_high
+        candle.c_low = self.c_low
+        candle.c_close = self.c_close
+        candle.c_base_volume = self.c_base_volume
+        candle.c_counter_volume = self.c_counter_volume
+        candle.c_date = self.c_date
+        return candle
+
     def __repr__(self):
         return '(%.6f,%.6f,%.6f,%.6f,%.6f,%.6f)' % \
                (self.c_open, self.c_high, self.c_low, self.c_close,
@@ -129,7 +145,7 @@ class Candle(object):
         wk = int(d.strftime('%W'))
 
         return (self.key, (self.c_date - EPOCH).total_seconds(),
-                d.year, d.month, wk, d.day, d.hour / 4, d.hour, d.minute / 15, d.minute / 5, d.minute,
+                d.year, d.month, wk, d.day, d.hour // 4, d.hour, d.minute // 15, d.minute // 5, d.minute,
                 self.c_open, self.c_high, self.c_low, self.c_close,
                 self.c_base_volume, self.c_counter_volume)
 
@@ -141,6 +157,69 @@ class Candle(object):
         return True, 'Valid'
 
 
+def aggregate_candle(candle_per_size_per_key, candlesize, candle):
+    """
+    Combines 1min (or any smaller) candle into the candle of given size.
+    :param candle_per_size_per_key: candles being combined, candlesize -> trade pair -> candle
+    :return: candle of given size if it is complete, None otherwise
+    """
+    # since min candle generation frequency in fetcher is 1min, why bother
+    # comparing it to other candles
+    if candlesize == Candle.CANDLESIZE_1MIN:
+        return candle
+
+    candle_per_key = candle_per_size_per_key.setdefault(candlesize, {})
+    if candle.key in candle_per_key:
+        old_candle = candle_per_key[candle.key]
+        # check whether its same candle, if yes then combine otherwise
+        # release the old candle and start combining current candle with future candles
+        if old_candle.is_same_candle(candle.c_date, candlesize):
+            old_candle.c_close = candle.c_close
+            old_candle.c_high = candle.c_high if candle.c_high > old_candle.c_high else old_candle.c_high
+            old_candle.c_low = candle.c_low if candle.c_low < old_candle.c_low else old_candle.c_low
+            old_candle.c_base_volume += float(candle.c_base_volume)
+            old_candle.c_counter_volume += float(candle.c_counter_volume)
+            return None
+
+        # current candle is new candle, hence release the old candle
+        # todo: can be improved. Now old candle only get expired when new candle arrives
+        logging.debug('Releasing candle of size = %s for tradepair = %s' % (candlesize, candle.key))
+        candle_per_key[candle.key] = candle.copy()
+        return old_candle
+
+    candle_per_key[candle.key] = candle.copy()
+    return None
+
+
+# length of the candle of each size in seconds
+CANDLESIZE_SECONDS = {
+    Candle.CANDLESIZE_1MIN: 60,
+    Candle.CANDLESIZE_5MIN: 5 * 60,
+    Candle.CANDLESIZE_15MIN: 15 * 60,
+    Candle.CANDLESIZE_1HR: 60 * 60,
+    Candle.CANDLESIZE_4HR: 4 * 60 * 60,
+    Candle.CANDLESIZE_1DAY: 24 * 60 * 60,
+    Candle.CANDLESIZE_1WK: 7 * 24 * 60 * 60,
+}
+
+SECONDS_PER_YEAR = 365 * 24 * 60 * 60
+
+
+def estimate_cost(start_ts, end_ts, candlesize, combinations=1, now=None):
+    """
+    :return: estimated number of candles processed by the backtest, for every parameters of sweep. Period without
+    start is assumed to be a year long.
+    """
+    now = now or time.time()
+    try:
+        end = int(end_ts) if end_ts else now
+        start = int(start_ts) if start_ts else end - SECONDS_PER_YEAR
+    except (TypeError, ValueError):
+        end, start = now, now - SECONDS_PER_YEAR
+    seconds = CANDLESIZE_SECONDS.get(candlesize, 60)
+    return max(1, (end - start) // seconds) * max(1, combinations)
+
+
 class UserProfile(object):
     def __init__(self, userid, account, account_secret):
         self.userid = userid
@@ -174,7 +253,8 @@ class Backtest(object):
     STATUS_ERROR = 'error'
     STATUS_FINISHED = 'finished'
 
-    def __init__(self, bid, algoname, start_ts, end_ts, tradepair, candlesize, strategyname, parameters):
+    def __init__(self, bid, algoname, start_ts, end_ts, tradepair, candlesize, strategyname, parameters, grid=None,
+                 pairs=None, capital=None):
         self.bid = bid
         self.algoname = algoname
         self.start_ts = start_ts
@@ -183,6 +263,81 @@ class Backtest(object):
         self.candlesize = candlesize
         self.strategyname = strategyname
         self.parameters = parameters
+        # parameters swept by the backtest, None for backtest of single parameters
+        self.grid = grid
+        # trade pairs of portfolio backtest traded from shared capital in units of their base asset, None for backtest
+        # of single trade pair
+        self.pairs = pairs
+        self.capital = capital
+
+    def is_sweep(self):
+        return self.grid is not None
+
+    def is_portfolio(self):
+        return self.pairs is not None
+
+
+# maximum number of parameters in a sweep
+MAX_SWEEP_SIZE = 1000
+
+# maximum number of trade pairs in a portfolio
+MAX_PORTFOLIO_PAIRS = 100
+
+
+def expand_grid(parameters, grid):
+    """
+    :param parameters: parameters of the algo, used for the parameters not in the grid
+    :param grid: dict of parameter name -> list of values (all the combinations are swept) or list of parameters
+    :return: list of parameters to backtest
+    """
+    if isinstance(grid, dict):
+        names = sorted(grid.keys())
+        for name in names:
+            if not isinstance(grid[name], list) or not grid[name]:
+                raise Exception('values of %s should be non empty list' % name)
+        combinations = [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+    elif isinstance(grid, list):
+        combinations = grid
+        for combination in combinations:
+            if not isinstance(combination, dict):
+                raise Exception('parameters should be dict')
+    else:
+        raise Exception('grid should be dict or list')
+
+    if not combinations:
+        raise Exception('no parameters to sweep')
+    if len(combinations) > MAX_SWEEP_SIZE:
+        raise Exception('%s parameters, at most %s are allowed' % (len(combinations), MAX_SWEEP_SIZE))
+
+    return [dict(parameters or {}, **combination) for combination in combinations]
+
+
+# maximum number of points of the equity curve stored with the metrics of backtest
+EQUITY_CURVE_POINTS = 1000
+EQUITY_CURVE_DTYPE = np.dtype([('ts', '<i8'), ('equity', '<f4')])
+
+
+def encode_equity_curve(ts, equity):
+    """
+    :return: bytes of at most EQUITY_CURVE_POINTS (ts, equity) pairs evenly spaced over the candles, last candle
+    included
+    """
+    n = len(equity)
+    index = np.arange(n)
+    if n > EQUITY_CURVE_POINTS:
+        index = np.unique(np.linspace(0, n - 1, EQUITY_CURVE_POINTS).astype(int))
+    curve = np.empty(len(index), dtype=EQUITY_CURVE_DTYPE)
+    curve['ts'] = np.asarray(ts)[index]
+    curve['equity'] = np.asarray(equity)[index]
+    return curve.tobytes()
+
+
+def decode_equity_curve(blob):
+    """
+    :return: list of [ts, equity] of the equity curve encoded by encode_equity_curve
+    """
+    curve = np.frombuffer(blob, dtype=EQUITY_CURVE_DTYPE)
+    return [[int(ts), float(equity)] for ts, equity in zip(curve['ts'], curve['equity'])]
 
 
 class DeployedAlgo(object):
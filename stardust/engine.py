@@ -13,8 +13,10 @@ import stardust.fetcher as real_fetcher
 import stardust.trader as real_trader
 import stardust.webapp as webapp
 from stardust.data import Engine, DeployedAlgo, TradeAdvice, Candle
-from stardust.data import set_db, get_main_db
-from stardust.strategy import STRATEGY_COROUTINE_FACTORY as strategy_coroutine_factory
+from stardust.data import set_db, get_main_db, get_backtest_db, aggregate_candle, CANDLESIZE_SECONDS
+from stardust.notify import set_notify_sockets
+from stardust.registry import IndicatorRegistry, IndicatorSubscription
+from stardust.strategy import STRATEGY_FACTORY as strategy_factory
 
 DEPLOYMENT = {}
 
@@ -30,23 +32,232 @@ async def update_deployed_status(deployment_id, status):
         raise
 
 
-async def put_deployment(did, algo, st, candle_pipe, s2a):
+async def put_deployment(did, algo, strategy, shared_indicators):
     # todo does this needs to be in database?
     DEPLOYMENT[did] = {
         'algo': algo,
-        'st': st,
-        'c2s': candle_pipe,
-        's2a': s2a,
+        'strategy': strategy,
+        'indicators': shared_indicators,
     }
 
 
 async def get_deployment(did):
     # todo does this needs to be in database?
     d = DEPLOYMENT[did]
-    return d['algo'], d['st'], d['c2s'], d['s2a']
+    return d['algo'], d['strategy'], d['indicators']
+
+
+async def load_history(tradepair, seconds):
+    """
+    Loads 1min candles of the trade pair imported in sdex_ohlcv (see importer) in single query.
+    :param seconds: length of the period before the latest imported candle
+    :return: list of candles ordered by date
+    """
+    candles = []
+    async with aiosqlite.connect(get_backtest_db()) as db:
+        async with db.execute("select ts, open, high, low, close, base_volume, counter_volume from sdex_ohlcv "
+                              "where trade_pair = ? and "
+                              "ts > (select max(ts) from sdex_ohlcv where trade_pair = ?) - ? order by ts",
+                              [tradepair, tradepair, seconds]) as cursor:
+            async for row in cursor:
+                candle = Candle(tradepair)
+                candle.from_dict({
+                    'ts': row[0],
+                    'open': row[1],
+                    'high': row[2],
+                    'low': row[3],
+                    'close': row[4],
+                    'base_volume': row[5],
+                    'counter_volume': row[6],
+                })
+                candles += [candle]
+    return candles
+
+
+async def warmup_strategy(did, tradepair, strategy, indicator_registry):
+    """
+    Fills candle history and indicators of newly deployed strategy with the latest imported candles, so that it can
+    trade on the first live candle. Number of candles is derived from the lookback of the indicators of strategy.
+    """
+    warmup_sizes = {}
+    seconds = 0
+    for candlesize in strategy.get_candlesizes():
+        warmup_sizes[candlesize] = strategy.get_warmup_size(candlesize)
+        if warmup_sizes[candlesize] > 0:
+            # one more candle as the latest one is most probably incomplete
+            seconds = max(seconds, (warmup_sizes[candlesize] + 1) * CANDLESIZE_SECONDS.get(candlesize, 60))
+
+    if seconds == 0:
+        return
+
+    history = await load_history(tradepair, seconds)
+    logging.info('Loaded %s historical candles for warmup of deployment %s' % (len(history), did))
+
+    for candlesize, warmup_size in warmup_sizes.items():
+        if warmup_size == 0:
+            continue
+
+        # candles are combined same way as the live ones, incomplete latest candle is not released
+        candles = []
+        candle_per_size_per_key = {}
+        for candle in history:
+            released = aggregate_candle(candle_per_size_per_key, candlesize, candle)
+            if released:
+                candles += [released]
+        candles = candles[-warmup_size:]
+
+        shared_values = indicator_registry.warmup(tradepair, candlesize, candles)
+        strategy._warmup(candles, shared_values, candlesize)
+
+
+class TimerWheel(object):
+    """
+    Hashed timer wheel. Timer is put into the slot in which it expires, timers that are further away than one turn of
+    the wheel wait there for the required number of turns. Scheduling and expiring a timer is constant time
+    irrespective of the number of timers.
+    """
+
+    def __init__(self, num_slots=60):
+        self.slots = [[] for _ in range(num_slots)]
+        self.current = 0
+        self.count = 0
+
+    def schedule(self, ticks, item):
+        """
+        :param ticks: number of ticks after which item expires, minimum 1
+        """
+        ticks = max(1, int(ticks))
+        num_slots = len(self.slots)
+        slot = (self.current + ticks) % num_slots
+        rounds = (ticks - 1) // num_slots
+        self.slots[slot] += [[rounds, item]]
+        self.count += 1
+
+    def advance(self):
+        """
+        Moves the wheel by one tick.
+        :return: items that are expired
+        """
+        self.current = (self.current + 1) % len(self.slots)
+
+        expired = []
+        pending = []
+        for timer in self.slots[self.current]:
+            if timer[0] > 0:
+                timer[0] -= 1
+                pending += [timer]
+            else:
+                expired += [timer[1]]
+        self.slots[self.current] = pending
+        self.count -= len(expired)
+
+        return expired
+
+
+class StrategyScheduler(object):
+    """
+    Executes all the deployed strategies of the engine. Strategy is executed as soon as new candle arrives for its
+    trade pair and candle size, strategies with EXECUTE_INTERVAL are additionally executed by single shared timer.
+    """
+
+    def __init__(self, loop, advice_pipeline, tick=1):
+        self.loop = loop
+        self.advice_pipeline = advice_pipeline
+        self.tick = tick
+        self.timers = TimerWheel()
+        self.timers_added = asyncio.Event(loop=loop)
+        # held while candles are passed to strategies, deployments take it to warmup without missing any candle
+        self.lock = asyncio.Lock(loop=loop)
+        # did -> (user_profile, algo, amount, num_cycles, strategy)
+        self.deployments = {}
+        # tradepair -> candlesize -> [did]
+        self.subscribers = {}
+
+    def add(self, user_profile, did, algo, amount, num_cycles, strategy):
+        deployment = (user_profile, algo, amount, num_cycles, strategy)
+        self.deployments[did] = deployment
+        # strategy gets candles of all the sizes it subscribed to on its trade pair
+        for candlesize in strategy.get_candlesizes():
+            self.subscribers.setdefault(algo.tradepair, {}).setdefault(candlesize, []).append(did)
+
+        if strategy.EXECUTE_INTERVAL:
+            self._schedule(did, deployment)
+
+    def remove(self, did):
+        if did not in self.deployments:
+            return
+        user_profile, algo, amount, num_cycles, strategy = self.deployments.pop(did)
+
+        # timers of removed deployment are dropped when they expire
+        candlesizes = self.subscribers[algo.tradepair]
+        for candlesize in strategy.get_candlesizes():
+            candlesizes[candlesize].remove(did)
+            if not candlesizes[candlesize]:
+                del candlesizes[candlesize]
+        if not candlesizes:
+            del self.subscribers[algo.tradepair]
+
+    def candlesizes(self, tradepair):
+        """ :return candle sizes used by the strategies deployed on trade pair, largest first """
+        if tradepair not in self.subscribers:
+            return []
+        sizes = Candle.VALID_CANDLE_SIZES
+        return sorted(self.subscribers[tradepair].keys(), reverse=True,
+                      key=lambda candlesize: sizes.index(candlesize) if candlesize in sizes else -1)
+
+    def _schedule(self, did, deployment):
+        strategy = deployment[4]
+        self.timers.schedule(float(strategy.EXECUTE_INTERVAL) / self.tick, (did, deployment))
+        self.timers_added.set()
+
+    async def _execute(self, did, deployment):
+        user_profile, algo, amount, num_cycles, strategy = deployment
+        try:
+            advice = strategy._execute()
+        except:
+            logging.exception('Error occurred while executing strategy of deployment %s' % did)
+            return
+
+        if advice:
+            logging.info('Got new advice %s from strategy of deployment %s' % (advice, did))
+            await self.advice_pipeline.put(TradeAdvice(user_profile, did, algo.tradepair, advice, amount, num_cycles))
+
+    async def on_candle(self, tradepair, candlesize, candle, shared_values):
+        """
+        Passes released candle to all the strategies deployed on trade pair and candle size and executes them.
+        """
+        if tradepair not in self.subscribers or candlesize not in self.subscribers[tradepair]:
+            return
+
+        for did in list(self.subscribers[tradepair][candlesize]):
+            deployment = self.deployments[did]
+            try:
+                if not deployment[4]._on_candle(candle, shared_values, candlesize):
+                    continue
+            except:
+                logging.exception('Error occurred while processing candle in strategy of deployment %s' % did)
+                continue
+            await self._execute(did, deployment)
+
+    async def run(self):
+        while True:
+            if self.timers.count == 0:
+                # nothing to execute periodically, sleep till strategy with timer gets deployed
+                self.timers_added.clear()
+                await self.timers_added.wait()
+
+            await asyncio.sleep(self.tick, loop=self.loop)
+
+            for did, deployment in self.timers.advance():
+                # deployment could be removed (or redeployed) after timer was scheduled
+                if self.deployments.get(did) is not deployment:
+                    continue
+                await self._execute(did, deployment)
+                if self.deployments.get(did) is deployment:
+                    self._schedule(did, deployment)
 
 
-async def candle_consumer(candle_pipeline, strategy_candle_pipelines):
+async def candle_consumer(candle_pipeline, scheduler, indicator_registry):
     candle_per_size_per_key = {
         Candle.CANDLESIZE_5MIN: {},
         Candle.CANDLESIZE_15MIN: {},
@@ -58,39 +269,29 @@ async def candle_consumer(candle_pipeline, strategy_candle_pipelines):
     while True:
         candle = await candle_pipeline.get()
         logging.info('Processing candle %s in engine' % candle.key)
-        if candle.key in strategy_candle_pipelines:
-            for candlesize, pipe in strategy_candle_pipelines[candle.key]:
-                # since min candle generation frequency in fetcher is 1min, why bother
-                # comparing it to other candles
-                if candlesize == Candle.CANDLESIZE_1MIN:
-                    await pipe.put(candle)
+
+        # candle of each size is aggregated and indicators on it are computed only once
+        # irrespective of the number of strategies using it. Larger candles are released first, so that
+        # strategies using multiple candle sizes see updated trend when they are executed on the smaller ones
+        async with scheduler.lock:
+            for candlesize in scheduler.candlesizes(candle.key):
+                released = aggregate_candle(candle_per_size_per_key, candlesize, candle)
+                if not released:
                     continue
 
-                if candle.key in candle_per_size_per_key[candlesize]:
-                    old_candle = candle_per_size_per_key[candlesize][candle.key]
-                    # check whether its same candle, if yes then combine otherwise
-                    # release the old candle and start combining current candle with future candles
-                    if old_candle.is_same_candle(candle.c_date, candlesize):
-                        old_candle.c_close = candle.c_close
-                        old_candle.c_high = candle.c_high if candle.c_high > old_candle.c_high else old_candle.c_high
-                        old_candle.c_low = candle.c_low if candle.c_low < old_candle.c_low else old_candle.c_low
-                        old_candle.c_base_volume += float(candle.c_base_volume)
-                        old_candle.c_counter_volume += float(candle.c_counter_volume)
-                    else:
-                        # current candle is new candle, hence release the old candle
-                        # todo: can be improved. Now old candle only get expired when new candle arrives
-                        candle_per_size_per_key[candlesize][candle.key] = candle
-                        logging.debug('Releasing candle of size = %s for tradepair = %s' % (candlesize, candle.key))
-                        await pipe.put(old_candle)
-                else:
-                    candle_per_size_per_key[candlesize][candle.key] = candle
+                shared_values = indicator_registry.process_candle(candle.key, candlesize, released)
+                await scheduler.on_candle(candle.key, candlesize, released, shared_values)
 
 
 async def run_engine(loop, engine_pipeline, candle_pipeline, advice_pipeline):
-    strategy_candle_pipelines = {}
+    indicator_registry = IndicatorRegistry()
+    scheduler = StrategyScheduler(loop, advice_pipeline)
+
+    logging.info('Starting strategy scheduler')
+    asyncio.ensure_future(scheduler.run(), loop=loop)
 
     logging.info('Starting candle consumer')
-    asyncio.ensure_future(candle_consumer(candle_pipeline, strategy_candle_pipelines), loop=loop)
+    asyncio.ensure_future(candle_consumer(candle_pipeline, scheduler, indicator_registry), loop=loop)
 
     while True:
         logging.debug('Waiting for engine command')
@@ -107,60 +308,54 @@ async def run_engine(loop, engine_pipeline, candle_pipeline, advice_pipeline):
             logging.info('Got new deploy command user=%s did=%s algo=%s amount=%s cycles=%s' %
                          (user_profile.userid, did, algo, amount, num_cycles))
 
-            st_candle_pipe = asyncio.Queue(loop=loop)
-            st_advice_pipe = asyncio.Queue(loop=loop)
-
-            candle_pipe = (algo.candlesize, st_candle_pipe)
-            if algo.tradepair in strategy_candle_pipelines:
-                strategy_candle_pipelines[algo.tradepair] += [candle_pipe]
-            else:
-                strategy_candle_pipelines[algo.tradepair] = [candle_pipe]
-
-            async def strategy_to_advice(user_profile_, did_, tradepair_, amount_, num_cycles_, st_pipe, main_pipe):
-                while True:
-                    advice = await st_pipe.get()
-                    await main_pipe.put(TradeAdvice(user_profile_, did_, tradepair_, advice, amount_, num_cycles_))
-
-            try:
-                strategy_coro = strategy_coroutine_factory[algo.strategyname](
-                    did, algo.parameters, st_candle_pipe, st_advice_pipe)
-            except:
-                logging.exception('Error occurred while instantiating strategy')
+            # strategy subscribes its shared indicators while it is instantiated, subscription and warmup are done
+            # under the scheduler lock so that no live candle is processed by an indicator before its warmup
+            async with scheduler.lock:
+                shared_indicators = IndicatorSubscription(indicator_registry, algo.tradepair, algo.candlesize)
+                try:
+                    # instantiate strategy instance and supply parameters for it to execute
+                    strategy = strategy_factory[algo.strategyname](did, algo.parameters, shared_indicators,
+                                                                   algo.candlesize)
+                except:
+                    logging.exception('Error occurred while instantiating strategy')
+
+                    # revert changes and change status to error
+                    shared_indicators.close()
+                    try:
+                        await update_deployed_status(did, DeployedAlgo.STATUS_ERROR)
+                    except:
+                        logging.exception('Error occurred while updating db')
+                    continue
 
-                # revert changes and change status to error
-                strategy_candle_pipelines[algo.tradepair].remove(candle_pipe)
                 try:
-                    await update_deployed_status(did, DeployedAlgo.STATUS_ERROR)
+                    await update_deployed_status(did, DeployedAlgo.STATUS_RUNNING)
                 except:
                     logging.exception('Error occurred while updating db')
-                continue
+                    shared_indicators.close()
+                    continue
 
-            try:
-                await update_deployed_status(did, DeployedAlgo.STATUS_RUNNING)
-            except:
-                logging.exception('Error occurred while updating db')
-                continue
+                try:
+                    await warmup_strategy(did, algo.tradepair, strategy, indicator_registry)
+                except:
+                    # strategy still works, but needs to wait for live candles till indicators are ready
+                    logging.exception('Error occurred while loading history for deployment %s' % did)
 
-            s2a = asyncio.ensure_future(strategy_to_advice(
-                user_profile, did, algo.tradepair, amount, num_cycles, st_advice_pipe, advice_pipeline), loop=loop)
-            # instantiate strategy instance and supply parameters for it to execute
-            st = asyncio.ensure_future(strategy_coro, loop=loop)
+                scheduler.add(user_profile, did, algo, amount, num_cycles, strategy)
 
             logging.debug('Algo deployed user=%s did=%s algo=%s amount=%s cycles=%s' %
                           (user_profile.userid, did, algo, amount, num_cycles))
 
-            await put_deployment(did, algo, st, candle_pipe, s2a)
+            await put_deployment(did, algo, strategy, shared_indicators)
         elif cmd_code == Engine.COMMAND_UNDEPLOY or cmd_code == Engine.COMMAND_STOP or cmd_code == Engine.COMMAND_DONE:
             did = cmd[1]
-            algo, st, candle_pipe, s2a = await get_deployment(did)
+            algo, strategy, shared_indicators = await get_deployment(did)
 
             logging.info('Got command to stop deployed algo did=%s algo=%s' % (did, algo))
 
             try:
-                strategy_candle_pipelines[algo.tradepair].remove(candle_pipe)
-
-                st.cancel()
-                s2a.cancel()
+                scheduler.remove(did)
+                # release indicators that are not used by any other strategy
+                shared_indicators.close()
 
                 if cmd_code == Engine.COMMAND_UNDEPLOY:
                     await update_deployed_status(did, DeployedAlgo.STATUS_STOPPED)
@@ -325,6 +520,10 @@ if __name__ == '__main__':
             backtest_db = dbconfig['connection_backtest']
     set_db(main_db, backtest_db)
 
+    if 'notify' in config:
+        notifyconfig = config['notify']
+        set_notify_sockets(notifyconfig.get('backtester_socket', None), notifyconfig.get('webapp_socket', None))
+
     logging.info('RestApi is configured to run on %s:%s' % (host, port))
 
     logging.info('Starting webapp')
@@ -11,7 +11,9 @@ import time
 import stellar
 import yaml
 
+from stardust.archive import CandleArchive
 from stardust.data import Candle, set_db, get_backtest_db
+from stardust.rollup import create_rollup_table, update_rollups
 
 
 def perform_recovery():
@@ -145,6 +147,19 @@ if __name__ == '__main__':
         if 'fetch_wait' in importerconfig:
             fetchwait = importerconfig['fetch_wait']
 
+    db_conn = sqlite3.connect(get_backtest_db())
+    create_rollup_table(db_conn)
+    db_conn.close()
+
+    archive = None
+    if 'archive' in config and 'path' in config['archive']:
+        # backtester loads numpy and the strategies, needed only with archive
+        from stardust.backtester import SdexHistory
+
+        logging.info('Syncing candle archive %s' % config['archive']['path'])
+        archive = CandleArchive(config['archive']['path'])
+        archive_history = SdexHistory(sdex_db=get_backtest_db()).init()
+
     start_cursor, unprocessed_candles = perform_recovery()
     if not start_cursor:
         start_cursor = start_cursor_
@@ -207,6 +222,7 @@ if __name__ == '__main__':
                     'INSERT INTO SDEX_OHLCV(TRADE_PAIR, TS, YEAR, MONTH, WEEK, DAY, HOUR4, HOUR, MINUTE15, MINUTE5, MINUTE,\
                     OPEN, HIGH, LOW, CLOSE, BASE_VOLUME, COUNTER_VOLUME) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)',
                     data)
+                update_rollups(c, [(row[0], row[1]) for row in data])
 
                 c.execute('UPDATE state SET value = ? WHERE key = ?', (e.paging_token, 'LAST_HANDLED_TRADE'))
                 if c.rowcount == 0:
@@ -224,9 +240,18 @@ if __name__ == '__main__':
                 c.execute('ROLLBACK')
 
                 logging.exception('Error occurred while persisting to DB');
+                data = []
 
             conn.close()
 
+        if archive and len(data) > 0:
+            for key in set([row[0] for row in data]):
+                try:
+                    archive.sync_all(archive_history, key)
+                except:
+                    # archive is synced again with next candles of the trade pair
+                    logging.exception('Error occurred while archiving candles of %s' % key)
+
         try:
             logging.info('Sleeping for %s sec' % fetchwait)
             time.sleep(fetchwait)
@@ -1,7 +1,82 @@
 # https://mrjbq7.github.io/ta-lib/doc_index.html
+import numbers
 
+import numpy as np
 from talib import abstract as talib
 
+# default values and positional order of the parameters of each indicator,
+# parameters with default value None are mandatory
+PARAMETERS = {
+    'BBANDS': ({'timeperiod': 5, 'nbdevup': 2, 'nbdevdn': 2, 'matype': 0},
+               ['timeperiod', 'nbdevup', 'nbdevdn', 'matype']),
+    'DEMA': ({'timeperiod': 30}, ['timeperiod']),
+    'EMA': ({'timeperiod': 30}, ['timeperiod']),
+    'HT_TRENDLINE': ({}, []),
+    'KAMA': ({'timeperiod': 30}, ['timeperiod']),
+    'MA': ({'timeperiod': 30, 'matype': 0}, ['timeperiod', 'matype']),
+    'MAMA': ({'fastlimit': 0, 'slowlimit': 0}, ['fastlimit', 'slowlimit']),
+    'MAVP': ({'periods': None, 'minperiod': 2, 'maxperiod': 30, 'matype': 0},
+             ['periods', 'minperiod', 'maxperiod', 'matype']),
+    'MIDPOINT': ({'timeperiod': 14}, ['timeperiod']),
+    'MIDPRICE': ({'timeperiod': 14}, ['timeperiod']),
+    'SAR': ({'acceleration': 0, 'maximum': 0}, ['acceleration', 'maximum']),
+    'SAREXT': ({'startvalue': 0, 'offsetonreverse': 0, 'accelerationinitlong': 0, 'accelerationlong': 0,
+                'accelerationmaxlong': 0, 'accelerationinitshort': 0, 'accelerationshort': 0,
+                'accelerationmaxshort': 0},
+               ['startvalue', 'offsetonreverse', 'accelerationinitlong', 'accelerationlong', 'accelerationmaxlong',
+                'accelerationinitshort', 'accelerationshort', 'accelerationmaxshort']),
+    'SMA': ({'timeperiod': 30}, ['timeperiod']),
+    'T3': ({'timeperiod': 5, 'vfactor': 0}, ['timeperiod', 'vfactor']),
+    'TEMA': ({'timeperiod': 30}, ['timeperiod']),
+    'TRIMA': ({'timeperiod': 30}, ['timeperiod']),
+    'WMA': ({'timeperiod': 30}, ['timeperiod']),
+    'MACD': ({'fastperiod': 12, 'slowperiod': 26, 'signalperiod': 9}, ['fastperiod', 'slowperiod', 'signalperiod']),
+}
+
+PARAM_INTEGER = 'integer'
+PARAM_REAL = 'real'
+PARAM_ARRAY = 'array'
+
+_INTEGER_MAX = 100000
+_REAL_MAX = 3e37
+
+# type and allowed range of the parameters as defined in TA-Lib
+PARAMETER_RANGES = {
+    'timeperiod': (PARAM_INTEGER, 2, _INTEGER_MAX),
+    'fastperiod': (PARAM_INTEGER, 2, _INTEGER_MAX),
+    'slowperiod': (PARAM_INTEGER, 2, _INTEGER_MAX),
+    'signalperiod': (PARAM_INTEGER, 1, _INTEGER_MAX),
+    'minperiod': (PARAM_INTEGER, 2, _INTEGER_MAX),
+    'maxperiod': (PARAM_INTEGER, 2, _INTEGER_MAX),
+    'matype': (PARAM_INTEGER, 0, 8),
+    'nbdevup': (PARAM_REAL, -_REAL_MAX, _REAL_MAX),
+    'nbdevdn': (PARAM_REAL, -_REAL_MAX, _REAL_MAX),
+    'fastlimit': (PARAM_REAL, 0.01, 0.99),
+    'slowlimit': (PARAM_REAL, 0.01, 0.99),
+    'vfactor': (PARAM_REAL, 0, 1),
+    'acceleration': (PARAM_REAL, 0, _REAL_MAX),
+    'maximum': (PARAM_REAL, 0, _REAL_MAX),
+    'startvalue': (PARAM_REAL, -_REAL_MAX, _REAL_MAX),
+    'offsetonreverse': (PARAM_REAL, 0, _REAL_MAX),
+    'accelerationinitlong': (PARAM_REAL, 0, _REAL_MAX),
+    'accelerationlong': (PARAM_REAL, 0, _REAL_MAX),
+    'accelerationmaxlong': (PARAM_REAL, 0, _REAL_MAX),
+    'accelerationinitshort': (PARAM_REAL, 0, _REAL_MAX),
+    'accelerationshort': (PARAM_REAL, 0, _REAL_MAX),
+    'accelerationmaxshort': (PARAM_REAL, 0, _REAL_MAX),
+    'periods': (PARAM_ARRAY, None, None),
+}
+
+# indicators which allow different range than the common one
+PARAMETER_RANGES_OVERRIDE = {
+    ('MA', 'timeperiod'): (PARAM_INTEGER, 1, _INTEGER_MAX),
+}
+
+_schemas = {}
+
+_validated = {}
+_VALIDATED_MAX = 100000
+
 
 def _get_params(kw, defvals, order):
     r = []
@@ -16,6 +91,108 @@ def _get_params(kw, defvals, order):
     return r
 
 
+def get_params(itype, kw):
+    """
+    :return parameter values of the indicator in positional order, defaults are used for missing ones. Integer values
+    of the real parameters are converted to float, as TA-Lib expects.
+    """
+    defvals, order = PARAMETERS[itype]
+    values = _get_params(kw, defvals, order)
+    for i, (name, ptype, pmin, pmax, default, mandatory) in enumerate(get_schema(itype)):
+        v = values[i]
+        if ptype == PARAM_REAL and isinstance(v, numbers.Integral) and not isinstance(v, bool):
+            values[i] = float(v)
+    return values
+
+
+def get_named_params(itype, kw):
+    """ :return dict of parameter values of the indicator, defaults are used for missing ones and others are ignored """
+    return dict(zip(PARAMETERS[itype][1], get_params(itype, kw)))
+
+
+def get_schema(itype):
+    """
+    :return list of (name, type, min, max, default, mandatory) for each parameter of the indicator in positional order
+    """
+    if itype in _schemas:
+        return _schemas[itype]
+
+    defvals, order = PARAMETERS[itype]
+    schema = []
+    for k in order:
+        ptype, pmin, pmax = PARAMETER_RANGES_OVERRIDE.get((itype, k), PARAMETER_RANGES[k])
+        schema += [(k, ptype, pmin, pmax, defvals[k], defvals[k] is None)]
+    _schemas[itype] = schema
+
+    return schema
+
+
+def _check_param(name, ptype, pmin, pmax, v):
+    if ptype == PARAM_ARRAY:
+        if not isinstance(v, (np.ndarray, list, tuple)):
+            return 'Parameter %s should be an array, got %s' % (name, type(v).__name__)
+        return None
+
+    if isinstance(v, bool):
+        return 'Parameter %s should be %s, got bool' % (name, ptype)
+    if ptype == PARAM_INTEGER and not isinstance(v, numbers.Integral):
+        return 'Parameter %s should be integer, got %s' % (name, type(v).__name__)
+    if ptype == PARAM_REAL and not isinstance(v, numbers.Real):
+        return 'Parameter %s should be real, got %s' % (name, type(v).__name__)
+    if v < pmin or v > pmax:
+        return 'Parameter %s = %s out of range [%s, %s]' % (name, v, pmin, pmax)
+
+    return None
+
+
+def validate_params(itype, kw):
+    """
+    Validates parameters of the indicator against its schema, results are memoized per indicator and parameters.
+    Parameters which are not used by the indicator are ignored. Throws exception if parameters are not valid.
+    """
+    if itype not in PARAMETERS:
+        raise Exception('Indicator not found = %s' % itype)
+
+    values = get_params(itype, kw)
+    try:
+        # type is a part of the key, as True == 1 and False == 0 would share the result of validation
+        key = (itype, tuple((type(v), v) for v in values))
+        hash(key)
+    except TypeError:
+        # array parameters can not be memoized
+        key = None
+
+    if key is not None and key in _validated:
+        error = _validated[key]
+    else:
+        error = None
+        for (name, ptype, pmin, pmax, default, mandatory), v in zip(get_schema(itype), values):
+            error = _check_param(name, ptype, pmin, pmax, v)
+            if error:
+                break
+
+        if key is not None:
+            if len(_validated) >= _VALIDATED_MAX:
+                _validated.clear()
+            _validated[key] = error
+
+    if error:
+        raise Exception(error)
+
+
+def get_lookback(itype, kw):
+    """ :return number of candles TA-Lib needs before it outputs first value of the indicator """
+    order = PARAMETERS[itype][1]
+    func = talib.Function(itype)
+    params = {}
+    for k, v in zip(order, get_params(itype, kw)):
+        # some of the parameters (e.g. periods of MAVP) are input arrays for TA-Lib
+        if k in func.parameters:
+            params[k] = v
+    func.set_parameters(params)
+    return func.lookback
+
+
 def get_all_indicators():
     return {
         'BBANDS': BBANDS,
@@ -41,8 +218,7 @@ def get_all_indicators():
 
 def BBANDS(ohlcv, kw):
     """ :return Bollinger Bands (upperband, middleband, lowerband) """
-    params = {'timeperiod': 5, 'nbdevup': 2, 'nbdevdn': 2, 'matype': 0}
-    timeperiod, nbdevup, nbdevdn, matype = _get_params(kw, params, ['timeperiod', 'nbdevup', 'nbdevdn', 'matype'])
+    timeperiod, nbdevup, nbdevdn, matype = get_params('BBANDS', kw)
     result = talib.BBANDS(ohlcv, timeperiod, nbdevup, nbdevdn, matype)
     return {
         'upperband': result[0],
@@ -53,8 +229,7 @@ def BBANDS(ohlcv, kw):
 
 def DEMA(ohlcv, kw):
     """ :return Double Exponential Moving Average (dema) """
-    params = {'timeperiod': 30}
-    timeperiod = _get_params(kw, params, ['timeperiod'])[0]
+    timeperiod = get_params('DEMA', kw)[0]
     result = talib.DEMA(ohlcv, timeperiod)
     return {
         'dema': result
@@ -63,8 +238,7 @@ def DEMA(ohlcv, kw):
 
 def EMA(ohlcv, kw):
     """ :return  Exponential Moving Average (ema) """
-    params = {'timeperiod': 30}
-    timeperiod = _get_params(kw, params, ['timeperiod'])[0]
+    timeperiod = get_params('EMA', kw)[0]
     result = talib.EMA(ohlcv, timeperiod)
     return {
         'ema': result
@@ -81,8 +255,7 @@ def HT_TRENDLINE(ohlcv, kw):
 
 def KAMA(ohlcv, kw):
     """ :return Kaufman Adaptive Moving Average (kama) """
-    params = {'timeperiod': 30}
-    timeperiod = _get_params(kw, params, ['timeperiod'])[0]
+    timeperiod = get_params('KAMA', kw)[0]
     result = talib.KAMA(ohlcv, timeperiod)
     return {
         'kama': result
@@ -91,8 +264,7 @@ def KAMA(ohlcv, kw):
 
 def MA(ohlcv, kw):
     """ :return Moving Average (ma) """
-    params = {'timeperiod': 30, 'matype': 0}
-    timeperiod, matype = _get_params(kw, params, ['timeperiod', 'matype'])
+    timeperiod, matype = get_params('MA', kw)
     result = talib.MA(ohlcv, timeperiod, matype)
     return {
         'ma': result
@@ -101,8 +273,7 @@ def MA(ohlcv, kw):
 
 def MAMA(ohlcv, kw):
     """ :return MESA Adaptive Moving Average (mama, fama) """
-    params = {'fastlimit': 0, 'slowlimit': 0}
-    fastlimit, slowlimit = _get_params(kw, params, ['fastlimit', 'slowlimit'])
+    fastlimit, slowlimit = get_params('MAMA', kw)
     result = talib.MAMA(ohlcv, fastlimit, slowlimit)
     return {
         'mama': result[0],
@@ -112,8 +283,7 @@ def MAMA(ohlcv, kw):
 
 def MAVP(ohlcv, kw):
     """ :return Moving average with variable period (mavp) """
-    params = {'periods': None, 'minperiod': 2, 'maxperiod': 30, 'matype': 0}
-    periods, minperiod, maxperiod, matype = _get_params(kw, params, ['periods', 'minperiod', 'maxperiod', 'matype'])
+    periods, minperiod, maxperiod, matype = get_params('MAVP', kw)
     result = talib.MAVP(ohlcv, periods, minperiod, maxperiod, matype)
     return {
         'mavp': result
@@ -122,8 +292,7 @@ def MAVP(ohlcv, kw):
 
 def MIDPOINT(ohlcv, kw):
     """ :return MidPoint over period (midpoint) """
-    params = {'timeperiod': 14}
-    timeperiod = _get_params(kw, params, ['timeperiod'])[0]
+    timeperiod = get_params('MIDPOINT', kw)[0]
     result = talib.MIDPOINT(ohlcv, timeperiod)
     return {
         'midpoint': result
@@ -132,8 +301,7 @@ def MIDPOINT(ohlcv, kw):
 
 def MIDPRICE(ohlcv, kw):
     """ :return Midpoint Price over period (midprice) """
-    params = {'timeperiod': 14}
-    timeperiod = _get_params(kw, params, ['timeperiod'])[0]
+    timeperiod = get_params('MIDPRICE', kw)[0]
     result = talib.MIDPRICE(ohlcv, timeperiod)
     return {
         'midprice': result
@@ -142,8 +310,7 @@ def MIDPRICE(ohlcv, kw):
 
 def SAR(ohlcv, kw):
     """ :return Parabolic SAR (sar) """
-    params = {'acceleration': 0, 'maximum': 0}
-    acceleration, maximum = _get_params(kw, params, ['acceleration', 'maximum'])
+    acceleration, maximum = get_params('SAR', kw)
     result = talib.SAR(ohlcv, acceleration, maximum)
     return {
         'sar': result,
@@ -152,11 +319,8 @@ def SAR(ohlcv, kw):
 
 def SAREXT(ohlcv, kw):
     """ :return Parabolic SAR - Extended (sarext) """
-    params = {'startvalue': 0, 'offsetonreverse': 0, 'accelerationinitlong': 0, 'accelerationlong': 0,
-              'accelerationmaxlong': 0, 'accelerationinitshort': 0, 'accelerationshort': 0, 'accelerationmaxshort': 0}
-    startvalue, offsetonreverse, accelerationinitlong, accelerationlong, accelerationmaxlong, accelerationinitshort, accelerationshort, accelerationmaxshort = _get_params(
-        kw, params, ['startvalue', 'offsetonreverse', 'accelerationinitlong', 'accelerationlong', 'accelerationmaxlong',
-                     'accelerationinitshort', 'accelerationshort', 'accelerationmaxshort'])
+    startvalue, offsetonreverse, accelerationinitlong, accelerationlong, accelerationmaxlong, accelerationinitshort, accelerationshort, accelerationmaxshort = get_params(
+        'SAREXT', kw)
     result = talib.SAREXT(ohlcv, startvalue, offsetonreverse, accelerationinitlong, accelerationlong,
                           accelerationmaxlong, accelerationinitshort, accelerationshort, accelerationmaxshort)
     return {
@@ -166,8 +330,7 @@ def SAREXT(ohlcv, kw):
 
 def SMA(ohlcv, kw):
     """ :return Simple Moving Average (sma) """
-    params = {'timeperiod': 30}
-    timeperiod = _get_params(kw, params, ['timeperiod'])[0]
+    timeperiod = get_params('SMA', kw)[0]
     result = talib.SMA(ohlcv, timeperiod)
     return {
         'sma': result
@@ -176,8 +339,7 @@ def SMA(ohlcv, kw):
 
 def T3(ohlcv, kw):
     """ :return Triple Exponential Moving Average (t3) """
-    params = {'timeperiod': 5, 'vfactor': 0}
-    timeperiod, vfactor = _get_params(kw, params, ['timeperiod', 'vfactor'])
+    timeperiod, vfactor = get_params('T3', kw)
     result = talib.T3(ohlcv, timeperiod, vfactor)
     return {
         't3': result
@@ -186,8 +348,7 @@ def T3(ohlcv, kw):
 
 def TEMA(ohlcv, kw):
     """ :return Triple Exponential Moving Average (tema) """
-    params = {'timeperiod': 30}
-    timeperiod = _get_params(kw, params, ['timeperiod'])[0]
+    timeperiod = get_params('TEMA', kw)[0]
     result = talib.TEMA(ohlcv, timeperiod)
     return {
         'tema': result
@@ -196,8 +357,7 @@ def TEMA(ohlcv, kw):
 
 def TRIMA(ohlcv, kw):
     """ :return Triangular Moving Average (trima) """
-    params = {'timeperiod': 30}
-    timeperiod = _get_params(kw, params, ['timeperiod'])[0]
+    timeperiod = get_params('TRIMA', kw)[0]
     result = talib.TRIMA(ohlcv, timeperiod)
     return {
         'trima': result
@@ -206,8 +366,7 @@ def TRIMA(ohlcv, kw):
 
 def WMA(ohlcv, kw):
     """ :return Weighted Moving Average (wma) """
-    params = {'timeperiod': 30}
-    timeperiod = _get_params(kw, params, ['timeperiod'])[0]
+    timeperiod = get_params('WMA', kw)[0]
     result = talib.WMA(ohlcv, timeperiod)
     return {
         'wma': result
@@ -216,8 +375,7 @@ def WMA(ohlcv, kw):
 
 def MACD(ohlcv, kw):
     """ :return Moving Average Convergence/Divergence (macd, macdsignal, macdhist =) """
-    params = {'fastperiod': 12, 'slowperiod': 26, 'signalperiod': 9}
-    fastperiod, slowperiod, signalperiod = _get_params(kw, params, ['fastperiod', 'slowperiod', 'signalperiod'])
+    fastperiod, slowperiod, signalperiod = get_params('MACD', kw)
     result = talib.MACD(ohlcv, fastperiod, slowperiod, signalperiod)
     return {
         'macd': result[0],
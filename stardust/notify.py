@@ -0,0 +1,75 @@
+# Notifications between webapp and backtester over local unix datagram sockets.
+#
+# Webapp notifies backtester when it adds a backtest request and backtester notifies webapp when status of a backtest
+# changes, message is the id of the backtest. Notifications are best effort: they are dropped when the other side is
+# not running or its socket buffer is full, hence both sides still poll the database, only less often.
+
+import logging
+import os
+import select
+import socket
+
+_backtester_socket = None
+_webapp_socket = None
+
+
+def set_notify_sockets(backtester_socket, webapp_socket):
+    global _backtester_socket, _webapp_socket
+    _backtester_socket = backtester_socket
+    _webapp_socket = webapp_socket
+
+
+def get_backtester_socket():
+    return _backtester_socket
+
+
+def get_webapp_socket():
+    return _webapp_socket
+
+
+def bind(path):
+    """
+    :return: non-blocking unix datagram socket bound to path, socket file left by earlier process is replaced
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    sock.bind(path)
+    return sock
+
+
+def _notify(path, bid):
+    if not path:
+        return False
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.setblocking(False)
+            sock.sendto(str(bid).encode(), path)
+        return True
+    except OSError as e:
+        # nobody is listening or it is busy, it finds out from the database
+        logging.debug('Cannot notify %s about backtest %s: %s' % (path, bid, e))
+        return False
+
+
+def notify_backtester(bid):
+    return _notify(_backtester_socket, bid)
+
+
+def notify_webapp(bid):
+    return _notify(_webapp_socket, bid)
+
+
+def wait(sock, timeout):
+    """
+    Waits for a notification on socket returned by bind.
+    :return: id of the notified backtest, None on timeout or if another process sharing the socket got it first
+    """
+    readable, _, _ = select.select([sock], [], [], timeout)
+    if not readable:
+        return None
+    try:
+        return int(sock.recv(64))
+    except (BlockingIOError, ValueError):
+        return None
@@ -0,0 +1,63 @@
+import numpy as np
+
+
+class OhlcvBuffer(object):
+    """
+    Fixed capacity candle history kept in preallocated numpy arrays. Once the buffer is full, every new candle
+    overwrites the oldest one, so memory used by the history stays same irrespective of how long the strategy runs.
+
+    Every candle is written twice (at its slot and at slot + capacity), so that the latest candles are always
+    available as a contiguous slice of the underlying array and can be passed to TA-Lib without copying them.
+    Note that views returned by this buffer are only valid until the next candle is added.
+    """
+    COLUMNS = ('open', 'high', 'low', 'close', 'volume')
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.data = np.zeros((len(OhlcvBuffer.COLUMNS), 2 * capacity))
+        self.head = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, column):
+        start = self.head + self.capacity - self.size
+        return self.data[OhlcvBuffer.COLUMNS.index(column), start:self.head + self.capacity]
+
+    def append(self, candle):
+        values = (candle.c_open, candle.c_high, candle.c_low, candle.c_close, candle.c_base_volume)
+        self.data[:, self.head] = values
+        self.data[:, self.head + self.capacity] = values
+        self.head = (self.head + 1) % self.capacity
+        if self.size < self.capacity:
+            self.size += 1
+
+    def arrays(self):
+        """
+        :return: dict with (zero-copy) view of history for each of the open, high, low, close, volume
+        """
+        start = self.head + self.capacity - self.size
+        end = self.head + self.capacity
+        arrays = {}
+        for i, column in enumerate(OhlcvBuffer.COLUMNS):
+            arrays[column] = self.data[i, start:end]
+        return arrays
+
+    def resize(self, capacity):
+        """
+        Changes capacity of the buffer keeping the latest candles that fit in the new capacity.
+        """
+        if capacity == self.capacity:
+            return
+
+        size = min(self.size, capacity)
+        data = np.zeros((len(OhlcvBuffer.COLUMNS), 2 * capacity))
+        end = self.head + self.capacity
+        data[:, :size] = self.data[:, end - size:end]
+        data[:, capacity:capacity + size] = data[:, :size]
+
+        self.data = data
+        self.capacity = capacity
+        self.head = size % capacity
+        self.size = size
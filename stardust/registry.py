@@ -0,0 +1,191 @@
+import json
+import logging
+
+import numpy as np
+
+import stardust.indicators as ind
+import stardust.streaming as streaming
+from stardust.data import Candle
+from stardust.ohlcv import OhlcvBuffer
+from stardust.strategy import BaseTradingStrategy
+
+
+class SharedIndicator(object):
+    def __init__(self, itype, parameters):
+        self.itype = itype
+        self.parameters = parameters
+        self.stream = streaming.create_streaming_indicator(itype, parameters)
+        self.lookback = ind.get_lookback(itype, parameters)
+        self.refcount = 0
+        # latest values of the indicator, empty till indicator processes first candle
+        self.values = {}
+        self.ready = False
+
+    def update(self, candle, arrays):
+        """
+        Updates the indicator with the candle that is already added to the history.
+        :param arrays: history of the channel, see OhlcvBuffer.arrays
+        """
+        values = {}
+        if self.stream:
+            for param_name, lastval in self.stream.update(candle).items():
+                values[param_name] = None if lastval == np.nan else lastval
+        else:
+            output = ind.get_all_indicators()[self.itype](arrays, self.parameters)
+            for param_name, param_val in output.items():
+                lastval = param_val[len(param_val) - 1]
+                values[param_name] = None if lastval == np.nan else lastval
+        self.values = values
+        self.ready = True
+        return values
+
+
+class Channel(object):
+    def __init__(self):
+        self.ohlcv = OhlcvBuffer(BaseTradingStrategy.CANDLE_HISTORY_MIN)
+        # key -> SharedIndicator
+        self.indicators = {}
+        # date of the latest candle in the history
+        self.last_date = None
+
+
+class IndicatorRegistry(object):
+    """
+    Engine wide registry of indicators. Indicators are shared by all the strategies running on same trade pair and
+    candle size, so that each unique indicator (same type and parameters) is computed only once per candle
+    irrespective of the number of strategies using it. Subscriptions are reference counted and indicator is removed
+    once the last strategy using it unsubscribes.
+    """
+
+    def __init__(self):
+        # (tradepair, candlesize) -> Channel
+        self.channels = {}
+
+    @staticmethod
+    def normalize(itype, parameters):
+        """
+        :return: parameters of the indicator (with defaults for the missing ones) in canonical form, strategy
+        parameters that are not used by the indicator are ignored
+        """
+        return json.dumps(ind.get_named_params(itype, parameters), sort_keys=True)
+
+    def subscribe(self, tradepair, candlesize, itype, parameters):
+        """
+        :return: key of the shared indicator, values of the indicator are available under this key in the result of
+        process_candle
+        """
+        key = (tradepair, candlesize, itype, IndicatorRegistry.normalize(itype, parameters))
+
+        channel = (tradepair, candlesize)
+        if channel not in self.channels:
+            self.channels[channel] = Channel()
+        ohlcv, indicators = self.channels[channel].ohlcv, self.channels[channel].indicators
+
+        if key not in indicators:
+            logging.debug('Adding shared indicator %s' % (key,))
+            indicators[key] = SharedIndicator(itype, parameters)
+            if indicators[key].lookback + 1 > ohlcv.capacity:
+                ohlcv.resize(indicators[key].lookback + 1)
+        indicators[key].refcount += 1
+
+        return key
+
+    def unsubscribe(self, key):
+        channel = (key[0], key[1])
+        if channel not in self.channels:
+            return
+        indicators = self.channels[channel].indicators
+        if key not in indicators:
+            return
+
+        indicators[key].refcount -= 1
+        if indicators[key].refcount <= 0:
+            logging.debug('Removing shared indicator %s' % (key,))
+            del indicators[key]
+            if not indicators:
+                del self.channels[channel]
+
+    def process_candle(self, tradepair, candlesize, candle):
+        """
+        Computes all the indicators subscribed for trade pair and candle size with given candle.
+        :return: dict of indicator key -> latest values of the indicator
+        """
+        channel = (tradepair, candlesize)
+        if channel not in self.channels:
+            return {}
+        channel = self.channels[channel]
+
+        channel.ohlcv.append(candle)
+        channel.last_date = candle.c_date
+
+        result = {}
+        arrays = channel.ohlcv.arrays()
+        for key, indicator in channel.indicators.items():
+            result[key] = indicator.update(candle, arrays)
+
+        return result
+
+    def warmup(self, tradepair, candlesize, candles):
+        """
+        Brings indicators of trade pair and candle size up to date with historical candles. Candles which are not newer
+        than the ones already processed are ignored. Indicators which are added after channel started processing
+        candles are computed over the history of the channel.
+        :param candles: historical candles ordered by date
+        :return: dict of indicator key -> latest values of the indicator
+        """
+        channel = (tradepair, candlesize)
+        if channel not in self.channels:
+            return {}
+        channel = self.channels[channel]
+
+        if len(channel.ohlcv) > 0:
+            arrays = channel.ohlcv.arrays()
+            for key, indicator in channel.indicators.items():
+                if indicator.ready:
+                    continue
+
+                logging.debug('Computing shared indicator %s over history' % (key,))
+                if not indicator.stream:
+                    indicator.update(None, arrays)
+                    continue
+
+                for i in range(len(channel.ohlcv)):
+                    candle = Candle(tradepair)
+                    candle.c_open = float(arrays['open'][i])
+                    candle.c_high = float(arrays['high'][i])
+                    candle.c_low = float(arrays['low'][i])
+                    candle.c_close = float(arrays['close'][i])
+                    candle.c_base_volume = float(arrays['volume'][i])
+                    indicator.update(candle, None)
+
+        for candle in candles:
+            if channel.last_date is None or candle.c_date > channel.last_date:
+                self.process_candle(tradepair, candlesize, candle)
+
+        result = {}
+        for key, indicator in channel.indicators.items():
+            result[key] = indicator.values
+        return result
+
+
+class IndicatorSubscription(object):
+    """
+    Subscriptions of single deployed strategy to the shared indicators of one trade pair. Indicators are subscribed
+    on the candle size of the deployment unless strategy asks for another one.
+    """
+
+    def __init__(self, registry, tradepair, candlesize):
+        self.registry = registry
+        self.tradepair = tradepair
+        self.candlesize = candlesize
+        self.keys = []
+
+    def subscribe(self, itype, parameters, candlesize=None):
+        key = self.registry.subscribe(self.tradepair, candlesize or self.candlesize, itype, parameters)
+        self.keys += [key]
+        return key
+
+    def close(self):
+        for key in self.keys:
+            self.registry.unsubscribe(key)
+        self.keys = []
@@ -0,0 +1,221 @@
+# Rollups of the minute candles in SDEX_OHLCV into larger resolutions.
+#
+# Candles of every resolution are kept in SDEX_OHLCV_ROLLUP keyed by trade pair, resolution and start of the period
+# (ts). Each resolution is computed from the next smaller one (5min from minute candles, 15min from 5min and so on),
+# so that updating a candle only reads few smaller candles. Candles are always recomputed from the smaller ones instead
+# of being updated incrementally, hence rewriting a minute candle (ON CONFLICT REPLACE) gives the same result.
+
+import datetime
+import getopt
+import logging
+import os
+import sqlite3
+import sys
+
+import yaml
+
+from stardust.data import set_db, get_backtest_db
+
+# resolution, seconds, resolution it is computed from
+ROLLUP_RESOLUTIONS = (
+    ('5min', 5 * 60, 'min'),
+    ('15min', 15 * 60, '5min'),
+    ('1hr', 60 * 60, '15min'),
+    ('4hr', 4 * 60 * 60, '1hr'),
+    ('1d', 24 * 60 * 60, '4hr'),
+    ('1w', 7 * 24 * 60 * 60, '1d'),
+)
+RESOLUTION_SECONDS = dict((resolution, seconds) for resolution, seconds, child in ROLLUP_RESOLUTIONS)
+
+# weeks start on monday, first monday after epoch is 1970-01-05
+WEEK_START = 4 * 24 * 60 * 60
+
+# number of rollup candles read or written at once while rebuilding
+PAGE_SIZE = 10000
+
+CANDLE_COLUMNS = 'ts, open, high, low, close, base_volume, counter_volume'
+
+
+def create_rollup_table(conn):
+    conn.execute('CREATE TABLE IF NOT EXISTS SDEX_OHLCV_ROLLUP ('
+                 'TRADE_PAIR TEXT NOT NULL, RESOLUTION TEXT NOT NULL, TS INT NOT NULL, '
+                 'OPEN REAL, HIGH REAL, LOW REAL, CLOSE REAL, BASE_VOLUME REAL, COUNTER_VOLUME REAL, '
+                 'PRIMARY KEY (TRADE_PAIR, RESOLUTION, TS) ON CONFLICT REPLACE) WITHOUT ROWID')
+
+
+def period_start(resolution, ts):
+    """
+    :return: seconds since epoch of the start of the candle of given resolution containing ts
+    """
+    seconds = RESOLUTION_SECONDS[resolution]
+    ts = int(ts)
+    if resolution == '1w':
+        return ts - (ts - WEEK_START) % seconds
+    return ts - ts % seconds
+
+
+def aggregate(rows, resolution):
+    """
+    rows: (ts, open, high, low, close, base_volume, counter_volume) of smaller candles ordered by ts
+    :return: generator of the candles of given resolution in the same format
+    """
+    candle = None
+    for ts, c_open, c_high, c_low, c_close, base_volume, counter_volume in rows:
+        start = period_start(resolution, ts)
+        if candle and candle[0] == start:
+            candle[2] = c_high if c_high > candle[2] else candle[2]
+            candle[3] = c_low if c_low < candle[3] else candle[3]
+            candle[4] = c_close
+            candle[5] += base_volume or 0
+            candle[6] += counter_volume or 0
+        else:
+            if candle:
+                yield tuple(candle)
+            candle = [start, c_open, c_high, c_low, c_close, base_volume or 0, counter_volume or 0]
+    if candle:
+        yield tuple(candle)
+
+
+def _insert(cursor, trade_pair, resolution, candles):
+    cursor.executemany('INSERT INTO sdex_ohlcv_rollup(trade_pair, resolution, %s) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'
+                       % CANDLE_COLUMNS, [(trade_pair, resolution) + candle for candle in candles])
+
+
+def _smaller_candles(cursor, trade_pair, resolution, start):
+    seconds = RESOLUTION_SECONDS[resolution]
+    if resolution == '5min':
+        # minute candles are looked up by the unique index of sdex_ohlcv
+        d = datetime.datetime.utcfromtimestamp(start)
+        return cursor.execute('SELECT %s FROM sdex_ohlcv WHERE trade_pair = ? AND year = ? AND month = ? AND day = ? '
+                              'AND hour = ? AND minute >= ? AND minute < ? ORDER BY ts' % CANDLE_COLUMNS,
+                              [trade_pair, d.year, d.month, d.day, d.hour, d.minute,
+                               d.minute + seconds // 60]).fetchall()
+
+    smaller = [child for r, s, child in ROLLUP_RESOLUTIONS if r == resolution][0]
+    return cursor.execute('SELECT %s FROM sdex_ohlcv_rollup WHERE trade_pair = ? AND resolution = ? AND ts >= ? '
+                          'AND ts < ? ORDER BY ts' % CANDLE_COLUMNS,
+                          [trade_pair, smaller, start, start + seconds]).fetchall()
+
+
+def update_rollups(cursor, candles):
+    """
+    Recomputes the candles of all the resolutions containing given minute candles. Should be called in the
+    transaction writing the minute candles.
+    candles: list of (trade_pair, ts) of the minute candles written
+    """
+    changed = set((trade_pair, int(ts)) for trade_pair, ts in candles)
+    for resolution, seconds, smaller in ROLLUP_RESOLUTIONS:
+        changed = set((trade_pair, period_start(resolution, ts)) for trade_pair, ts in changed)
+        for trade_pair, start in sorted(changed):
+            rows = list(aggregate(_smaller_candles(cursor, trade_pair, resolution, start), resolution))
+            if rows:
+                _insert(cursor, trade_pair, resolution, rows)
+            else:
+                cursor.execute('DELETE FROM sdex_ohlcv_rollup WHERE trade_pair = ? AND resolution = ? AND ts = ?',
+                               [trade_pair, resolution, start])
+
+
+def _rollup_pages(conn, trade_pair, resolution):
+    ts = None
+    while True:
+        if ts is None:
+            rows = conn.execute('SELECT %s FROM sdex_ohlcv_rollup WHERE trade_pair = ? AND resolution = ? '
+                                'ORDER BY ts LIMIT %s' % (CANDLE_COLUMNS, PAGE_SIZE),
+                                [trade_pair, resolution]).fetchall()
+        else:
+            rows = conn.execute('SELECT %s FROM sdex_ohlcv_rollup WHERE trade_pair = ? AND resolution = ? AND ts > ? '
+                                'ORDER BY ts LIMIT %s' % (CANDLE_COLUMNS, PAGE_SIZE),
+                                [trade_pair, resolution, ts]).fetchall()
+        for row in rows:
+            yield row
+        if len(rows) < PAGE_SIZE:
+            break
+        ts = rows[-1][0]
+
+
+def rebuild_rollups(conn, trade_pair):
+    """
+    Rebuilds all the rollups of the trade pair from its minute candles in one transaction.
+    """
+    conn.execute('DELETE FROM sdex_ohlcv_rollup WHERE trade_pair = ?', [trade_pair])
+
+    # minutes are read in order of the unique index of sdex_ohlcv, which is the order of ts
+    minutes = conn.execute('SELECT %s FROM sdex_ohlcv WHERE trade_pair = ? ORDER BY year, month, day, hour, minute'
+                           % CANDLE_COLUMNS, [trade_pair])
+    for resolution, seconds, smaller in ROLLUP_RESOLUTIONS:
+        rows = minutes if smaller == 'min' else _rollup_pages(conn, trade_pair, smaller)
+        count = 0
+        candles = []
+        for candle in aggregate(rows, resolution):
+            candles += [candle]
+            if len(candles) == PAGE_SIZE:
+                # rollup pages are read completely before the next page is written
+                _insert(conn, trade_pair, resolution, candles)
+                count += len(candles)
+                candles = []
+        _insert(conn, trade_pair, resolution, candles)
+        count += len(candles)
+        logging.info('Rebuilt %s %s candles of %s' % (count, resolution, trade_pair))
+
+    conn.commit()
+
+
+def usage():
+    print('rollup -c/--config <config-file> [-p/--pair <trade-pair>]')
+
+
+if __name__ == '__main__':
+    # rebuilds the rollups of existing history, importer keeps them up to date afterwards.
+    # Should be run while importer is stopped.
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "c:p:", ["config=", "pair="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    configfile = 'engine.yaml'
+    pairs = []
+    for opt, val in opts:
+        if opt in ('-c', '--config'):
+            configfile = val
+        elif opt in ('-p', '--pair'):
+            pairs += [val]
+
+    if not os.path.isfile(configfile):
+        print('config file %s doesnt exist' % configfile)
+        usage()
+        sys.exit(2)
+
+    with open(configfile, 'r') as f:
+        configcontent = f.read()
+    try:
+        config = yaml.load(configcontent)
+    except yaml.YAMLError as e:
+        print('Incorrect config file content. ex = %s' % str(e))
+        sys.exit(2)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    main_db = 'engine.db'
+    backtest_db = 'backtest.db'
+    if 'db' in config:
+        dbconfig = config['db']
+        if 'connection_main' in dbconfig:
+            main_db = dbconfig['connection_main']
+        if 'connection_backtest' in dbconfig:
+            backtest_db = dbconfig['connection_backtest']
+    set_db(main_db, backtest_db)
+
+    db = sqlite3.connect(get_backtest_db())
+    create_rollup_table(db)
+
+    # earlier importer stored these as real numbers
+    db.execute("UPDATE sdex_ohlcv SET hour4 = hour / 4, minute15 = minute / 15, minute5 = minute / 5 "
+               "WHERE typeof(hour4) = 'real' OR typeof(minute15) = 'real' OR typeof(minute5) = 'real'")
+    db.commit()
+
+    if not pairs:
+        pairs = [row[0] for row in db.execute('SELECT DISTINCT trade_pair FROM sdex_ohlcv')]
+    for pair in pairs:
+        rebuild_rollups(db, pair)
+    db.close()
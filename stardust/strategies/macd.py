@@ -1,5 +1,7 @@
 import logging
 
+import numpy as np
+
 from stardust.strategy import register_strategy, BaseTradingStrategy
 
 
@@ -19,6 +21,8 @@ from stardust.strategy import register_strategy, BaseTradingStrategy
 # Candle to process before considering it a trend:
 # trend_stickiness = 1
 class MACD(BaseTradingStrategy):
+    VECTORIZED = True
+
     def __init__(self):
         BaseTradingStrategy.__init__(self)
         self.trend_direction = 'none'
@@ -83,5 +87,40 @@ class MACD(BaseTradingStrategy):
                 self.trend_advised = True
                 self.sell()
 
+    def execute_vectorized(self, ohlcv, indicators):
+        params = self.get_parameters()
+        threshold_up = params['threshold_up']
+        threshold_down = params['threshold_down']
+        trend_stickiness = params['trend_stickiness']
+
+        macd = indicators['macdx']['macd']
+
+        # trend of each candle, candles within thresholds (or during warmup) keep the previous trend
+        trend = np.zeros(len(macd), dtype=int)
+        trend[macd > threshold_up] = 1
+        trend[macd < threshold_down] = -1
+        trend[macd == 0] = 0
+
+        signal = np.zeros(len(macd), dtype=int)
+        trend_index = np.flatnonzero(trend)
+        if len(trend_index) == 0:
+            return signal
+        trend = trend[trend_index]
+
+        # trend starts at the candle where direction changes
+        starts = np.ones(len(trend), dtype=bool)
+        starts[1:] = trend[1:] != trend[:-1]
+        start_index = trend_index[starts][np.cumsum(starts) - 1]
+        trend_id = np.cumsum(starts)
+
+        # advice is generated once per trend at first candle where trend persisted for trend_stickiness candles
+        persisted = (trend_index - start_index) >= trend_stickiness
+        trend_index, trend, trend_id = trend_index[persisted], trend[persisted], trend_id[persisted]
+        advised = np.ones(len(trend_id), dtype=bool)
+        advised[1:] = trend_id[1:] != trend_id[:-1]
+
+        signal[trend_index[advised]] = np.where(trend[advised] > 0, self.SIGNAL_BUY, self.SIGNAL_SELL)
+        return signal
+
 
 register_strategy('macd', MACD)
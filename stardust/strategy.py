@@ -1,10 +1,12 @@
-import asyncio
 import logging
 
 import numpy as np
 
+import stardust.batched as batched
 import stardust.indicators as ind
-from stardust.data import TradeAdvice
+import stardust.streaming as streaming
+from stardust.data import TradeAdvice, Candle
+from stardust.ohlcv import OhlcvBuffer
 
 
 class TradingException(Exception):
@@ -14,41 +16,61 @@ class TradingException(Exception):
 
 # Strategy that needs to be impletemented to customize
 class BaseTradingStrategy(object):
-    SLEEP_TIME = 1
+    # strategy is executed on every new candle, strategies that also need to be executed between the candles set it
+    # to the number of seconds after which they are executed again
+    EXECUTE_INTERVAL = None
+    # minimum number of candles kept in history, indicators with longer lookback increase it. Recursive indicators
+    # (e.g. EMA) that are computed over the history need it to be longer than the lookback to converge.
     CANDLE_HISTORY_MIN = 1440
+    # set it to True in the strategies that implement execute_vectorized, backtests of such strategies process
+    # the whole history at once instead of candle by candle
+    VECTORIZED = False
+
+    SIGNAL_NONE = 0
+    SIGNAL_BUY = 1
+    SIGNAL_SELL = -1
 
     def __init__(self):
         self.deployment_id = None
         self.parameters = None
-        self.candle_pipeline = None
-        self.order_pipeline = None
         self.indicators = None
 
+        self.candlesize = None
         self.current_advice = None
         self.current_candle = None
+        self.current_candles = {}
         self.indicator_params = {}
         self.indicator_values = {}
+        self.indicator_streams = {}
+        self.indicator_keys = {}
+        self.indicator_sizes = {}
+        self.indicator_grids = set()
+        self.shared_indicators = None
         self.ohlcv = None
+        self.ohlcv_per_size = {}
 
-    def setup(self, deployment_id, parameters, in_candle_pipeline, out_order_pipeline):
+    def setup(self, deployment_id, parameters, shared_indicators=None, candlesize=None):
         self.deployment_id = deployment_id
         self.parameters = parameters
-        self.candle_pipeline = in_candle_pipeline
-        self.order_pipeline = out_order_pipeline
         self.indicators = ind.get_all_indicators()
+        # when running inside engine, indicators are computed once for all the strategies on same trade pair
+        # and candle size and their values are delivered along with the candle
+        self.shared_indicators = shared_indicators
+        # candle size of the algo, strategy can additionally use other candle sizes of the same trade pair
+        self.candlesize = candlesize
 
         self.current_advice = None
         self.current_candle = None
+        self.current_candles = {}
         self.indicator_type = {}
         self.indicator_params = {}
         self.indicator_values = {}
-        self.ohlcv = {
-            'open': [],
-            'high': [],
-            'low': [],
-            'close': [],
-            'volume': []
-        }
+        self.indicator_streams = {}
+        self.indicator_keys = {}
+        self.indicator_sizes = {}
+        self.indicator_grids = set()
+        self.ohlcv = OhlcvBuffer(BaseTradingStrategy.CANDLE_HISTORY_MIN)
+        self.ohlcv_per_size = {candlesize: self.ohlcv}
 
     def name(self):
         return 'Base'
@@ -73,6 +95,14 @@ class BaseTradingStrategy(object):
         """
         pass
 
+    def process_timeframe_candle(self, candlesize, candle):
+        """
+        callback: called instead of process_candle for candles of the additional candle sizes the strategy subscribed
+        to using add_timeframe (or add_indicator with candlesize).
+        :param candlesize: size of the candle e.g. '1hr'
+        """
+        pass
+
     def execute(self, indicators):
         """
         callback: this function will be called periodically based upon configured frequency.
@@ -84,36 +114,124 @@ class BaseTradingStrategy(object):
         """
         pass
 
-    def add_indicator(self, name, itype, parameters):
+    def execute_vectorized(self, ohlcv, indicators):
+        """
+        callback: used in backtests instead of process_candle and execute when VECTORIZED is set.
+        This function should generate advice for all the candles at once using numpy array operations.
+        :param ohlcv: dict with numpy arrays of open, high, low, close, volume of all the candles
+        :param indicators: values of the indicators that is added using 'add_indicator' function computed over all the
+        candles e.g. indicators['sma']['sma'] is numpy array with value for each candle (nan during warmup)
+        :return: numpy array with advice for each candle, SIGNAL_BUY, SIGNAL_SELL or SIGNAL_NONE
+        """
+        return None
+
+    def add_timeframe(self, candlesize):
+        """
+        subscribe to candles of another size of the same trade pair. Candles of this size are passed to
+        process_timeframe_candle and execute is called for them as well.
+        :param candlesize: size of the candle e.g. '1hr'
+        """
+        if candlesize in self.ohlcv_per_size:
+            return
+
+        if candlesize not in Candle.VALID_CANDLE_SIZES:
+            raise TradingException('Not valid candle size = %s. Valid values = %s' %
+                                   (candlesize, str(Candle.VALID_CANDLE_SIZES)))
+
+        self.ohlcv_per_size[candlesize] = OhlcvBuffer(BaseTradingStrategy.CANDLE_HISTORY_MIN)
+
+    def get_candlesizes(self):
+        """
+        :return: candle sizes used by strategy, candle size of the algo first
+        """
+        return list(self.ohlcv_per_size.keys())
+
+    def get_history(self, candlesize=None):
+        """
+        :return: dict with numpy arrays of open, high, low, close, volume of the latest candles of given size
+        (candle size of the algo by default). Arrays are only valid till next candle arrives.
+        """
+        return self.ohlcv_per_size[candlesize or self.candlesize].arrays()
+
+    def add_indicator(self, name, itype, parameters, candlesize=None):
         """
         add this indicator to be provided while calling execute function. see list of parameters and required input [TODO:here]
         :param name: name of the indicator
         :param parameters: parameters for indicator in dict format, if not required parameters are provided then
         it will throw TradingException.
+        :param candlesize: compute indicator over candles of this size instead of candle size of the algo
         """
         if name in self.indicator_values:
             return
 
+        candlesize = candlesize or self.candlesize
+        self.add_timeframe(candlesize)
+
         if itype not in self.indicators:
             raise TradingException('Indicator not found = %s ' % itype)
 
         try:
             # check whether all the parameters are correct for indicator
-            tmp = {
-                'open': np.random.random(100),
-                'high': np.random.random(100),
-                'low': np.random.random(100),
-                'close': np.random.random(100),
-                'volume': np.random.random(100)
-            }
-            # test the indicators with parameters to check whether they are ok
-            self.indicators[itype](tmp, parameters)
+            ind.validate_params(itype, parameters)
         except Exception as e:
             raise TradingException('Incorrect indicator configuration = %s' % e)
 
         self.indicator_type[name] = itype
         self.indicator_params[name] = parameters
         self.indicator_values[name] = {}
+        self.indicator_sizes[name] = candlesize
+
+        if self.shared_indicators:
+            self.indicator_keys[name] = self.shared_indicators.subscribe(itype, parameters, candlesize)
+            return
+
+        # indicators without streaming version are recomputed over candle history
+        self.indicator_streams[name] = streaming.create_streaming_indicator(itype, parameters)
+
+        ohlcv = self.ohlcv_per_size[candlesize]
+        lookback = ind.get_lookback(itype, parameters)
+        if lookback + 1 > ohlcv.capacity:
+            ohlcv.resize(lookback + 1)
+
+    def add_indicator_grid(self, name, itype, grid, candlesize=None):
+        """
+        add indicator computed for a grid of parameters e.g. EMA for periods 5..50. Value of each output of the
+        indicator is numpy array with value for each parameters in the grid (2-D array parameters x candles in
+        execute_vectorized).
+        :param name: name of the indicator
+        :param grid: list of parameters for indicator in dict format
+        :param candlesize: compute indicator over candles of this size instead of candle size of the algo
+        """
+        if name in self.indicator_values:
+            return
+
+        candlesize = candlesize or self.candlesize
+        self.add_timeframe(candlesize)
+
+        if itype not in self.indicators:
+            raise TradingException('Indicator not found = %s ' % itype)
+
+        if not grid:
+            raise TradingException('Empty parameter grid for indicator = %s' % itype)
+
+        try:
+            for parameters in grid:
+                ind.validate_params(itype, parameters)
+        except Exception as e:
+            raise TradingException('Incorrect indicator configuration = %s' % e)
+
+        self.indicator_type[name] = itype
+        self.indicator_params[name] = list(grid)
+        self.indicator_values[name] = {}
+        self.indicator_sizes[name] = candlesize
+        self.indicator_grids.add(name)
+        # grid is recomputed over candle history
+        self.indicator_streams[name] = None
+
+        ohlcv = self.ohlcv_per_size[candlesize]
+        lookback = self._get_lookback(name)
+        if lookback + 1 > ohlcv.capacity:
+            ohlcv.resize(lookback + 1)
 
     def buy(self):
         """
@@ -127,104 +245,181 @@ class BaseTradingStrategy(object):
         """
         self.current_advice = TradeAdvice.SELL
 
-    async def _get_next_available_candle(self):
+    def _update_indicators(self, candle, shared_values=None, candlesize=None):
         """
-        Gets the next available candle in the pipeline. Until next candle is available this function will return same
-        Candle every time.
-        :return:  Next available candle from pipeline if any otherwise current available candle
+        Adds the candle to the candle history and updates values of all the added indicators.
+        :param shared_values: values of the shared indicators computed for this candle (see IndicatorRegistry)
+        :param candlesize: size of the candle, candle size of the algo by default
         """
-        if not self.candle_pipeline.empty():
-            return await self.candle_pipeline.get()
-        return self.current_candle
-
-    def _is_new_candle(self, candle):
-        if not self.current_candle:
+        candlesize = candlesize or self.candlesize
+        history = self.ohlcv_per_size[candlesize]
+        # oldest candle is dropped once the history is full
+        history.append(candle)
+
+        ohlcv = None
+        for k, itype in self.indicator_type.items():
+            if self.indicator_sizes[k] != candlesize:
+                continue
+
+            if k in self.indicator_keys:
+                key = self.indicator_keys[k]
+                if shared_values and key in shared_values:
+                    self.indicator_values[k].update(shared_values[key])
+                continue
+
+            stream = self.indicator_streams[k]
+            if stream:
+                # streaming indicator is updated in constant time with the latest candle
+                for param_name, lastval in stream.update(candle).items():
+                    self.indicator_values[k][param_name] = None if lastval == np.nan else lastval
+                continue
+
+            if ohlcv is None:
+                ohlcv = history.arrays()
+
+            if k in self.indicator_grids:
+                # last value of the indicator for each parameters in the grid
+                for param_name, param_val in batched.compute_grid(itype, ohlcv, self.indicator_params[k]).items():
+                    self.indicator_values[k][param_name] = param_val[:, param_val.shape[1] - 1]
+                continue
+
+            # compute indicator
+            indicator = self.indicators[itype]
+            for param_name, param_val in indicator(ohlcv, self.indicator_params[k]).items():
+                # get the last value of the indicator
+                lastval = param_val[len(param_val) - 1]
+                self.indicator_values[k][param_name] = None if lastval == np.nan else lastval
+
+    def _compute_indicators(self, ohlcv, cache=None, scope=None):
+        """
+        Internal function. Should not be called from outside. Computes all the added indicators over whole history.
+        :param cache: IndicatorCache to reuse values computed by earlier backtests
+        :param scope: (tradepair, candlesize, start_ts, end_ts, candles digest) identifying the history in the cache
+        :return: dict of indicator name -> dict of output name -> numpy array of values
+        """
+        values = {}
+        for k, itype in self.indicator_type.items():
+            if self.indicator_sizes[k] != self.candlesize:
+                continue
+
+            key = None
+            if cache is not None:
+                if k in self.indicator_grids:
+                    params = [ind.get_named_params(itype, p) for p in self.indicator_params[k]]
+                else:
+                    params = ind.get_named_params(itype, self.indicator_params[k])
+                key = cache.key(*(scope + (itype, params)))
+                if key:
+                    values[k] = cache.get(key)
+                    if values[k] is not None:
+                        continue
+
+            if k in self.indicator_grids:
+                values[k] = batched.compute_grid(itype, ohlcv, self.indicator_params[k])
+            else:
+                values[k] = self.indicators[itype](ohlcv, self.indicator_params[k])
+            if key:
+                cache.put(key, values[k])
+        return values
+
+    def get_warmup_size(self, candlesize=None):
+        """
+        :return: number of candles of given size (candle size of the algo by default) needed by the indicators
+        before they output their first value
+        """
+        candlesize = candlesize or self.candlesize
+        size = 0
+        for k in self.indicator_type.keys():
+            if self.indicator_sizes[k] == candlesize:
+                size = max(size, self._get_lookback(k) + 1)
+        return size
+
+    def _get_lookback(self, name):
+        itype = self.indicator_type[name]
+        if name in self.indicator_grids:
+            return max([ind.get_lookback(itype, parameters) for parameters in self.indicator_params[name]])
+        return ind.get_lookback(itype, self.indicator_params[name])
+
+    def _warmup(self, candles, shared_values=None, candlesize=None):
+        """
+        Internal function. Should not be called from outside. Fills the candle history and indicators with historical
+        candles, so that strategy is ready to trade on first live candle. Callbacks are not called for these candles.
+        :param candles: historical candles ordered by date
+        :param shared_values: latest values of the shared indicators (see IndicatorRegistry.warmup)
+        """
+        candlesize = candlesize or self.candlesize
+        for candle in candles:
+            if not self._is_new_candle(candle, candlesize):
+                continue
+            self._update_indicators(candle, None, candlesize)
+            self.current_candles[candlesize] = candle
+            if candlesize == self.candlesize:
+                self.current_candle = candle
+
+        if shared_values:
+            for k, key in self.indicator_keys.items():
+                if self.indicator_sizes[k] == candlesize and key in shared_values:
+                    self.indicator_values[k].update(shared_values[key])
+
+    def _is_new_candle(self, candle, candlesize=None):
+        current_candle = self.current_candles.get(candlesize or self.candlesize)
+        if not current_candle:
             return True
-        return candle.c_date > self.current_candle.c_date
-
-    async def run(self):
-        # This function receives candles from the pipeline, generates indicators and then
-        # periodically calls execute function
-        """
-        Internal function. Should not be called from outside. Executes internal logic.
-        """
-        logging.info('Starting loop for strategy %s with deployment %s' % (self.name(), self.deployment_id))
-        while True:
-            candle = await self._get_next_available_candle()
-            logging.debug("Starting strategy execution [candle = %s]" % (candle,))
-
-            try:
-                if candle and self._is_new_candle(candle):
-                    logging.info('Got new candle in strategy %s for deployment %s' % (self.name(), self.deployment_id))
-
-                    # todo write logic to purge old candles
-                    self.ohlcv['open'] += [candle.c_open]
-                    self.ohlcv['high'] += [candle.c_high]
-                    self.ohlcv['low'] += [candle.c_low]
-                    self.ohlcv['close'] += [candle.c_close]
-                    self.ohlcv['volume'] += [candle.c_base_volume]
-
-                    result = {}
-                    for k, itype in self.indicator_type.items():
-                        # compute indicator
-                        ohlcv = {}
-                        ohlcv['open'] = np.array(self.ohlcv['open'])
-                        ohlcv['high'] = np.array(self.ohlcv['high'])
-                        ohlcv['low'] = np.array(self.ohlcv['low'])
-                        ohlcv['close'] = np.array(self.ohlcv['close'])
-                        ohlcv['volume'] = np.array(self.ohlcv['volume'])
-
-                        indicator = self.indicators[itype]
-                        result[k] = indicator(ohlcv, self.indicator_params[k])
-
-                    for k, vals in result.items():
-                        for param_name, param_val in vals.items():
-                            # get the last value of the indicator
-                            lastval = param_val[len(param_val) - 1]
-                            self.indicator_values[k][param_name] = None if lastval == np.nan else lastval
-
-                    # call trading strategy's process candle callback
-                    logging.debug(
-                        'Processing candle for strategy %s of deployment %s' % (self.name(), self.deployment_id))
-                    self.process_candle(candle)
-
-                    self.current_candle = candle
-            except:
-                logging.exception('Exception in processing candle')
-
-            # execute actual trading strategy callback
-            logging.debug('Processing logic for strategy %s of deployment %s' % (self.name(), self.deployment_id))
-            self.execute(self.indicator_values)
-
-            if self.current_advice:
-                logging.debug('Sending %s from strategy %s of deployment %s' %
-                              (self.current_advice, self.name(), self.deployment_id))
-                await self.order_pipeline.put(self.current_advice)
-                self.current_advice = None
-
-            await asyncio.sleep(BaseTradingStrategy.SLEEP_TIME)
-
-
-STRATEGY_COROUTINE_FACTORY = {}
+        return candle.c_date > current_candle.c_date
+
+    def _on_candle(self, candle, shared_values=None, candlesize=None):
+        """
+        Internal function. Should not be called from outside. Updates indicators with new candle and passes it to
+        process_candle (or process_timeframe_candle) callback.
+        :return: True if the candle is processed, False if it is not newer than the current candle
+        """
+        candlesize = candlesize or self.candlesize
+        if not self._is_new_candle(candle, candlesize):
+            return False
+
+        logging.info('Got new %s candle in strategy %s for deployment %s' %
+                     (candlesize, self.name(), self.deployment_id))
+        self._update_indicators(candle, shared_values, candlesize)
+
+        # call trading strategy's process candle callback
+        logging.debug('Processing candle for strategy %s of deployment %s' % (self.name(), self.deployment_id))
+        if candlesize == self.candlesize:
+            self.process_candle(candle)
+            self.current_candle = candle
+        else:
+            self.process_timeframe_candle(candlesize, candle)
+
+        self.current_candles[candlesize] = candle
+        return True
+
+    def _execute(self):
+        """
+        Internal function. Should not be called from outside. Executes trading strategy callback.
+        :return: advice generated by the strategy if any
+        """
+        logging.debug('Processing logic for strategy %s of deployment %s' % (self.name(), self.deployment_id))
+        self.execute(self.indicator_values)
+
+        advice = self.current_advice
+        self.current_advice = None
+        return advice
+
+
 STRATEGY_FACTORY = {}
+# classes of the registered strategies by name
+STRATEGY_CLASSES = {}
 
 
 def register_strategy(name, strategy_class):
     logging.info('Registering strategy %s' % (name,))
-    if name in STRATEGY_COROUTINE_FACTORY:
+    if name in STRATEGY_FACTORY:
         return
 
-    def return_coroutine(did, params, candle_pipe, advice_pipe):
-        c = strategy_class()
-        c.setup(did, params, candle_pipe, advice_pipe)
-        c.init()
-        return c.run()
-
-    def return_strategy(did, params):
+    def return_strategy(did, params, shared_indicators=None, candlesize=None):
         c = strategy_class()
-        c.setup(did, params, None, None)
+        c.setup(did, params, shared_indicators, candlesize)
         c.init()
         return c
 
     STRATEGY_FACTORY[name] = return_strategy
-    STRATEGY_COROUTINE_FACTORY[name] = return_coroutine
+    STRATEGY_CLASSES[name] = strategy_class
@@ -0,0 +1,540 @@
+# Streaming (incremental) versions of the indicators in stardust.indicators.
+#
+# Each indicator keeps its own state and is updated with one candle at a time in constant time, instead of
+# re-running the TA-Lib function over the whole candle history. The arithmetic follows the TA-Lib C
+# implementation step by step (same seeding, same order of floating point operations), so the values match
+# the ones returned by the wrappers in stardust.indicators. Output names are the same as of those wrappers.
+# Until an indicator has seen enough candles (its TA-Lib lookback) it returns nan for every output.
+
+import collections
+import math
+
+import stardust.indicators as ind
+
+NAN = float('nan')
+
+
+def _is_zero(v):
+    # same as TA_IS_ZERO
+    return -0.00000001 < v < 0.00000001
+
+
+def _is_zero_or_neg(v):
+    # same as TA_IS_ZERO_OR_NEG
+    return v < 0.00000001
+
+
+class _Ema(object):
+    """ EMA seeded with the simple average of the first 'period' values (TA-Lib default compatibility) """
+
+    def __init__(self, period):
+        self.period = period
+        self.k = 2.0 / (period + 1)
+        self.count = 0
+        self.total = 0.0
+        self.value = NAN
+
+    def update(self, x):
+        if self.count < self.period:
+            self.count += 1
+            self.total += x
+            if self.count == self.period:
+                self.value = self.total / self.period
+            return self.value
+
+        self.value = ((x - self.value) * self.k) + self.value
+        return self.value
+
+
+class _T3Ema(_Ema):
+    """ EMA stage of T3, TA-Lib computes it as k * x + (1 - k) * prev """
+
+    def __init__(self, period):
+        _Ema.__init__(self, period)
+        self.one_minus_k = 1.0 - self.k
+
+    def update(self, x):
+        if self.count < self.period:
+            return _Ema.update(self, x)
+
+        self.value = (self.k * x) + (self.one_minus_k * self.value)
+        return self.value
+
+
+class _Sma(object):
+    def __init__(self, period):
+        self.period = period
+        self.window = collections.deque()
+        self.total = 0.0
+
+    def update(self, x):
+        self.window.append(x)
+        self.total += x
+        if len(self.window) < self.period:
+            return NAN
+
+        value = self.total / self.period
+        self.total -= self.window.popleft()
+        return value
+
+
+class _Wma(object):
+    def __init__(self, period):
+        self.period = period
+        self.divider = (period * (period + 1)) >> 1
+        self.window = collections.deque()
+        self.period_sum = 0.0
+        self.period_sub = 0.0
+        self.trailing_value = 0.0
+
+    def update(self, x):
+        if self.period == 1:
+            return x
+
+        n = len(self.window)
+        if n < self.period - 1:
+            self.window.append(x)
+            self.period_sub += x
+            self.period_sum += x * (n + 1)
+            return NAN
+
+        self.period_sub += x
+        self.period_sub -= self.trailing_value
+        self.period_sum += x * self.period
+        self.window.append(x)
+        self.trailing_value = self.window.popleft()
+        value = self.period_sum / self.divider
+        self.period_sum -= self.period_sub
+        return value
+
+
+class _Dema(object):
+    def __init__(self, period):
+        self.ema1 = _Ema(period)
+        self.ema2 = _Ema(period)
+
+    def update(self, x):
+        e1 = self.ema1.update(x)
+        if math.isnan(e1):
+            return NAN
+        e2 = self.ema2.update(e1)
+        if math.isnan(e2):
+            return NAN
+        return (2.0 * e1) - e2
+
+
+class _Tema(object):
+    def __init__(self, period):
+        self.ema1 = _Ema(period)
+        self.ema2 = _Ema(period)
+        self.ema3 = _Ema(period)
+
+    def update(self, x):
+        e1 = self.ema1.update(x)
+        if math.isnan(e1):
+            return NAN
+        e2 = self.ema2.update(e1)
+        if math.isnan(e2):
+            return NAN
+        e3 = self.ema3.update(e2)
+        if math.isnan(e3):
+            return NAN
+        return e3 + ((3.0 * e1) - (3.0 * e2))
+
+
+class _T3(object):
+    def __init__(self, period, vfactor):
+        self.stages = [_T3Ema(period) for _ in range(6)]
+
+        tmp = vfactor * vfactor
+        self.c1 = -tmp * vfactor
+        self.c2 = 3.0 * (tmp - self.c1)
+        self.c3 = -6.0 * tmp - 3.0 * (vfactor - self.c1)
+        self.c4 = 1.0 + 3.0 * vfactor - self.c1 + 3.0 * tmp
+
+    def update(self, x):
+        e = []
+        for stage in self.stages:
+            x = stage.update(x)
+            if math.isnan(x):
+                return NAN
+            e += [x]
+        return self.c1 * e[5] + self.c2 * e[4] + self.c3 * e[3] + self.c4 * e[2]
+
+
+class _Kama(object):
+    CONST_MAX = 2.0 / (30.0 + 1.0)
+    CONST_DIFF = 2.0 / (2.0 + 1.0) - CONST_MAX
+
+    def __init__(self, period):
+        self.period = period
+        self.window = collections.deque(maxlen=period + 1)
+        self.sum_roc1 = 0.0
+        self.trailing_value = 0.0
+        self.value = NAN
+
+    def _smoothing(self, period_roc):
+        if self.sum_roc1 <= period_roc or _is_zero(self.sum_roc1):
+            sc = 1.0
+        else:
+            sc = math.fabs(period_roc / self.sum_roc1)
+        sc = (sc * _Kama.CONST_DIFF) + _Kama.CONST_MAX
+        return sc * sc
+
+    def update(self, x):
+        n = len(self.window)
+        if n < self.period:
+            if n > 0:
+                self.sum_roc1 += math.fabs(self.window[-1] - x)
+            self.window.append(x)
+            return NAN
+
+        if math.isnan(self.value):
+            self.sum_roc1 += math.fabs(self.window[-1] - x)
+            trailing = self.window[0]
+            self.value = self.window[-1]
+        else:
+            trailing = self.window[1]
+            self.sum_roc1 -= math.fabs(self.trailing_value - trailing)
+            self.sum_roc1 += math.fabs(x - self.window[-1])
+
+        self.trailing_value = trailing
+        sc = self._smoothing(x - trailing)
+        self.value = ((x - self.value) * sc) + self.value
+        self.window.append(x)
+        return self.value
+
+
+class _Extreme(object):
+    """ Highest (or lowest) value over last 'period' values using a monotonic queue, O(1) amortized """
+
+    def __init__(self, period, highest):
+        self.period = period
+        self.highest = highest
+        self.queue = collections.deque()
+        self.index = 0
+
+    def update(self, x):
+        queue = self.queue
+        if self.highest:
+            while queue and queue[-1][1] <= x:
+                queue.pop()
+        else:
+            while queue and queue[-1][1] >= x:
+                queue.pop()
+        queue.append((self.index, x))
+        if queue[0][0] <= self.index - self.period:
+            queue.popleft()
+        self.index += 1
+
+        if self.index < self.period:
+            return NAN
+        return queue[0][1]
+
+
+class _Identity(object):
+    def update(self, x):
+        return x
+
+
+def _moving_average(matype, period):
+    """ :return streaming moving average for TA-Lib MA type, None if there is no streaming version of it """
+    if period == 1:
+        return _Identity()
+    if matype == 0:
+        return _Sma(period)
+    if matype == 1:
+        return _Ema(period)
+    if matype == 2:
+        return _Wma(period)
+    if matype == 3:
+        return _Dema(period)
+    if matype == 4:
+        return _Tema(period)
+    if matype == 6:
+        return _Kama(period)
+    if matype == 8:
+        return _T3(period, 0.7)
+    return None
+
+
+class StreamingIndicator(object):
+    """
+    Base of all streaming indicators. update is called once for every new candle and returns the latest value
+    of every output of the indicator (nan until the indicator is warmed up).
+    """
+
+    def update(self, candle):
+        raise NotImplementedError()
+
+
+class StreamingEMA(StreamingIndicator):
+    def __init__(self, kw):
+        self.ema = _Ema(ind.get_params('EMA', kw)[0])
+
+    def update(self, candle):
+        return {'ema': self.ema.update(candle.c_close)}
+
+
+class StreamingSMA(StreamingIndicator):
+    def __init__(self, kw):
+        self.sma = _Sma(ind.get_params('SMA', kw)[0])
+
+    def update(self, candle):
+        return {'sma': self.sma.update(candle.c_close)}
+
+
+class StreamingWMA(StreamingIndicator):
+    def __init__(self, kw):
+        self.wma = _Wma(ind.get_params('WMA', kw)[0])
+
+    def update(self, candle):
+        return {'wma': self.wma.update(candle.c_close)}
+
+
+class StreamingDEMA(StreamingIndicator):
+    def __init__(self, kw):
+        self.dema = _Dema(ind.get_params('DEMA', kw)[0])
+
+    def update(self, candle):
+        return {'dema': self.dema.update(candle.c_close)}
+
+
+class StreamingTEMA(StreamingIndicator):
+    def __init__(self, kw):
+        self.tema = _Tema(ind.get_params('TEMA', kw)[0])
+
+    def update(self, candle):
+        return {'tema': self.tema.update(candle.c_close)}
+
+
+class StreamingT3(StreamingIndicator):
+    def __init__(self, kw):
+        timeperiod, vfactor = ind.get_params('T3', kw)
+        self.t3 = _T3(timeperiod, vfactor)
+
+    def update(self, candle):
+        return {'t3': self.t3.update(candle.c_close)}
+
+
+class StreamingKAMA(StreamingIndicator):
+    def __init__(self, kw):
+        self.kama = _Kama(ind.get_params('KAMA', kw)[0])
+
+    def update(self, candle):
+        return {'kama': self.kama.update(candle.c_close)}
+
+
+class StreamingMACD(StreamingIndicator):
+    def __init__(self, kw):
+        fastperiod, slowperiod, signalperiod = ind.get_params('MACD', kw)
+        if slowperiod < fastperiod:
+            fastperiod, slowperiod = slowperiod, fastperiod
+
+        # TA-Lib seeds the fast EMA at the same candle as the slow one, so the first
+        # (slowperiod - fastperiod) candles are never seen by the fast EMA
+        self.skip = slowperiod - fastperiod
+        self.fast = _Ema(fastperiod)
+        self.slow = _Ema(slowperiod)
+        self.signal = _Ema(signalperiod)
+
+    def update(self, candle):
+        x = candle.c_close
+        slow = self.slow.update(x)
+        if self.skip > 0:
+            self.skip -= 1
+            return {'macd': NAN, 'macdsignal': NAN, 'macdhist': NAN}
+        fast = self.fast.update(x)
+        if math.isnan(slow):
+            return {'macd': NAN, 'macdsignal': NAN, 'macdhist': NAN}
+
+        macd = fast - slow
+        signal = self.signal.update(macd)
+        if math.isnan(signal):
+            return {'macd': NAN, 'macdsignal': NAN, 'macdhist': NAN}
+        return {'macd': macd, 'macdsignal': signal, 'macdhist': macd - signal}
+
+
+class StreamingBBANDS(StreamingIndicator):
+    def __init__(self, kw):
+        timeperiod, nbdevup, nbdevdn, matype = ind.get_params('BBANDS', kw)
+        self.period = timeperiod
+        self.nbdevup = nbdevup
+        self.nbdevdn = nbdevdn
+        self.matype = matype
+        self.ma = _moving_average(matype, timeperiod)
+        self.window = collections.deque()
+        self.total1 = 0.0
+        self.total2 = 0.0
+
+    def _stddev(self, x, ma):
+        self.window.append(x)
+        self.total1 += x
+        self.total2 += x * x
+        if len(self.window) < self.period:
+            return NAN
+
+        if self.matype == 0:
+            # variance around the precalculated simple moving average
+            mean2 = self.total2 / self.period
+            trailing = self.window.popleft()
+            self.total1 -= trailing
+            self.total2 -= trailing * trailing
+            variance = mean2 - ma * ma
+        else:
+            mean1 = self.total1 / self.period
+            mean2 = self.total2 / self.period
+            trailing = self.window.popleft()
+            self.total1 -= trailing
+            self.total2 -= trailing * trailing
+            variance = mean2 - mean1 * mean1
+
+        if not _is_zero_or_neg(variance):
+            return math.sqrt(variance)
+        return 0.0
+
+    def update(self, candle):
+        x = candle.c_close
+        middle = self.ma.update(x)
+        stddev = self._stddev(x, middle)
+        if math.isnan(middle) or math.isnan(stddev):
+            return {'upperband': NAN, 'middleband': NAN, 'lowerband': NAN}
+        return {
+            'upperband': middle + stddev * self.nbdevup,
+            'middleband': middle,
+            'lowerband': middle - stddev * self.nbdevdn
+        }
+
+
+class StreamingMIDPOINT(StreamingIndicator):
+    def __init__(self, kw):
+        timeperiod = ind.get_params('MIDPOINT', kw)[0]
+        self.highest = _Extreme(timeperiod, True)
+        self.lowest = _Extreme(timeperiod, False)
+
+    def update(self, candle):
+        highest = self.highest.update(candle.c_close)
+        lowest = self.lowest.update(candle.c_close)
+        return {'midpoint': (highest + lowest) / 2.0}
+
+
+class StreamingMIDPRICE(StreamingIndicator):
+    def __init__(self, kw):
+        timeperiod = ind.get_params('MIDPRICE', kw)[0]
+        self.highest = _Extreme(timeperiod, True)
+        self.lowest = _Extreme(timeperiod, False)
+
+    def update(self, candle):
+        highest = self.highest.update(candle.c_high)
+        lowest = self.lowest.update(candle.c_low)
+        return {'midprice': (highest + lowest) / 2.0}
+
+
+class StreamingSAR(StreamingIndicator):
+    def __init__(self, kw):
+        acceleration, maximum = ind.get_params('SAR', kw)
+        if acceleration > maximum:
+            acceleration = maximum
+        self.acceleration = acceleration
+        self.maximum = maximum
+        self.af = acceleration
+
+        self.is_long = None
+        self.sar = None
+        self.ep = None
+        self.prev_high = None
+        self.prev_low = None
+
+    def update(self, candle):
+        high, low = candle.c_high, candle.c_low
+        if self.prev_high is None:
+            self.prev_high, self.prev_low = high, low
+            return {'sar': NAN}
+
+        if self.is_long is None:
+            # initial direction is short when there is a positive minus DM between first two candles
+            diff_plus = high - self.prev_high
+            diff_minus = self.prev_low - low
+            self.is_long = not (diff_minus > 0 and diff_plus < diff_minus)
+            if self.is_long:
+                self.ep, self.sar = high, self.prev_low
+            else:
+                self.ep, self.sar = low, self.prev_high
+            # for the very first candle previous high/low are that of the candle itself
+            self.prev_high, self.prev_low = high, low
+
+        prev_high, prev_low = self.prev_high, self.prev_low
+        self.prev_high, self.prev_low = high, low
+
+        sar, ep = self.sar, self.ep
+        if self.is_long:
+            if low <= sar:
+                # switch to short
+                self.is_long = False
+                sar = max(ep, prev_high, high)
+                value = sar
+                self.af = self.acceleration
+                ep = low
+                sar = sar + self.af * (ep - sar)
+                sar = max(sar, prev_high, high)
+            else:
+                value = sar
+                if high > ep:
+                    ep = high
+                    self.af = min(self.af + self.acceleration, self.maximum)
+                sar = sar + self.af * (ep - sar)
+                sar = min(sar, prev_low, low)
+        else:
+            if high >= sar:
+                # switch to long
+                self.is_long = True
+                sar = min(ep, prev_low, low)
+                value = sar
+                self.af = self.acceleration
+                ep = high
+                sar = sar + self.af * (ep - sar)
+                sar = min(sar, prev_low, low)
+            else:
+                value = sar
+                if low < ep:
+                    ep = low
+                    self.af = min(self.af + self.acceleration, self.maximum)
+                sar = sar + self.af * (ep - sar)
+                sar = max(sar, prev_high, high)
+
+        self.sar, self.ep = sar, ep
+        return {'sar': value}
+
+
+def get_all_streaming_indicators():
+    return {
+        'BBANDS': StreamingBBANDS,
+        'DEMA': StreamingDEMA,
+        'EMA': StreamingEMA,
+        'KAMA': StreamingKAMA,
+        'MIDPOINT': StreamingMIDPOINT,
+        'MIDPRICE': StreamingMIDPRICE,
+        'SAR': StreamingSAR,
+        'SMA': StreamingSMA,
+        'T3': StreamingT3,
+        'TEMA': StreamingTEMA,
+        'WMA': StreamingWMA,
+        'MACD': StreamingMACD,
+    }
+
+
+def create_streaming_indicator(itype, kw):
+    """
+    :return streaming version of the indicator with given parameters, None if the indicator (or the configuration,
+    e.g. BBANDS with a moving average type that has no streaming version) can only be computed over the full history
+    """
+    streaming_indicators = get_all_streaming_indicators()
+    if itype not in streaming_indicators:
+        return None
+
+    if itype == 'BBANDS':
+        timeperiod, _, _, matype = ind.get_params('BBANDS', kw)
+        if _moving_average(matype, timeperiod) is None:
+            return None
+
+    return streaming_indicators[itype](kw)
@@ -1,15 +1,18 @@
+import asyncio
 import json
 import logging
 import sys
+import time
 
 import aiosqlite
 import stellar
 from aiohttp import web
 
 from stardust.data import Algo, Engine, UserProfile
-from stardust.data import Backtest
+from stardust.data import Backtest, expand_grid, decode_equity_curve, estimate_cost, MAX_PORTFOLIO_PAIRS
 from stardust.data import DeployedAlgo
 from stardust.data import get_main_db, get_backtest_db
+from stardust.notify import notify_backtester, get_webapp_socket, bind
 
 routes = web.RouteTableDef()
 
@@ -29,6 +32,15 @@ ERR_INCORRECT_REQUEST = 2
 ERR_RESOURCE_NOT_FOUND = 3
 ERR_RESOURCE_ALREADY_EXIST = 4
 
+# default and maximum seconds /backtest/wait waits for status of backtest to change
+WAIT_TIMEOUT = 30
+MAX_WAIT_TIMEOUT = 120
+# seconds between reads of backtest status while waiting, in case notification from backtester is lost
+WAIT_POLL_INTERVAL = 5
+
+# futures of the requests waiting for status of backtest to change, by backtest id
+backtest_waiters = {}
+
 
 def json_response(body='', **kwargs):
     # kwargs['body'] = json.dumps(body or kwargs['body'])
@@ -65,6 +77,52 @@ async def get_existing_algo(userid, algoname):
     return None
 
 
+async def get_backtest_status(userid, breq_id):
+    try:
+        async with aiosqlite.connect(get_backtest_db()) as db:
+            async with db.execute("select id, algoname, start_ts, end_ts, "
+                                  "tradepair, candlesize, strategyname, parameters, status, "
+                                  "progress_candles, total_candles, progress_ts "
+                                  "from backtest_request where userid = ? and id = ?",
+                                  [userid, breq_id]) as cursor:
+                async for row in cursor:
+                    return {
+                        'id': row[0],
+                        'algo_name': row[1],
+                        'start_ts': row[2],
+                        'end_ts': row[3],
+                        'trade_pair': row[4],
+                        'candle_size': row[5],
+                        'strategy_name': row[6],
+                        'strategy_parameters': row[7],
+                        'status': row[8],
+                        'progress': {
+                            'candles': row[9],
+                            'total_candles': row[10],
+                            'ts': row[11],
+                        },
+                    }
+    except:
+        raise
+
+    return None
+
+
+class BacktestNotifications(asyncio.DatagramProtocol):
+    """
+    Wakes up the requests waiting for the backtests backtester notifies about.
+    """
+
+    def datagram_received(self, data, addr):
+        try:
+            bid = int(data)
+        except ValueError:
+            return
+        for future in backtest_waiters.pop(bid, []):
+            if not future.done():
+                future.set_result(True)
+
+
 async def get_deployed_algo(userid, deployment_id):
     try:
         async with aiosqlite.connect(get_main_db()) as db:
@@ -172,8 +230,9 @@ async def backtest_run(request):
     algoname = reqparams['algo_name'] if 'algo_name' in reqparams else ''
     start_ts = reqparams['start_ts'] if 'start_ts' in reqparams else ''
     end_ts = reqparams['end_ts'] if 'end_ts' in reqparams else ''
+    priority = reqparams['priority'] if 'priority' in reqparams else 0
 
-    if not algoname:
+    if not algoname or type(priority) != int:
         return json_response(STATUS_ERR % ERRORS[ERR_INCORRECT_REQUEST], status=400)
 
     try:
@@ -187,11 +246,13 @@ async def backtest_run(request):
             try:
                 async with aiosqlite.connect(get_backtest_db()) as db:
                     cursor = await db.execute("insert into backtest_request(userid, algoname, start_ts, end_ts, "
-                                              "tradepair, candlesize, strategyname, parameters, status) "
-                                              "values (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                              "tradepair, candlesize, strategyname, parameters, status, priority, "
+                                              "cost, queued_at) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
                                               [userid, algoname, start_ts, end_ts,
                                                algo['trade_pair'], algo['candle_size'], algo['strategy_name'],
-                                               json.dumps(algo['strategy_parameters']), Backtest.STATUS_NEW])
+                                               json.dumps(algo['strategy_parameters']), Backtest.STATUS_NEW,
+                                               priority, estimate_cost(start_ts, end_ts, algo['candle_size']),
+                                               int(time.time())])
                     await db.commit()
 
                     breq = {'req_id': cursor.lastrowid}
@@ -204,36 +265,296 @@ async def backtest_run(request):
     else:
         return json_response(STATUS_ERR % ERRORS[ERR_RESOURCE_NOT_FOUND], status=400)
 
+    notify_backtester(breq['req_id'])
     return json_response(json.dumps(breq))
 
 
 @login_required
-@routes.get('/backtest/status/{req_id}')
-async def backtest_status(request):
+@routes.post('/backtest/sweep/')
+async def backtest_sweep(request):
+    userid = request.user
+    reqparams = await request.json()
+
+    if type(reqparams) != dict:
+        return json_response(STATUS_ERR % ERRORS[ERR_INCORRECT_REQUEST], status=400)
+
+    algoname = reqparams['algo_name'] if 'algo_name' in reqparams else ''
+    start_ts = reqparams['start_ts'] if 'start_ts' in reqparams else ''
+    end_ts = reqparams['end_ts'] if 'end_ts' in reqparams else ''
+    grid = reqparams['grid'] if 'grid' in reqparams else None
+    priority = reqparams['priority'] if 'priority' in reqparams else 0
+
+    if not (algoname and grid) or type(priority) != int:
+        return json_response(STATUS_ERR % ERRORS[ERR_INCORRECT_REQUEST], status=400)
+
+    try:
+        algo = await get_existing_algo(userid, algoname)
+    except:
+        return json_response(STATUS_ERR % ERRORS[ERR_INTERNAL_ERROR], status=500)
+
+    if not algo:
+        return json_response(STATUS_ERR % ERRORS[ERR_RESOURCE_NOT_FOUND], status=400)
+
+    try:
+        combinations = len(expand_grid(algo['strategy_parameters'], grid))
+    except:
+        logging.exception('Incorrect sweep grid')
+        return json_response(STATUS_ERR % ERRORS[ERR_INCORRECT_REQUEST], status=400)
+
+    num_tries = 0
+    while num_tries < 3:
+        try:
+            async with aiosqlite.connect(get_backtest_db()) as db:
+                cursor = await db.execute("insert into backtest_request(userid, algoname, start_ts, end_ts, "
+                                          "tradepair, candlesize, strategyname, parameters, grid, status, priority, "
+                                          "cost, queued_at) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                          [userid, algoname, start_ts, end_ts,
+                                           algo['trade_pair'], algo['candle_size'], algo['strategy_name'],
+                                           json.dumps(algo['strategy_parameters']), json.dumps(grid),
+                                           Backtest.STATUS_NEW, priority,
+                                           estimate_cost(start_ts, end_ts, algo['candle_size'], combinations),
+                                           int(time.time())])
+                await db.commit()
+
+                breq = {'req_id': cursor.lastrowid}
+            break
+        except:
+            logging.exception('Exception occurred while updating backtest_request')
+            num_tries += 1
+    else:
+        return json_response(STATUS_ERR % ERRORS[ERR_INTERNAL_ERROR], status=400)
+
+    notify_backtester(breq['req_id'])
+    return json_response(json.dumps(breq))
+
+
+@login_required
+@routes.get('/backtest/sweep/results/{req_id}')
+async def backtest_sweep_results(request):
     userid = request.user
     breq_id = request.match_info['req_id']
 
-    bstatus = None
+    try:
+        limit = int(request.query.get('limit', -1))
+    except ValueError:
+        return json_response(STATUS_ERR % ERRORS[ERR_INCORRECT_REQUEST], status=400)
+
     num_tries = 0
+    exist = False
+    results = []
     while num_tries < 3:
         try:
             async with aiosqlite.connect(get_backtest_db()) as db:
-                async with db.execute("select id, algoname, start_ts, end_ts, "
-                                      "tradepair, candlesize, strategyname, parameters, status "
-                                      "from backtest_request where userid = ? and id = ?",
-                                      [userid, breq_id]) as cursor:
+                results_id = None
+                async with db.execute("select coalesce(results_id, id) from backtest_request where userid = ? and "
+                                      "id = ? and grid is not null", [userid, breq_id]) as cursor:
                     async for row in cursor:
-                        bstatus = {
-                            'id': row[0],
-                            'algo_name': row[1],
-                            'start_ts': row[2],
-                            'end_ts': row[3],
-                            'trade_pair': row[4],
-                            'candle_size': row[5],
-                            'strategy_name': row[6],
-                            'strategy_parameters': row[7],
-                            'status': row[8],
+                        exist = True
+                        results_id = row[0]
+
+                async with db.execute("select rank, parameters, pnl, num_trades, max_drawdown "
+                                      "from backtest_sweep_results where backtest_id = ? order by rank limit ?",
+                                      [results_id, limit]) as cursor:
+                    async for row in cursor:
+                        results += [
+                            {
+                                'rank': row[0],
+                                'strategy_parameters': json.loads(row[1]),
+                                'pnl': row[2],
+                                'num_trades': row[3],
+                                'max_drawdown': row[4],
+                            }
+                        ]
+            break
+        except:
+            logging.exception('Exception occurred while reading backtest_sweep_results')
+            results = []
+            num_tries += 1
+    else:
+        return json_response(STATUS_ERR % ERRORS[ERR_INTERNAL_ERROR], status=500)
+
+    if not exist:
+        return json_response(STATUS_ERR % ERRORS[ERR_RESOURCE_NOT_FOUND], status=400)
+
+    return json_response(json.dumps(results))
+
+
+@login_required
+@routes.post('/backtest/portfolio/')
+async def backtest_portfolio(request):
+    userid = request.user
+    reqparams = await request.json()
+
+    if type(reqparams) != dict:
+        return json_response(STATUS_ERR % ERRORS[ERR_INCORRECT_REQUEST], status=400)
+
+    algoname = reqparams['algo_name'] if 'algo_name' in reqparams else ''
+    start_ts = reqparams['start_ts'] if 'start_ts' in reqparams else ''
+    end_ts = reqparams['end_ts'] if 'end_ts' in reqparams else ''
+    pairs = reqparams['trade_pairs'] if 'trade_pairs' in reqparams else None
+    capital = reqparams['capital'] if 'capital' in reqparams else None
+    priority = reqparams['priority'] if 'priority' in reqparams else 0
+
+    if not algoname or type(priority) != int:
+        return json_response(STATUS_ERR % ERRORS[ERR_INCORRECT_REQUEST], status=400)
+    if type(pairs) != list or not 0 < len(pairs) <= MAX_PORTFOLIO_PAIRS or len(set(map(str, pairs))) != len(pairs):
+        return json_response(STATUS_ERR % ERRORS[ERR_INCORRECT_REQUEST], status=400)
+    # capital is shared in units of the base asset, hence all the pairs have the same base asset
+    if not all([type(pair) == str and len(pair.split('_')) == 4 for pair in pairs]) or \
+            len(set([tuple(pair.split('_')[:2]) for pair in pairs])) != 1:
+        return json_response(STATUS_ERR % ERRORS[ERR_INCORRECT_REQUEST], status=400)
+    if capital is not None and (type(capital) not in (int, float) or capital <= 0):
+        return json_response(STATUS_ERR % ERRORS[ERR_INCORRECT_REQUEST], status=400)
+
+    try:
+        algo = await get_existing_algo(userid, algoname)
+    except:
+        return json_response(STATUS_ERR % ERRORS[ERR_INTERNAL_ERROR], status=500)
+
+    if not algo:
+        return json_response(STATUS_ERR % ERRORS[ERR_RESOURCE_NOT_FOUND], status=400)
+
+    num_tries = 0
+    while num_tries < 3:
+        try:
+            async with aiosqlite.connect(get_backtest_db()) as db:
+                cursor = await db.execute("insert into backtest_request(userid, algoname, start_ts, end_ts, "
+                                          "tradepair, candlesize, strategyname, parameters, pairs, capital, status, "
+                                          "priority, cost, queued_at) "
+                                          "values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                          [userid, algoname, start_ts, end_ts,
+                                           pairs[0], algo['candle_size'], algo['strategy_name'],
+                                           json.dumps(algo['strategy_parameters']), json.dumps(pairs), capital,
+                                           Backtest.STATUS_NEW, priority,
+                                           estimate_cost(start_ts, end_ts, algo['candle_size'], len(pairs)),
+                                           int(time.time())])
+                await db.commit()
+
+                breq = {'req_id': cursor.lastrowid}
+            break
+        except:
+            logging.exception('Exception occurred while updating backtest_request')
+            num_tries += 1
+    else:
+        return json_response(STATUS_ERR % ERRORS[ERR_INTERNAL_ERROR], status=400)
+
+    notify_backtester(breq['req_id'])
+    return json_response(json.dumps(breq))
+
+
+@login_required
+@routes.get('/backtest/portfolio/results/{req_id}')
+async def backtest_portfolio_results(request):
+    userid = request.user
+    breq_id = request.match_info['req_id']
+    with_curve = request.query.get('equity_curve', 'false').lower() not in ('false', '0')
+
+    num_tries = 0
+    exist = False
+    results = []
+    while num_tries < 3:
+        try:
+            async with aiosqlite.connect(get_backtest_db()) as db:
+                results_id = None
+                async with db.execute("select coalesce(results_id, id) from backtest_request where userid = ? and "
+                                      "id = ? and pairs is not null", [userid, breq_id]) as cursor:
+                    async for row in cursor:
+                        exist = True
+                        results_id = row[0]
+
+                async with db.execute("select trade_pair, num_candles, num_trades, total_return, max_drawdown, "
+                                      "sharpe, sortino, win_rate, exposure, %s from backtest_pair_metrics "
+                                      "where backtest_id = ? order by total_return desc"
+                                      % ('equity_curve' if with_curve else 'null'), [results_id]) as cursor:
+                    async for row in cursor:
+                        metrics = {
+                            'trade_pair': row[0],
+                            'num_candles': row[1],
+                            'num_trades': row[2],
+                            'total_return': row[3],
+                            'max_drawdown': row[4],
+                            'sharpe': row[5],
+                            'sortino': row[6],
+                            'win_rate': row[7],
+                            'exposure': row[8],
+                        }
+                        if with_curve:
+                            metrics['equity_curve'] = decode_equity_curve(row[9])
+                        results += [metrics]
+            break
+        except:
+            logging.exception('Exception occurred while reading backtest_pair_metrics')
+            results = []
+            num_tries += 1
+    else:
+        return json_response(STATUS_ERR % ERRORS[ERR_INTERNAL_ERROR], status=500)
+
+    if not exist:
+        return json_response(STATUS_ERR % ERRORS[ERR_RESOURCE_NOT_FOUND], status=400)
+
+    return json_response(json.dumps(results))
+
+
+@login_required
+@routes.get('/backtest/metrics/{backtest_id}')
+async def backtest_metrics(request):
+    userid = request.user
+    backtest_id = request.match_info['backtest_id']
+    with_curve = request.query.get('equity_curve', 'true').lower() not in ('false', '0')
+
+    num_tries = 0
+    exist = False
+    metrics = None
+    while num_tries < 3:
+        try:
+            async with aiosqlite.connect(get_backtest_db()) as db:
+                results_id = None
+                async with db.execute("select coalesce(results_id, id) from backtest_request "
+                                      "where userid = ? and id = ?", [userid, backtest_id]) as cursor:
+                    async for row in cursor:
+                        exist = True
+                        results_id = row[0]
+
+                async with db.execute("select num_candles, num_trades, total_return, max_drawdown, sharpe, sortino, "
+                                      "win_rate, exposure, %s from backtest_metrics where backtest_id = ?"
+                                      % ('equity_curve' if with_curve else 'null'), [results_id]) as cursor:
+                    async for row in cursor:
+                        metrics = {
+                            'num_candles': row[0],
+                            'num_trades': row[1],
+                            'total_return': row[2],
+                            'max_drawdown': row[3],
+                            'sharpe': row[4],
+                            'sortino': row[5],
+                            'win_rate': row[6],
+                            'exposure': row[7],
                         }
+                        if with_curve:
+                            metrics['equity_curve'] = decode_equity_curve(row[8])
+            break
+        except:
+            logging.exception('Exception occurred while reading backtest_metrics')
+            num_tries += 1
+    else:
+        return json_response(STATUS_ERR % ERRORS[ERR_INTERNAL_ERROR], status=500)
+
+    if not exist or not metrics:
+        return json_response(STATUS_ERR % ERRORS[ERR_RESOURCE_NOT_FOUND], status=400)
+
+    return json_response(json.dumps(metrics))
+
+
+@login_required
+@routes.get('/backtest/status/{req_id}')
+async def backtest_status(request):
+    userid = request.user
+    breq_id = request.match_info['req_id']
+
+    bstatus = None
+    num_tries = 0
+    while num_tries < 3:
+        try:
+            bstatus = await get_backtest_status(userid, breq_id)
             break
         except:
             logging.exception('Exception occurred while updating backtest_request')
@@ -247,6 +568,63 @@ async def backtest_status(request):
         return json_response(STATUS_ERR % ERRORS[ERR_RESOURCE_NOT_FOUND], status=400)
 
 
+@login_required
+@routes.get('/backtest/wait/{req_id}')
+async def backtest_wait(request):
+    """
+    Returns status of the backtest as soon as it is different from given status, or the backtest is finished (or
+    failed) if status is not given. Current status is returned after timeout seconds.
+    """
+    userid = request.user
+    breq_id = request.match_info['req_id']
+    status = request.query.get('status', None)
+
+    try:
+        bid = int(breq_id)
+        timeout = min(float(request.query.get('timeout', WAIT_TIMEOUT)), MAX_WAIT_TIMEOUT)
+    except ValueError:
+        return json_response(STATUS_ERR % ERRORS[ERR_INCORRECT_REQUEST], status=400)
+
+    loop = asyncio.get_event_loop()
+    deadline = time.time() + timeout
+    while True:
+        # registered before reading the status, so that notification sent meanwhile is not missed
+        future = loop.create_future()
+        backtest_waiters.setdefault(bid, []).append(future)
+        try:
+            num_tries = 0
+            while num_tries < 3:
+                try:
+                    bstatus = await get_backtest_status(userid, breq_id)
+                    break
+                except:
+                    logging.exception('Exception occurred while reading backtest_request')
+                    num_tries += 1
+            else:
+                return json_response(STATUS_ERR % ERRORS[ERR_INTERNAL_ERROR], status=500)
+
+            if not bstatus:
+                return json_response(STATUS_ERR % ERRORS[ERR_RESOURCE_NOT_FOUND], status=400)
+
+            if status:
+                changed = bstatus['status'] != status
+            else:
+                changed = bstatus['status'] in (Backtest.STATUS_FINISHED, Backtest.STATUS_ERROR)
+            remaining = deadline - time.time()
+            if changed or remaining <= 0:
+                return json_response(json.dumps(bstatus))
+
+            try:
+                await asyncio.wait_for(future, min(remaining, WAIT_POLL_INTERVAL))
+            except asyncio.TimeoutError:
+                pass
+        finally:
+            if future in backtest_waiters.get(bid, []):
+                backtest_waiters[bid].remove(future)
+                if not backtest_waiters[bid]:
+                    del backtest_waiters[bid]
+
+
 @login_required
 @routes.get('/backtest/trades/{backtest_id}')
 async def backtest_trades(request):
@@ -255,15 +633,18 @@ async def backtest_trades(request):
 
     num_tries = 0
     exist = False
+    results_id = None
     while num_tries < 3:
         try:
             async with aiosqlite.connect(get_backtest_db()) as db:
                 async with db.execute("select id, algoname, start_ts, end_ts, "
-                                      "tradepair, candlesize, strategyname, parameters, status "
-                                      "from backtest_request where userid = ? and id = ?",
+                                      "tradepair, candlesize, strategyname, parameters, status, "
+                                      "coalesce(results_id, id) from backtest_request where userid = ? and id = ?",
                                       [userid, backtest_id]) as cursor:
                     async for row in cursor:
                         exist = True
+                        # backtest identical to an earlier one has its results
+                        results_id = row[9]
             break
         except:
             logging.exception('Exception occurred while updating backtest_request')
@@ -279,7 +660,7 @@ async def backtest_trades(request):
         async with aiosqlite.connect(get_backtest_db()) as db:
             async with db.execute("select ts, advice, sold_asset, sold_amount, bought_asset, bought_amount "
                                   "from backtest_trades where backtest_id = ?",
-                                  [backtest_id]) as cursor:
+                                  [results_id]) as cursor:
                 async for row in cursor:
                     trades += [
                         {
@@ -510,6 +891,25 @@ async def auth_middleware(app, handler):
     return middleware
 
 
+async def start_notifications(app):
+    app['notifications'] = None
+    if not get_webapp_socket():
+        return
+
+    try:
+        sock = bind(get_webapp_socket())
+        transport, protocol = await app.loop.create_datagram_endpoint(BacktestNotifications, sock=sock)
+        app['notifications'] = transport
+        logging.info('Listening for backtest notifications on %s' % get_webapp_socket())
+    except:
+        logging.exception('Cannot listen on %s, backtest status is polled' % get_webapp_socket())
+
+
+async def stop_notifications(app):
+    if app['notifications']:
+        app['notifications'].close()
+
+
 def run_api_server(host, port, startup, cleanup, config):
     app = web.Application(middlewares=[auth_middleware])
 
@@ -541,5 +941,7 @@ def run_api_server(host, port, startup, cleanup, config):
 
     app.add_routes(routes)
     app.on_startup.append(startup)
+    app.on_startup.append(start_notifications)
     app.on_cleanup.append(cleanup)
+    app.on_cleanup.append(stop_notifications)
     web.run_app(app, host=host, port=port)
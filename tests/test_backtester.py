@@ -0,0 +1,164 @@
+import datetime
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import sqlite3
+import tempfile
+import unittest
+
+import numpy as np
+
+import stardust.backtester as backtester
+from stardust.data import set_db, Backtest
+from stardust.strategies.macd import MACD
+
+SCHEMA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'db.schema')
+TRADE_PAIR = 'XLM_native_USD_GA'
+PARAMETERS = {'fastperiod': 12, 'slowperiod': 26, 'signalperiod': 9, 'threshold_up': 0.0001,
+              'threshold_down': -0.0001, 'trend_stickiness': 1}
+
+
+def create_db(path, n):
+    """
+    Creates backtest db with n random minute candles of TRADE_PAIR.
+    """
+    conn = sqlite3.connect(path)
+    conn.executescript(''.join(line for line in open(SCHEMA) if not line.startswith('#')))
+    rng = np.random.RandomState(1)
+    close = 1 + np.cumsum(rng.randn(n)) * 0.01
+    start = datetime.datetime(2019, 1, 1)
+    rows = []
+    for i in range(n):
+        d = start + datetime.timedelta(minutes=i)
+        ts = int((d - datetime.datetime(1970, 1, 1)).total_seconds())
+        c_open = close[i - 1] if i else close[i]
+        rows += [(TRADE_PAIR, ts, d.year, d.month, int(d.strftime('%W')), d.day, d.hour // 4, d.hour, d.minute // 15,
+                  d.minute // 5, d.minute, c_open, max(c_open, close[i]) + 0.001, min(c_open, close[i]) - 0.001,
+                  close[i], 1.0, 1.0)]
+    conn.executemany('insert into sdex_ohlcv(trade_pair, ts, year, month, week, day, hour4, hour, minute15, minute5, '
+                     'minute, open, high, low, close, base_volume, counter_volume) '
+                     'values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    conn.commit()
+    conn.close()
+
+
+def add_request(path):
+    with sqlite3.connect(path) as conn:
+        cursor = conn.execute("insert into backtest_request(userid, algoname, start_ts, end_ts, tradepair, candlesize, "
+                              "strategyname, parameters, status) values (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                              ['user', 'algo', 0, 0, TRADE_PAIR, '1min', 'macd', json.dumps(PARAMETERS),
+                               Backtest.STATUS_NEW])
+        conn.commit()
+        return cursor.lastrowid
+
+
+def stop_after_checkpoint(save_trades):
+    """
+    :return: SdexHistory._save_trades which stops the worker the same way as SIGTERM once checkpoint is saved
+    """
+    def _save_trades(self, bid, trades, db=None, checkpoint=None):
+        saved = save_trades(self, bid, trades, db, checkpoint)
+        if saved and checkpoint and checkpoint[2] is not None:
+            os.kill(os.getpid(), signal.SIGTERM)
+        return saved
+    return _save_trades
+
+
+def stop_while_claiming(claim_backtest):
+    """
+    :return: claim_backtest which stops the worker while retrying a failed db operation
+    """
+    def _claim_backtest(worker, lease_ttl=backtester.LEASE_TTL):
+        claimed = claim_backtest(worker, lease_ttl)
+        try:
+            os.kill(os.getpid(), signal.SIGTERM)
+        except:
+            pass
+        return claimed
+    return _claim_backtest
+
+
+class StoppedWorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = os.path.join(self.tmpdir, 'backtest.db')
+        create_db(self.db, 20000)
+        set_db(self.db, self.db)
+        backtester.upgrade_backtest_db()
+
+        self.patched = (MACD.VECTORIZED, backtester.CHECKPOINT_INTERVAL, backtester.SdexHistory._save_trades,
+                        backtester.claim_backtest)
+        # backtest is run candle by candle and checkpointed every PROGRESS_CANDLES candles
+        MACD.VECTORIZED = False
+        backtester.CHECKPOINT_INTERVAL = 0
+
+    def tearDown(self):
+        MACD.VECTORIZED, backtester.CHECKPOINT_INTERVAL, backtester.SdexHistory._save_trades, \
+            backtester.claim_backtest = self.patched
+        shutil.rmtree(self.tmpdir)
+
+    def test_stopped_backtest_is_resumed_from_checkpoint(self):
+        bid = add_request(self.db)
+        backtester.SdexHistory._save_trades = stop_after_checkpoint(self.patched[2])
+        worker = multiprocessing.get_context('fork').Process(target=backtester.run_worker,
+                                                             args=('stopped', self.db, self.db))
+        worker.start()
+        worker.join(60)
+        backtester.SdexHistory._save_trades = self.patched[2]
+        self.assertEqual(worker.exitcode, 0)
+
+        conn = sqlite3.connect(self.db)
+        status, lease_owner, attempts = conn.execute("select status, lease_owner, attempts from backtest_request "
+                                                     "where id = ?", [bid]).fetchone()
+        self.assertEqual(status, Backtest.STATUS_RUNNING)
+        self.assertIsNone(lease_owner)
+        self.assertEqual(attempts, 0)
+        checkpoint_ts, candles, state = backtester.SdexHistory.load_checkpoint(bid)
+        self.assertTrue(0 < candles < 20000)
+        trades = conn.execute("select id, advice, sold_amount, bought_amount from backtest_trades "
+                              "where backtest_id = ? order by id", [bid]).fetchall()
+
+        # released backtest is claimed again without counting the attempt and resumed from the checkpoint
+        backtest, lease, attempts, resumed = backtester.claim_backtest('resumed')
+        self.assertEqual((backtest.bid, attempts, resumed), (bid, 1, True))
+        self.assertTrue(backtester.delete_backtest_results(bid, resume=True))
+        self.assertEqual(backtester.SdexHistory.load_checkpoint(bid)[0], checkpoint_ts)
+
+        history = backtester.SdexHistory(self.db).init()
+        history.lease = lease
+        self.assertEqual(history.run(backtest), (True, None))
+        history.lease = None
+        resumed_trades = conn.execute("select id, advice, sold_amount, bought_amount from backtest_trades "
+                                      "where backtest_id = ? order by id", [bid]).fetchall()
+        self.assertEqual(resumed_trades[:len(trades)], trades)
+
+        # resumed backtest has the same trades as uninterrupted one
+        other = add_request(self.db)
+        self.assertEqual(history.run(Backtest(other, 'algo', 0, 0, TRADE_PAIR, '1min', 'macd', PARAMETERS)),
+                         (True, None))
+        history.close()
+        other_trades = conn.execute("select advice, sold_amount, bought_amount from backtest_trades "
+                                    "where backtest_id = ? order by id", [other]).fetchall()
+        self.assertEqual([trade[1:] for trade in resumed_trades], other_trades)
+        conn.close()
+
+    def test_worker_stopped_during_db_retry_releases_backtest(self):
+        bid = add_request(self.db)
+        backtester.claim_backtest = stop_while_claiming(self.patched[3])
+        worker = multiprocessing.get_context('fork').Process(target=backtester.run_worker,
+                                                             args=('stopped', self.db, self.db))
+        worker.start()
+        worker.join(60)
+        backtester.claim_backtest = self.patched[3]
+        self.assertEqual(worker.exitcode, 0)
+
+        with sqlite3.connect(self.db) as conn:
+            status, lease_owner, attempts = conn.execute("select status, lease_owner, attempts from backtest_request "
+                                                         "where id = ?", [bid]).fetchone()
+        self.assertEqual((status, lease_owner, attempts), (Backtest.STATUS_RUNNING, None, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()